@@ -159,6 +159,14 @@ def get_parser():
                         help='used to get perplexity in evaluation')
     parser.set_defaults(get_perplexity=False)
 
+    parser.add_argument('--quantize', dest='quantize', action='store_true',
+                        help='int8 dynamic quantization of the linear layers of the decoders (cpu inference only)')
+    parser.set_defaults(quantize=False)
+
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'fused'],
+                        help='run the model in eager pytorch, as the graph exported by Foodimg2Ing.export or in '
+                             'eager pytorch with fused decoder layers (both inference only)')
+
     parser.add_argument('--use_true_ingrs', dest='use_true_ingrs', action='store_true',
                         help='if used, true ingredients will be used as input to obtain the recipe in evaluation')
     parser.set_defaults(use_true_ingrs=False)
@@ -0,0 +1,112 @@
+#batching.py
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent prediction requests into batched model calls.
+
+    Requests are queued and a single worker thread groups them into batches of at most `max_batch_size`,
+    waiting no more than `max_wait_ms` after the oldest queued request before running `predict_fn` on the
+    whole batch. `predict_fn` takes a list of inputs and returns one result per input, in order.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=20, num_wait_samples=1000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self._batch_sizes = collections.Counter()
+        self._wait_times = collections.deque(maxlen=num_wait_samples)
+        self._num_requests = 0
+
+    def submit(self, item):
+        """Queue an input, returns a Future holding its result"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.time()))
+        return future
+
+    def predict(self, item, timeout=None):
+        """Queue an input and block until its result is ready"""
+        return self.submit(item).result(timeout)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # past the deadline, only take what is already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._run_batch(self._next_batch())
+
+    def _run_batch(self, batch, record=True):
+        if record:
+            start = time.time()
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._num_requests += len(batch)
+                self._wait_times.extend(start - enqueued for _, _, enqueued in batch)
+
+        try:
+            results = self.predict_fn([item for item, _, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                # one bad input (e.g. an unreadable upload) should not fail the rest of the batch
+                for request in batch:
+                    self._run_batch([request], record=False)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """Queue depth, batch size histogram and queueing time of recent requests (in ms)"""
+        with self._lock:
+            wait_times = sorted(self._wait_times)
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            num_requests = self._num_requests
+
+        wait_ms = {}
+        if wait_times:
+            wait_ms = {
+                'mean': 1000 * sum(wait_times) / len(wait_times),
+                'p50': 1000 * wait_times[len(wait_times) // 2],
+                'p95': 1000 * wait_times[min(len(wait_times) - 1, int(0.95 * len(wait_times)))],
+                'max': 1000 * wait_times[-1],
+            }
+
+        return {
+            'queue_depth': self._queue.qsize(),
+            'requests': num_requests,
+            'batches': sum(batch_sizes.values()),
+            'batch_sizes': batch_sizes,
+            'wait_ms': wait_ms,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': 1000 * self.max_wait,
+        }
@@ -0,0 +1,140 @@
+#cache.py
+import collections
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+def tensor_key(tensor, *parts):
+    """Content address of what is computed from a tensor: hash of its values and shape and of the repr of
+    `parts`, e.g. the model version and decoding params of a prediction from a preprocessed image"""
+    digest = hashlib.sha256()
+    digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    digest.update(str(tuple(tensor.shape)).encode())
+    for part in parts:
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    """Two-tier cache of predictions keyed by tensor_key(image_tensor, model_version, params).
+
+    The first tier is an in-process LRU of at most `max_entries` predictions. With `path`, predictions are also
+    stored in a SQLite database shared by processes and restarts, whose least recently used entries are evicted
+    once it holds more than `max_bytes`. Values are pickled, so callers always get their own copy.
+    """
+
+    def __init__(self, max_entries=1024, path=None, max_bytes=256 * 2 ** 20):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._db = None
+        self._counts = collections.Counter()
+
+    def _connect(self):
+        if self._db is None and self.path is not None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                             '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions (last_access)')
+            self._db.commit()
+        return self._db
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._counts['memory_hits'] += 1
+                return pickle.loads(data)
+
+            db = self._connect()
+            if db is not None:
+                row = db.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    db.execute('UPDATE predictions SET last_access = ? WHERE key = ?', (time.time(), key))
+                    db.commit()
+                    self._remember(key, row[0])
+                    self._counts['disk_hits'] += 1
+                    return pickle.loads(row[0])
+
+            self._counts['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remember(key, data)
+            db = self._connect()
+            if db is not None:
+                db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                           (key, data, len(data), time.time()))
+                self._evict_disk(db)
+                db.commit()
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counts['memory_evictions'] += 1
+
+    def _evict_disk(self, db):
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute('SELECT key, size FROM predictions ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            db.execute('DELETE FROM predictions WHERE key = ?', (key,))
+            total -= size
+            self._counts['disk_evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            db = self._connect()
+            if db is not None:
+                db.execute('DELETE FROM predictions')
+                db.commit()
+
+    def stats(self):
+        """Hits per tier, misses, evictions and the size of each tier"""
+        with self._lock:
+            counts = dict(self._counts)
+            memory_entries = len(self._memory)
+            memory_bytes = sum(len(data) for data in self._memory.values())
+            disk_entries, disk_bytes = 0, 0
+            db = self._connect()
+            if db is not None:
+                disk_entries, disk_bytes = db.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions').fetchone()
+
+        hits = counts.get('memory_hits', 0) + counts.get('disk_hits', 0)
+        requests = hits + counts.get('misses', 0)
+        return {
+            'requests': requests,
+            'hits': hits,
+            'memory_hits': counts.get('memory_hits', 0),
+            'disk_hits': counts.get('disk_hits', 0),
+            'misses': counts.get('misses', 0),
+            'hit_rate': hits / requests if requests else 0.0,
+            'memory_evictions': counts.get('memory_evictions', 0),
+            'disk_evictions': counts.get('disk_evictions', 0),
+            'memory_entries': memory_entries,
+            'memory_bytes': memory_bytes,
+            'disk_entries': disk_entries,
+            'disk_bytes': disk_bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes if self.path is not None else None,
+        }
@@ -0,0 +1,59 @@
+#checkpoint.py
+import os
+import tempfile
+import time
+
+from Foodimg2Ing.filelock import file_lock
+
+# files derived from the checkpoint (safetensors conversion, quantized weights, exported graph) are cached next
+# to the vocabularies with the signature of the checkpoint they were built from, and rebuilt when it changes
+
+
+def checkpoint_signature(model_path):
+    """Identifies the checkpoint a derived file was built from"""
+    stat = os.stat(model_path)
+    return {'path': os.path.realpath(model_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def write_file(path, write):
+    """Call write(tmp_path) on a temporary file of its own next to path, then rename it to path, so readers of
+    path see either the previous file or the whole new one"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_derived(path, model_path, load, write):
+    """Contents of the file at path derived from the checkpoint at model_path.
+
+    load(path) returns the signature of the checkpoint the file was built from and its contents. When the file
+    is missing or was built from another checkpoint, write(tmp_path, signature) builds it again, one process at
+    a time. Raises OSError when it cannot be written.
+    """
+    signature = checkpoint_signature(model_path)
+
+    def read():
+        if not os.path.exists(path):
+            return None
+        source, value = load(path)
+        return value if source == signature else None
+
+    value = read()
+    if value is not None:
+        return value
+    with file_lock(path + '.lock'):
+        # processes that waited for the lock read the file written by the first one
+        value = read()
+        if value is not None:
+            return value
+        start = time.time()
+        write_file(path, lambda tmp_path: write(tmp_path, signature))
+        print(f"Built {path} from {model_path} in {time.time() - start:.2f}s")
+    return load(path)[1]
@@ -0,0 +1,170 @@
+#data_loader.py
+import math
+import os
+import pickle
+
+import lmdb
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+from torchvision import transforms
+
+
+class Vocabulary(object):
+    """Vocabulary built for training (recipe1m_vocab_ingrs.pkl): word2idx maps every ingredient name, synonyms
+    included, to its id and idx2word maps ids to their names"""
+
+    def __init__(self):
+        self.word2idx = {}
+        self.idx2word = {}
+        self.idx = 0
+
+    def __call__(self, word):
+        if word not in self.word2idx:
+            return self.word2idx['<pad>']
+        return self.word2idx[word]
+
+    def __len__(self):
+        return len(self.idx2word)
+
+
+class VocabularyUnpickler(pickle.Unpickler):
+    # the training vocabularies were pickled from build_vocab.py, run as a script
+    def find_class(self, module, name):
+        if name == 'Vocabulary':
+            return Vocabulary
+        return super().find_class(module, name)
+
+
+def load_ingrs_vocab(aux_data_dir, suff=''):
+    """Ingredient Vocabulary the model was trained with"""
+    with open(os.path.join(aux_data_dir, suff + 'recipe1m_vocab_ingrs.pkl'), 'rb') as f:
+        return VocabularyUnpickler(f).load()
+
+
+class Recipe1MImages(data.Dataset):
+    """Images of a Recipe1M split, in the order of imname2pos.pkl, as (transformed image, image name).
+
+    With use_lmdb, images are read from the lmdb_<split> database written by utils/ims2file.py. The environment
+    is opened readonly on first access in each process, so DataLoader workers never share a handle, and values
+    are read in place from the memory map (buffer transactions + np.frombuffer). Otherwise the jpg files in
+    recipe1m_dir/images/<split> are decoded, resized and center cropped to image_size as ims2file does.
+    `names` restricts the dataset to those images.
+    """
+
+    def __init__(self, aux_data_dir, split, transform=None, use_lmdb=True, recipe1m_dir=None, image_size=256,
+                 max_num_samples=-1, names=None):
+        if names is None:
+            with open(os.path.join(aux_data_dir, 'imname2pos.pkl'), 'rb') as f:
+                names = pickle.load(f)[split]
+        self.names = list(names)
+        if max_num_samples != -1:
+            self.names = self.names[:max_num_samples]
+
+        self.split = split
+        self.transform = transform
+        self.use_lmdb = use_lmdb
+        self.lmdb_path = os.path.join(aux_data_dir, 'lmdb_' + split)
+        self.image_dir = os.path.join(recipe1m_dir, 'images', split) if recipe1m_dir is not None else None
+        self.resize = transforms.Compose([transforms.Resize(image_size), transforms.CenterCrop(image_size)])
+
+        self._env = None
+        self._pid = None
+
+    def __getstate__(self):
+        # handles are per process, workers started with spawn open their own
+        state = self.__dict__.copy()
+        state['_env'] = None
+        state['_pid'] = None
+        return state
+
+    def env(self):
+        if self._env is None or self._pid != os.getpid():
+            self._env = lmdb.open(self.lmdb_path, max_readers=1, readonly=True, lock=False, readahead=False,
+                                  meminit=False)
+            self._pid = os.getpid()
+        return self._env
+
+    def load(self, name):
+        if not self.use_lmdb:
+            path = os.path.join(self.image_dir, name[0], name[1], name[2], name[3], name)
+            return self.resize(Image.open(path).convert('RGB'))
+
+        with self.env().begin(write=False, buffers=True) as txn:
+            buffer = txn.get(name.encode())
+            if buffer is None:
+                raise KeyError('{} is not in {}'.format(name, self.lmdb_path))
+            side = int(math.sqrt(len(buffer) // 3))
+            image = np.frombuffer(buffer, dtype=np.uint8).reshape(side, side, 3)
+            # the buffer is only valid inside the transaction, PIL copies it
+            return Image.fromarray(image, 'RGB')
+
+    def __getitem__(self, index):
+        name = self.names[index]
+        image = self.load(name)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, name
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Recipe1MDataset(data.Dataset):
+    """Recipes of a split (recipe1m_<split>.pkl) that have images, as (first image, ingredient ids, recipe id).
+
+    Ingredient names are mapped to their id with the word2idx of the training vocabulary, which also holds the
+    synonyms merged into each ingredient; names missing from it are dropped. The ids are padded to maxnumlabels
+    with the index of '<pad>' (last in the vocabulary), the format of the ingr_ids returned by model.sample, so
+    both can go through label2onehot. Images are read as in Recipe1MImages.
+    """
+
+    def __init__(self, aux_data_dir, split, transform=None, use_lmdb=True, recipe1m_dir=None, image_size=256,
+                 maxnumlabels=20, suff='', max_num_samples=-1):
+        with open(os.path.join(aux_data_dir, suff + 'recipe1m_' + split + '.pkl'), 'rb') as f:
+            self.recipes = [entry for entry in pickle.load(f) if entry['images']]
+        if max_num_samples != -1:
+            self.recipes = self.recipes[:max_num_samples]
+
+        self.ingrs_vocab = load_ingrs_vocab(aux_data_dir, suff)
+        self.word2idx = self.ingrs_vocab.word2idx
+        self.pad_value = len(self.ingrs_vocab) - 1
+        self.maxnumlabels = maxnumlabels
+        self.images = Recipe1MImages(aux_data_dir, split, transform=transform, use_lmdb=use_lmdb,
+                                     recipe1m_dir=recipe1m_dir, image_size=image_size,
+                                     names=[entry['images'][0] for entry in self.recipes])
+
+    def __getitem__(self, index):
+        entry = self.recipes[index]
+        image, _ = self.images[index]
+
+        labels = []
+        for ingr in entry['ingredients']:
+            idx = self.word2idx.get(ingr)
+            if idx is not None and idx not in labels:
+                labels.append(idx)
+        labels = labels[:self.maxnumlabels]
+        labels = labels + [self.pad_value] * (self.maxnumlabels - len(labels))
+        return image, torch.tensor(labels), entry['id']
+
+    def __len__(self):
+        return len(self.recipes)
+
+
+def get_loader(args, split, transform, shuffle=False, max_num_samples=-1):
+    """DataLoader over the images of a split, reading from lmdb unless --load_jpeg is used"""
+    dataset = Recipe1MImages(args.aux_data_dir, split, transform=transform, use_lmdb=args.use_lmdb,
+                             recipe1m_dir=args.recipe1m_dir, image_size=args.image_size,
+                             max_num_samples=max_num_samples)
+    return data.DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle, num_workers=args.num_workers,
+                           pin_memory=torch.cuda.is_available(), persistent_workers=args.num_workers > 0)
+
+
+def get_eval_loader(args, split, transform, max_num_samples=-1):
+    """DataLoader over the recipes of a split with their ground truth ingredients, in order"""
+    dataset = Recipe1MDataset(args.aux_data_dir, split, transform=transform, use_lmdb=args.use_lmdb,
+                              recipe1m_dir=args.recipe1m_dir, image_size=args.image_size,
+                              maxnumlabels=args.maxnumlabels, suff=args.suff, max_num_samples=max_num_samples)
+    return data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers,
+                           pin_memory=torch.cuda.is_available())
@@ -0,0 +1,150 @@
+#evaluate.py
+import argparse
+import collections
+import contextlib
+import json
+import time
+
+import torch
+from torchvision import transforms
+
+from Foodimg2Ing.data_loader import get_eval_loader
+from Foodimg2Ing.model import label2onehot
+from Foodimg2Ing.registry import DATA_DIR, registry
+from utils.metrics import ErrorTypes, compute_metrics
+from utils.output_utils import prepare_output_batch
+
+# metrics compared with --baseline, higher is better for all of them
+GATED_METRICS = ['f1', 'f1_ingredients', 'iou', 'jaccard', 'valid']
+
+
+class StageTimer(object):
+    """Wall time spent in each stage of the evaluation, waiting for the device so that it is not
+    attributed to the next stage"""
+
+    def __init__(self, device):
+        self.device = device
+        self.times = collections.Counter()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.time()
+        yield
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.times[name] += time.time() - start
+
+
+def evaluate(args):
+    """Ingredient metrics and recipe validity of the model on args.eval_split, with throughput and latency
+    per stage"""
+    loaded = registry.get(args.data_dir, quantize=args.quantize, backend=args.backend)
+    model, device = loaded.model, loaded.device
+    pad_value = len(loaded.ingrs_vocab) - 1
+
+    transform = transforms.Compose([transforms.CenterCrop(args.crop_size), transforms.ToTensor(),
+                                    transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+    # ground truth ids come from the training vocabulary, the vocabulary of the model is only used for decoding
+    loader = get_eval_loader(args, args.eval_split, transform, args.max_eval)
+    if loader.dataset.pad_value != pad_value:
+        raise ValueError('The training vocabulary in {} has {} ingredients, the model {}'.format(
+            args.aux_data_dir, loader.dataset.pad_value + 1, pad_value + 1))
+
+    timer = StageTimer(device)
+    error_types = ErrorTypes()
+    valid, n = 0, 0
+    start = time.time()
+    batches = iter(loader)
+    while True:
+        with timer('data'):
+            batch = next(batches, None)
+            if batch is not None:
+                images, ingr_gt = batch[0].to(device), batch[1].to(device)
+        if batch is None:
+            break
+
+        with torch.no_grad():
+            with timer('cnn'):
+                img_features = model.image_encoder(images)
+            with timer('decode'):
+                outputs = model.sample(images, greedy=args.greedy, temperature=args.temperature, beam=args.beam,
+                                       true_ingrs=None, img_features=img_features)
+            with timer('metrics'):
+                error_types.update(label2onehot(outputs['ingr_ids'], pad_value), label2onehot(ingr_gt, pad_value))
+
+        with timer('validity'):
+            predictions = prepare_output_batch(outputs['recipe_ids'].cpu().numpy(),
+                                               outputs['ingr_ids'].cpu().numpy(), loaded.ingrs_vocab, loaded.vocab)
+            valid += sum(v['is_valid'] for _, v in predictions)
+        n += len(predictions)
+        if n // args.batch_size % args.log_step == 0:
+            print('{}/{} samples'.format(n, len(loader.dataset)))
+    elapsed = time.time() - start
+
+    result = error_types.result()
+    ret_metrics = collections.defaultdict(list)
+    compute_metrics(ret_metrics, result, ['accuracy', 'f1', 'jaccard', 'dice'])
+    metrics = {name: float(values[-1]) for name, values in ret_metrics.items()}
+    metrics['iou'] = float(result['iou'])
+    metrics['valid'] = valid / n
+    metrics['samples'] = n
+    metrics['samples_per_s'] = n / elapsed
+    metrics['ms_per_sample'] = {name: 1000 * t / n for name, t in timer.times.items()}
+    return metrics
+
+
+def check_baseline(metrics, baseline, tolerance):
+    """Names of the gated metrics that dropped more than tolerance below the baseline"""
+    return [name for name in GATED_METRICS if name in baseline and metrics[name] < baseline[name] - tolerance]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='evaluate the model on a Recipe1M split')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--aux_data_dir', type=str, default='../data',
+                        help='directory with recipe1m_<split>.pkl, imname2pos.pkl and the lmdb_<split> databases')
+    parser.add_argument('--recipe1m_dir', type=str, default='path/to/recipe1m',
+                        help='directory where recipe1m dataset is extracted')
+    parser.add_argument('--suff', type=str, default='')
+    parser.add_argument('--eval_split', type=str, default='val')
+    parser.add_argument('--max_eval', type=int, default=-1, help='number of recipes to evaluate, -1 is all')
+    parser.add_argument('--load_jpeg', dest='use_lmdb', action='store_false',
+                        help='if used, images are loaded from jpg files instead of lmdb')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--crop_size', type=int, default=224)
+    parser.add_argument('--maxnumlabels', type=int, default=20)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--log_step', type=int, default=10, help='batches between progress messages')
+    parser.add_argument('--sampling', dest='greedy', action='store_false',
+                        help='sample the predictions with --temperature instead of greedy decoding')
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--beam', type=int, default=-1)
+    parser.add_argument('--quantize', action='store_true', help='evaluate the int8 dynamically quantized model')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'fused'])
+    parser.add_argument('--output', type=str, default='', help='write the metrics to this json file')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='json file written by --output, fail if a metric dropped below it')
+    parser.add_argument('--tolerance', type=float, default=0.005,
+                        help='largest drop of a metric allowed with --baseline')
+    args = parser.parse_args()
+
+    metrics = evaluate(args)
+    for name in ['f1', 'f1_ingredients', 'iou', 'jaccard', 'dice', 'accuracy', 'valid']:
+        print('{:>16}: {:.4f}'.format(name, metrics[name]))
+    print('{} samples, {:.1f} samples/s'.format(metrics['samples'], metrics['samples_per_s']))
+    print('ms per sample: ' + ', '.join('{} {:.2f}'.format(name, ms) for name, ms in metrics['ms_per_sample'].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = check_baseline(metrics, baseline, args.tolerance)
+        for name in regressions:
+            print('{} dropped from {:.4f} to {:.4f}'.format(name, baseline[name], metrics[name]))
+        if regressions:
+            raise SystemExit('{} metrics regressed'.format(len(regressions)))
+        print('no regression against {}'.format(args.baseline))
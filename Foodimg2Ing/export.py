@@ -0,0 +1,380 @@
+#export.py
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from Foodimg2Ing.checkpoint import load_derived
+from Foodimg2Ing.model import mask_from_eos, stage_callback
+from modules.transformer_decoder import SinusoidalPositionalEmbedding, mask_repetitions
+
+EXPORTED_FILENAME = 'modelbest.ts'
+EXPORTED_QUANTIZED_FILENAME = 'modelbest.int8.ts'
+
+
+def get_exported_path(data_dir, quantize=False):
+    return os.path.join(data_dir, EXPORTED_QUANTIZED_FILENAME if quantize else EXPORTED_FILENAME)
+
+
+def positional_table(decoder):
+    """Positional embedding of every position, as a plain tensor (None without positional embeddings)"""
+    if decoder.embed_positions is None:
+        return None
+    if isinstance(decoder.embed_positions, SinusoidalPositionalEmbedding):
+        return decoder.embed_positions.weights[:decoder.seq_length + 2].clone()
+    return decoder.embed_positions.weight.detach().clone()
+
+
+def attend(attn, q, k, v, mask):
+    """MultiheadAttention for a single query step. q is Time(1) x Batch x Channel and already scaled, k and v are
+    Time x Batch x Channel, mask is broadcastable to (batch x heads x 1 x time) and True where k is ignored"""
+    bsz = q.size(1)
+    src_len = k.size(0)
+    q = q.contiguous().view(1, bsz * attn.num_heads, attn.head_dim).transpose(0, 1)
+    k = k.contiguous().view(src_len, bsz * attn.num_heads, attn.head_dim).transpose(0, 1)
+    v = v.contiguous().view(src_len, bsz * attn.num_heads, attn.head_dim).transpose(0, 1)
+
+    attn_weights = torch.bmm(q, k.transpose(1, 2))
+    attn_weights = attn_weights.view(bsz, attn.num_heads, 1, src_len).masked_fill(mask, float('-inf'))
+    attn_weights = F.softmax(attn_weights.view(bsz * attn.num_heads, 1, src_len).float(), dim=-1)
+
+    out = torch.bmm(attn_weights, v)
+    out = out.transpose(0, 1).contiguous().view(1, bsz, attn.embed_dim)
+    return attn.out_proj(out)
+
+
+def decoder_step(decoder, positions, token, step, self_k, self_v, static_k, static_v, memory_mask):
+    """One incremental step of a DecoderTransformer with explicit key/value caches.
+
+    self_k/self_v (layers x capacity x batch x channel) are written in place at `step`; entries after `step` are
+    masked out, so the graph does not depend on how many steps were decoded. static_k/static_v (layers x time x
+    batch x channel) are the projected encoder outputs. Returns the logits (batch x vocab).
+    """
+    x = decoder.embed_scale * decoder.embed_tokens(token.unsqueeze(1))
+    if positions is not None:
+        # the first token is at position padding_idx + 1
+        x = x + positions.index_select(0, step.view(1) + 1).unsqueeze(0)
+    if decoder.normalize_inputs:
+        x = decoder.layer_norms_in[2](x)
+    x = x.transpose(0, 1)
+
+    future = torch.arange(self_k.size(1), device=self_k.device) > step
+    memory_mask = memory_mask.unsqueeze(1).unsqueeze(2)
+    for i, layer in enumerate(decoder.layers):
+        residual = x
+        x = layer.maybe_layer_norm(0, x, before=True)
+        q, k, v = layer.self_attn.in_proj_qkv(x)
+        self_k[i].index_copy_(0, step.view(1), k)
+        self_v[i].index_copy_(0, step.view(1), v)
+        x = residual + attend(layer.self_attn, q * layer.self_attn.scaling, self_k[i], self_v[i], future)
+        x = layer.maybe_layer_norm(0, x, after=True)
+
+        residual = x
+        x = layer.maybe_layer_norm(1, x, before=True)
+        q = layer.cond_att.in_proj_q(x) * layer.cond_att.scaling
+        x = residual + attend(layer.cond_att, q, static_k[i], static_v[i], memory_mask)
+        x = layer.maybe_layer_norm(1, x, after=True)
+
+        residual = x
+        x = layer.maybe_layer_norm(-1, x, before=True)
+        x = layer.fc2(F.relu(layer.fc1(x)))
+        x = residual + x
+        x = layer.maybe_layer_norm(-1, x, after=True)
+        if layer.use_last_ln:
+            x = layer.last_ln(x)
+
+    return decoder.linear(x[0])
+
+
+def decoder_prepare(decoder, ingr_features, ingr_mask, img_features):
+    """Keys/values of the encoder outputs for every layer (layers x time x batch x channel) and the memory
+    padding mask (batch x time, True at padding)"""
+    memory, memory_mask = decoder.prepare_memory(ingr_features, ingr_mask, img_features)
+    keys, values = [], []
+    for layer in decoder.layers:
+        k, v = layer.cond_att.in_proj_kv(memory)
+        keys.append(k)
+        values.append(v)
+    if memory_mask is None:
+        memory_mask = torch.zeros(memory.size(1), memory.size(0), dtype=torch.bool, device=memory.device)
+    return torch.stack(keys), torch.stack(values), memory_mask.bool()
+
+
+class ExportableModel(nn.Module):
+    """The pieces of InverseCookingModel.sample that run inside the exported graph. The decoding loops stay in
+    python (see ExportedModel), each method is traced separately."""
+
+    def __init__(self, model):
+        super(ExportableModel, self).__init__()
+        self.image_encoder = model.image_encoder
+        self.ingredient_encoder = model.ingredient_encoder
+        self.ingredient_decoder = model.ingredient_decoder
+        self.recipe_decoder = model.recipe_decoder
+        ingr_positions = positional_table(model.ingredient_decoder)
+        recipe_positions = positional_table(model.recipe_decoder)
+        self.register_buffer('ingr_positions', ingr_positions)
+        self.register_buffer('recipe_positions', recipe_positions)
+
+    def encode_image(self, img_inputs):
+        return self.image_encoder(img_inputs)
+
+    def encode_ingredients(self, ingr_ids):
+        return self.ingredient_encoder(ingr_ids)
+
+    def ingr_prepare(self, img_features):
+        return decoder_prepare(self.ingredient_decoder, None, None, img_features)
+
+    def ingr_step(self, token, step, self_k, self_v, static_k, static_v, memory_mask):
+        return decoder_step(self.ingredient_decoder, self.ingr_positions, token, step, self_k, self_v,
+                            static_k, static_v, memory_mask)
+
+    def recipe_prepare(self, ingr_features, ingr_mask, img_features):
+        return decoder_prepare(self.recipe_decoder, ingr_features, ingr_mask, img_features)
+
+    def recipe_step(self, token, step, self_k, self_v, static_k, static_v, memory_mask):
+        return decoder_step(self.recipe_decoder, self.recipe_positions, token, step, self_k, self_v,
+                            static_k, static_v, memory_mask)
+
+
+def export_model(model, path, source=None, crop_size=224):
+    """Trace the encoders and the decoder steps of an InverseCookingModel in eval mode and save them to path.
+    source identifies the checkpoint the model was loaded from."""
+    exportable = ExportableModel(model).eval()
+    batch = 2
+    img_inputs = torch.randn(batch, 3, crop_size, crop_size)
+
+    with torch.no_grad():
+        img_features = exportable.encode_image(img_inputs)
+        ingr_ids = torch.zeros(batch, model.ingredient_decoder.seq_length).long()
+        ingr_features = exportable.encode_ingredients(ingr_ids)
+        ingr_mask = torch.ones(batch, 1, ingr_ids.size(1))
+        ingr_kv = exportable.ingr_prepare(img_features)
+        recipe_kv = exportable.recipe_prepare(ingr_features, ingr_mask, img_features)
+
+        inputs = {
+            'encode_image': (img_inputs,),
+            'encode_ingredients': (ingr_ids,),
+            'ingr_prepare': (img_features,),
+            'ingr_step': step_inputs(model.ingredient_decoder, *ingr_kv),
+            'recipe_prepare': (ingr_features, ingr_mask, img_features),
+            'recipe_step': step_inputs(model.recipe_decoder, *recipe_kv),
+        }
+        traced = torch.jit.trace_module(exportable, inputs, check_trace=False)
+
+    meta = {
+        'pad_value': model.pad_value,
+        'ingrs_only': model.ingrs_only,
+        'recipe_only': model.recipe_only,
+        'ingr_seq_length': model.ingredient_decoder.seq_length,
+        'recipe_seq_length': model.recipe_decoder.seq_length,
+        'source': source,
+    }
+    torch.jit.save(traced, path, _extra_files={'meta.json': json.dumps(meta)})
+    return traced
+
+
+def step_inputs(decoder, static_k, static_v, memory_mask):
+    """Example inputs of a decoder step, with caches for the whole sequence"""
+    num_layers, _, batch, channels = static_k.size()
+    self_k = torch.zeros(num_layers, decoder.seq_length, batch, channels)
+    return torch.zeros(batch).long(), torch.tensor(1), self_k, self_k.clone(), static_k, static_v, memory_mask
+
+
+class ExportedModel(object):
+    """Runs an exported model with the same sample() interface as InverseCookingModel (greedy and top-k sampling,
+    beam search is only available with the eager model)"""
+
+    def __init__(self, module, meta, device):
+        self.module = module
+        self.device = device
+        self.pad_value = meta['pad_value']
+        self.ingrs_only = meta['ingrs_only']
+        self.recipe_only = meta['recipe_only']
+        self.ingr_seq_length = meta['ingr_seq_length']
+        self.recipe_seq_length = meta['recipe_seq_length']
+
+    def parameters(self):
+        return self.module.parameters()
+
+    def buffers(self):
+        return self.module.buffers()
+
+    def modules(self):
+        return self.module.modules()
+
+    def decode(self, step_fn, static_k, static_v, memory_mask, seq_length, greedy, temperature, replacement,
+               first_token_value, last_token_value, step_callback=None):
+        """Same decoding as DecoderTransformer.sample with early exit, using an exported step function"""
+        fs = memory_mask.size(0)
+        num_layers, _, _, channels = static_k.size()
+        self_k = torch.zeros(num_layers, seq_length, fs, channels, device=self.device)
+        self_v = torch.zeros(num_layers, seq_length, fs, channels, device=self.device)
+
+        token = torch.ones(fs, dtype=torch.long, device=self.device) * first_token_value
+        sampled_ids = torch.ones(fs, seq_length, dtype=torch.long, device=self.device) * last_token_value
+        logits = None
+        # rows of the output still being decoded
+        active = torch.arange(fs, device=self.device)
+        predicted_mask = None
+
+        for i in range(seq_length):
+            outputs = step_fn(token, torch.tensor(i), self_k, self_v, static_k, static_v, memory_mask)
+            if logits is None:
+                logits = torch.zeros(fs, seq_length, outputs.size(1), device=self.device)
+                if not replacement:
+                    predicted_mask = torch.zeros(fs, outputs.size(1), device=self.device)
+            if not replacement:
+                outputs += predicted_mask
+
+            logits[active, i] = outputs
+            if greedy:
+                _, predicted = F.softmax(outputs, dim=-1).max(1)
+            else:
+                prob_prev_topk, indices = torch.topk(F.softmax(outputs / temperature, dim=-1), k=10, dim=1)
+                predicted = torch.gather(indices, 1, torch.multinomial(prob_prev_topk, 1))[:, 0]
+
+            sampled_ids[active, i] = predicted
+            if step_callback is not None:
+                step_callback(i, active, predicted)
+            if not replacement:
+                mask_repetitions(predicted_mask, predicted)
+            token = predicted
+
+            # a row starting with last_token_value keeps decoding: mask_from_eos always keeps the first position
+            if i == 0:
+                continue
+            finished = predicted == last_token_value
+            if finished.all():
+                break
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(1)
+                active = active[keep]
+                token = token[keep]
+                self_k = self_k.index_select(2, keep)
+                self_v = self_v.index_select(2, keep)
+                static_k = static_k.index_select(2, keep)
+                static_v = static_v.index_select(2, keep)
+                memory_mask = memory_mask[keep]
+                if not replacement:
+                    predicted_mask = predicted_mask[keep]
+
+        return sampled_ids, logits
+
+    def image_encoder(self, img_inputs):
+        return self.module.encode_image(img_inputs)
+
+    def sample(self, img_inputs, greedy=True, temperature=1.0, beam=-1, true_ingrs=None, img_features=None,
+               callback=None):
+        if beam != -1:
+            raise ValueError('Beam search is not supported by the exported model, use the eager backend')
+
+        outputs = dict()
+        if img_features is None:
+            img_features = self.module.encode_image(img_inputs)
+
+        if not self.recipe_only:
+            static_k, static_v, memory_mask = self.module.ingr_prepare(img_features)
+            ingr_ids, ingr_probs = self.decode(self.module.ingr_step, static_k, static_v, memory_mask,
+                                               self.ingr_seq_length, True, temperature, False, 0, 0,
+                                               stage_callback(callback, 'ingredients'))
+
+            # mask ingredients after finding eos
+            sample_mask = mask_from_eos(ingr_ids, eos_value=0, mult_before=False)
+            ingr_ids[sample_mask == 0] = self.pad_value
+
+            outputs['ingr_ids'] = ingr_ids
+            outputs['ingr_probs'] = ingr_probs.data
+
+            input_mask = sample_mask.float().unsqueeze(1)
+            input_feats = self.module.encode_ingredients(ingr_ids)
+
+        if self.ingrs_only:
+            return outputs
+
+        # option during sampling to use the real ingredients and not the predicted ones to infer the recipe
+        if true_ingrs is not None:
+            input_mask = mask_from_eos(true_ingrs, eos_value=0, mult_before=False)
+            true_ingrs[input_mask == 0] = self.pad_value
+            input_feats = self.module.encode_ingredients(true_ingrs)
+            input_mask = input_mask.float().unsqueeze(1)
+
+        static_k, static_v, memory_mask = self.module.recipe_prepare(input_feats, input_mask, img_features)
+        ids, probs = self.decode(self.module.recipe_step, static_k, static_v, memory_mask, self.recipe_seq_length,
+                                 greedy, temperature, True, 0, 1, stage_callback(callback, 'recipe'))
+
+        outputs['recipe_probs'] = probs.data
+        outputs['recipe_ids'] = ids
+
+        return outputs
+
+
+def load_exported_model(path, device):
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    module.eval()
+    meta = json.loads(extra_files['meta.json'])
+    return ExportedModel(module, meta, device), meta
+
+
+def get_exported_model(model_path, data_dir, device, build_model, quantize=False):
+    """Exported model for the checkpoint at model_path, read from the disk cache in data_dir when it is up to
+    date, otherwise exported from the eager model returned by build_model() and written to the cache"""
+    def load(path):
+        model, meta = load_exported_model(path, device)
+        return meta.get('source'), model
+
+    def write(path, signature):
+        export_model(build_model().cpu(), path, signature)
+
+    return load_derived(get_exported_path(data_dir, quantize), model_path, load, write)
+
+
+def check(args):
+    """Compare the eager and exported models on the images in args.image_dir"""
+    from Foodimg2Ing.output import list_images, preprocess_images
+    from Foodimg2Ing.registry import registry
+
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+    eager = registry.get(args.data_dir, device='cpu', quantize=args.quantize)
+    exported = registry.get(args.data_dir, device='cpu', quantize=args.quantize, backend='torchscript')
+
+    failures = 0
+    for path in images:
+        image_tensor = preprocess_images([path], 'cpu')
+        results = {}
+        for name, loaded in (('eager', eager), ('torchscript', exported)):
+            start = time.time()
+            with torch.no_grad():
+                out = loaded.model.sample(image_tensor, greedy=True, temperature=1.0, beam=-1, true_ingrs=None)
+            results[name] = (out, time.time() - start)
+        (a, eager_time), (b, exported_time) = results['eager'], results['torchscript']
+        same = torch.equal(a['ingr_ids'], b['ingr_ids']) and torch.equal(a['recipe_ids'], b['recipe_ids'])
+        diff = (a['recipe_probs'] - b['recipe_probs']).abs().max().item()
+        failures += not same
+        print('{}: ids {}, max logit diff {:.2e}, eager {:.2f}s, torchscript {:.2f}s'.format(
+            os.path.basename(path), 'equal' if same else 'DIFFERENT', diff, eager_time, exported_time))
+    if failures:
+        raise SystemExit('{}/{} images differ'.format(failures, len(images)))
+    print('exported model matches the eager model on {} images'.format(len(images)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export the model to TorchScript')
+    parser.add_argument('--data_dir', type=str, default='./data',
+                        help='directory with the vocabularies and the checkpoint, the export is written there')
+    parser.add_argument('--quantize', action='store_true', help='export the int8 dynamically quantized model')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the exported and eager models on the images in --image_dir')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    args = parser.parse_args()
+
+    from Foodimg2Ing.registry import registry
+    registry.get(args.data_dir, device='cpu', quantize=args.quantize, backend='torchscript')
+    if args.check:
+        check(args)
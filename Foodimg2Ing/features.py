@@ -0,0 +1,151 @@
+#features.py
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from Foodimg2Ing.cache import tensor_key
+from Foodimg2Ing.filelock import file_lock
+
+FEATURES_FILENAME = 'features.f32'
+INDEX_FILENAME = 'index.json'
+LOCK_FILENAME = 'store.lock'
+
+
+class FeatureStore(object):
+    """Image features computed by EncoderCNN (embed_size x 49 each), persisted in a directory.
+
+    The features are rows of a float32 file read through np.memmap, so opening a store does not load it and
+    lookups only touch the rows they need. index.json maps the tensor_key() of a preprocessed image and of the
+    checkpoint to its row. Writers take a file lock, reload the index, append the new features at the end of the
+    file (their rows are its offset) and replace the index atomically, so several processes can share a store.
+    """
+
+    def __init__(self, path, shape=(512, 49)):
+        self.path = path
+        self.shape = tuple(shape)
+        self._lock = threading.Lock()
+        self._features = None
+
+        os.makedirs(path, exist_ok=True)
+        self._rows = self._load_index()
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path) as f:
+            index = json.load(f)
+        if tuple(index['shape']) != self.shape:
+            raise ValueError('Feature store {} holds features of shape {}, not {}'.format(
+                self.path, tuple(index['shape']), self.shape))
+        return index['rows']
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _row_bytes(self):
+        return int(np.prod(self.shape)) * 4
+
+    def _memmap(self, row):
+        if self._features is None or self._features.shape[0] <= row:
+            # rows written by other processes may follow the ones of our index
+            path = os.path.join(self.path, FEATURES_FILENAME)
+            self._features = np.memmap(path, dtype=np.float32, mode='r',
+                                       shape=(os.path.getsize(path) // self._row_bytes(),) + self.shape)
+        return self._features
+
+    def get(self, key):
+        """Features for key as a (embed_size x 49) tensor, or None"""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            return torch.from_numpy(np.array(self._memmap(row)[row]))
+
+    def put_many(self, keys, features):
+        """Store features (N x embed_size x 49) under keys, keys already in the store are skipped"""
+        features = features.detach().cpu().float().numpy()
+        with self._lock, file_lock(os.path.join(self.path, LOCK_FILENAME)):
+            # other processes may have added features since the index was read
+            self._rows = self._load_index()
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            if not new:
+                return
+            with open(os.path.join(self.path, FEATURES_FILENAME), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                first_row = f.tell() // self._row_bytes()
+                # drop a partial row left by a write that failed, whole rows not in the index are left unused
+                f.truncate(first_row * self._row_bytes())
+                f.write(np.ascontiguousarray(features[new]).tobytes())
+            for j, i in enumerate(new):
+                self._rows[keys[i]] = first_row + j
+
+            index_path = os.path.join(self.path, INDEX_FILENAME)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump({'shape': list(self.shape), 'rows': self._rows}, f)
+            os.replace(index_path + '.tmp', index_path)
+
+    def put(self, key, features):
+        self.put_many([key], features.unsqueeze(0))
+
+    def nbytes(self):
+        return len(self._rows) * self._row_bytes()
+
+
+def encode_images(loaded, image_tensor, store=None):
+    """EncoderCNN features of a preprocessed batch, read from the store when it has them. Features computed
+    here are added to the store."""
+    if store is None:
+        with torch.no_grad():
+            return loaded.model.image_encoder(image_tensor)
+
+    checkpoint = loaded.version[0] if loaded.version is not None else loaded.model_path
+    keys = [tensor_key(image_tensor[i], checkpoint) for i in range(image_tensor.size(0))]
+    features = [store.get(key) for key in keys]
+    missing = [i for i, feature in enumerate(features) if feature is None]
+    if missing:
+        with torch.no_grad():
+            computed = loaded.model.image_encoder(image_tensor[missing])
+        store.put_many([keys[i] for i in missing], computed)
+        for j, i in enumerate(missing):
+            features[i] = computed[j]
+    return torch.stack([feature.to(image_tensor.device) for feature in features])
+
+
+def populate(args):
+    """Compute and store the features of every image in args.image_dir"""
+    from Foodimg2Ing.output import list_images, preprocess_images
+    from Foodimg2Ing.registry import registry
+
+    images = list_images(args.image_dir)
+    loaded = registry.get(args.data_dir)
+    store = FeatureStore(args.store, (loaded.args.embed_size, 49))
+    before = len(store)
+
+    start = time.time()
+    for i in range(0, len(images), args.batch_size):
+        image_tensor = preprocess_images(images[i:i + args.batch_size], loaded.device)
+        encode_images(loaded, image_tensor, store)
+        print('{}/{} images'.format(min(i + args.batch_size, len(images)), len(images)))
+    elapsed = time.time() - start
+    print('added {} features in {:.1f}s, the store holds {} ({:.1f} MB)'.format(
+        len(store) - before, elapsed, len(store), store.nbytes() / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bulk-populate a feature store from a directory of images')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--store', type=str, default='./data/features',
+                        help='feature store directory')
+    parser.add_argument('--data_dir', type=str, default='./data',
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=16)
+    populate(parser.parse_args())
@@ -0,0 +1,26 @@
+#filelock.py
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where the files guarded by these locks should have a single writer
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock on path (created if missing) held by this process until the block exits. Processes
+    taking the lock on the same path run their blocks one at a time"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
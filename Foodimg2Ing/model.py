@@ -17,11 +17,10 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 def label2onehot(labels, pad_value):
 
-    # input labels to one hot vector
-    inp_ = torch.unsqueeze(labels, 2)
-    one_hot = torch.FloatTensor(labels.size(0), labels.size(1), pad_value + 1).zero_().to(device)
-    one_hot.scatter_(2, inp_, 1)
-    one_hot, _ = one_hot.max(dim=1)
+    # input labels to one hot vector, scattered straight into (batch x vocab) instead of taking the max
+    # over a (batch x length x vocab) tensor
+    one_hot = torch.zeros(labels.size(0), pad_value + 1, device=labels.device)
+    one_hot.scatter_(1, labels, 1)
     # remove pad position
     one_hot = one_hot[:, :-1]
     # eos position is always 0
@@ -31,30 +30,32 @@ def label2onehot(labels, pad_value):
 
 
 def mask_from_eos(ids, eos_value, mult_before=True):
-    mask = torch.ones(ids.size()).to(device).byte()
-    mask_aux = torch.ones(ids.size(0)).to(device).byte()
-
     # find eos in ingredient prediction
-    for idx in range(ids.size(1)):
-        # force mask to have 1s in the first position to avoid division by 0 when predictions start with eos
-        if idx == 0:
-            continue
-        if mult_before:
-            mask[:, idx] = mask[:, idx] * mask_aux
-            mask_aux = mask_aux * (ids[:, idx] != eos_value)
-        else:
-            mask_aux = mask_aux * (ids[:, idx] != eos_value)
-            mask[:, idx] = mask[:, idx] * mask_aux
-    return mask
+    is_eos = ids == eos_value
+    # force mask to have 1s in the first position to avoid division by 0 when predictions start with eos
+    is_eos[:, 0] = False
+    # number of eos up to (and including) each position
+    num_eos = is_eos.cumsum(1)
+    if mult_before:
+        # the first eos is kept in the mask
+        num_eos = num_eos - is_eos.long()
+    return (num_eos == 0).byte()
+
 
+def stage_callback(callback, stage):
+    # step callback of a decoder, reporting the decoding stage to callback
+    if callback is None:
+        return None
+    return lambda step, rows, ids: callback(stage, step, rows, ids)
 
-def get_model(args, ingr_vocab_size, instrs_vocab_size):
+
+def get_model(args, ingr_vocab_size, instrs_vocab_size, pretrained=True):
 
     # build ingredients embedding
     encoder_ingrs = EncoderLabels(args.embed_size, ingr_vocab_size,
-                                  args.dropout_encoder, scale_grad=False).to(device)
+                                  args.dropout_encoder, scale_grad=False)
     # build image model
-    encoder_image = EncoderCNN(args.embed_size, args.dropout_encoder, args.image_model)
+    encoder_image = EncoderCNN(args.embed_size, args.dropout_encoder, args.image_model, pretrained=pretrained)
 
     decoder = DecoderTransformer(args.embed_size, instrs_vocab_size,
                                  dropout=args.dropout_decoder_r, seq_length=args.maxseqlen,
@@ -134,9 +135,11 @@ class InverseCookingModel(nn.Module):
 
             # decode ingredients with transformer
             # autoregressive mode for ingredient decoder
+            # the loss pools logits up to the ground truth eos, so every step is decoded for every sample
             ingr_ids, ingr_logits = self.ingredient_decoder.sample(None, None, greedy=True,
                                                                    temperature=1.0, img_features=img_features,
-                                                                   first_token_value=0, replacement=False)
+                                                                   first_token_value=0, replacement=False,
+                                                                   early_exit=False)
 
             ingr_logits = torch.nn.functional.softmax(ingr_logits, dim=-1)
 
@@ -197,17 +200,24 @@ class InverseCookingModel(nn.Module):
 
         return losses
 
-    def sample(self, img_inputs, greedy=True, temperature=1.0, beam=-1, true_ingrs=None):
+    def sample(self, img_inputs, greedy=True, temperature=1.0, beam=-1, true_ingrs=None, img_features=None,
+               callback=None):
+        """With callback, callback(stage, step, rows, ids) is called after every decoding step of the ingredient
+        ('ingredients') and recipe ('recipe') decoders with the ids sampled for the rows still being decoded"""
 
         outputs = dict()
 
-        img_features = self.image_encoder(img_inputs)
+        # precomputed features (e.g. from a feature store) skip the cnn
+        if img_features is None:
+            img_features = self.image_encoder(img_inputs)
 
         if not self.recipe_only:
             ingr_ids, ingr_probs = self.ingredient_decoder.sample(None, None, greedy=True, temperature=temperature,
                                                                   beam=-1,
                                                                   img_features=img_features, first_token_value=0,
-                                                                  replacement=False)
+                                                                  replacement=False,
+                                                                  step_callback=stage_callback(callback,
+                                                                                               'ingredients'))
 
             # mask ingredients after finding eos
             sample_mask = mask_from_eos(ingr_ids, eos_value=0, mult_before=False)
@@ -231,9 +241,16 @@ class InverseCookingModel(nn.Module):
             input_mask = input_mask.unsqueeze(1)
 
         ids, probs = self.recipe_decoder.sample(input_feats, input_mask, greedy, temperature, beam, img_features, 0,
-                                                last_token_value=1)
+                                                last_token_value=1,
+                                                step_callback=stage_callback(callback, 'recipe'))
 
         outputs['recipe_probs'] = probs.data
         outputs['recipe_ids'] = ids
 
         return outputs
+
+    def fuse(self):
+        """Replace the layers of both decoders by inference-only fused layers (see FusedDecoderLayer), in place"""
+        self.ingredient_decoder.fuse()
+        self.recipe_decoder.fuse()
+        return self
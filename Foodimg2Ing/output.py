@@ -1,114 +1,227 @@
 # import the necessary libraries
 #output.py
-from huggingface_hub import hf_hub_download
-import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 import numpy as np
+import glob
+import io
 import os
-from Foodimg2Ing.args import get_parser
-import pickle
-from Foodimg2Ing.model import get_model
+import queue
+import threading
+from Foodimg2Ing.cache import PredictionCache, tensor_key
+from Foodimg2Ing.features import FeatureStore, encode_images
+from Foodimg2Ing.registry import DATA_DIR, registry
 from torchvision import transforms
-from utils.output_utils import prepare_output
+from utils.output_utils import prepare_output_batch
 from PIL import Image
 import time
-from tensorflow.keras.preprocessing import image
 from Foodimg2Ing import app
 from Foodimg2Ing import routes
 
-def get_model_path(data_dir):
-    """Helper function to get model path with proper error handling"""
-    try:
-        # First try to download from Hugging Face
-        model_path = hf_hub_download(
-            repo_id="dark-side/ai-recipe-generator-model",
-            filename="modelbest.ckpt",
-            cache_dir=data_dir
-        )
-        print(f"Successfully downloaded model from Hugging Face to {model_path}")
-        return model_path
-    except Exception as e:
-        print(f"Error downloading model from Hugging Face: {e}")
-        
-        # Fallback to local path
-        local_path = os.path.join(data_dir, 'modelbest.ckpt')
-        if os.path.exists(local_path):
-            print(f"Using locally cached model at {local_path}")
-            return local_path
-        else:
-            raise RuntimeError("Model not found either on Hugging Face or locally")
-
-def output(uploadedfile):
-    """Process the image and return recipe information"""
-    # Keep all the codes and pre-trained weights in data directory
-    data_dir = './data'
-    os.makedirs(data_dir, exist_ok=True)  # Ensure data directory exists
+# predictions of images seen before (greedy and beam search only, sampling is not deterministic)
+prediction_cache = PredictionCache(max_entries=app.config.get('PREDICTION_CACHE_ENTRIES', 1024),
+                                   path=app.config.get('PREDICTION_CACHE_PATH'),
+                                   max_bytes=app.config.get('PREDICTION_CACHE_MAX_BYTES', 256 * 2 ** 20))
+
+# cnn features of the demo / catalogue images, filled with `python -m Foodimg2Ing.features`
+feature_store = None
+if app.config.get('FEATURE_STORE_PATH'):
+    feature_store = FeatureStore(app.config['FEATURE_STORE_PATH'])
+
+# images are resized so their shorter side is IMAGE_SIZE, then center cropped to CROP_SIZE
+IMAGE_SIZE = 256
+CROP_SIZE = 224
+
+# built once, shared by every request
+transform = transforms.Compose([
+    transforms.Resize(IMAGE_SIZE),
+    transforms.CenterCrop(CROP_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+])
+
+
+def load_image(source, draft=True):
+    """Open an image as RGB from a path, a file object or the encoded bytes, PIL images are passed through.
+
+    With draft, JPEGs are decoded directly at a reduced scale (1/2, 1/4 or 1/8) when that still leaves their
+    shorter side at least IMAGE_SIZE pixels, which is much cheaper than decoding the full image to resize it.
+    """
+    if isinstance(source, Image.Image):
+        return source.convert('RGB')
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        if draft:
+            img.draft('RGB', (IMAGE_SIZE, IMAGE_SIZE))
+        return img.convert('RGB')
+
+
+def list_images(image_dir):
+    """Paths of the jpg, jpeg and png images in image_dir, sorted"""
+    paths = []
+    for ext in ('jpg', 'jpeg', 'png'):
+        paths.extend(glob.glob(os.path.join(image_dir, '*.' + ext)))
+    return sorted(paths)
+
+
+def preprocess_images(images, device, draft=True):
+    """Resize, crop and normalize a list of images (anything load_image accepts) into a single
+    (N, 3, 224, 224) batch"""
+    image_tensor = torch.stack([transform(load_image(img, draft)) for img in images])
+    return image_tensor.to(device)
+
+
+def predict_batch(images, greedy=True, temperature=1.0, beam=-1, data_dir=DATA_DIR, quantize=False,
+                  backend='eager', cache=prediction_cache, features=feature_store, draft=True):
+    """Generate recipes for several images with one pass of the encoder and the two decoders.
+
+    Returns a list with the (outs, valid) pair from prepare_output for every image, in input order.
+    With quantize, the int8 dynamically quantized model is used (cpu only). backend is 'eager', 'torchscript'
+    (the graph exported by Foodimg2Ing.export, cpu only, no beam search) or 'fused' (eager with fused decoder layers,
+    float only). Deterministic predictions are looked up in / added to `cache` (None disables it), only the
+    images not found there go through the model.
+    Their cnn features are read from / added to the `features` store when one is given. draft is passed to
+    load_image, draft=False decodes JPEGs at full size.
+    """
+    if len(images) == 0:
+        return []
+
+    loaded = registry.get(data_dir, quantize=quantize, backend=backend)
+    image_tensor = preprocess_images(images, loaded.device, draft)
+
+    results = [None] * len(images)
+    keys = None
+    if cache is not None and (greedy or beam != -1):
+        keys = [tensor_key(image_tensor[i], loaded.version, (greedy, beam, draft)) for i in range(len(images))]
+        results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
 
-    # code will run in gpu if available and if the flag is set to True, else it will run on cpu
-    use_gpu = True
-    device = torch.device('cuda' if torch.cuda.is_available() and use_gpu else 'cpu')
-    map_loc = None if torch.cuda.is_available() and use_gpu else 'cpu'
+    img_features = None
+    if features is not None:
+        img_features = encode_images(loaded, image_tensor[missing], features)
 
+    with torch.no_grad():
+        outputs = loaded.model.sample(image_tensor[missing], greedy=greedy,
+                                      temperature=temperature, beam=beam, true_ingrs=None,
+                                      img_features=img_features)
+
+    predictions = prepare_output_batch(outputs['recipe_ids'].cpu().numpy(), outputs['ingr_ids'].cpu().numpy(),
+                                       loaded.ingrs_vocab, loaded.vocab)
+    for j, i in enumerate(missing):
+        results[i] = predictions[j]
+        if keys is not None:
+            cache.put(keys[i], results[i])
+    return results
+
+
+class StreamCancelled(Exception):
+    """Raised in the decoding callback of stream_prediction once its consumer went away"""
+
+
+def stream_prediction(image, greedy=True, temperature=1.0, data_dir=DATA_DIR, quantize=False, backend='eager',
+                      cache=prediction_cache, features=feature_store, draft=True):
+    """Generate the recipe for one image, yielding events as the decoders produce them.
+
+    Events are dicts with a 'type' and the seconds since the call ('time'): an 'ingredient' event per predicted
+    ingredient and a 'token' event per word of the recipe ('<eoi>' ends an instruction), both with the word in
+    'text', then 'done' with the title, ingredients and recipe of format_prediction and 'valid' (or 'error'
+    with a 'message'). The first ingredient arrives after the cnn and one step of the ingredient decoder.
+    The model runs in a background thread, which stops decoding when the generator is closed. draft is passed to
+    load_image as in predict_batch.
+    """
+    start = time.time()
+    loaded = registry.get(data_dir, quantize=quantize, backend=backend)
+    image_tensor = preprocess_images([image], loaded.device, draft)
+
+    def done(outs, valid):
+        title, ingredients, recipe = format_prediction(outs, valid)
+        return {'type': 'done', 'title': title, 'ingredients': ingredients, 'recipe': recipe, 'valid': valid,
+                'time': time.time() - start}
+
+    key = None
+    if cache is not None and greedy:
+        key = tensor_key(image_tensor[0], loaded.version, (greedy, -1, draft))
+        cached = cache.get(key)
+        if cached is not None:
+            yield done(*cached)
+            return
+
+    events = queue.Queue()
+    stop = threading.Event()
+    ingredients_done = [False]
+
+    def callback(stage, step, rows, ids):
+        if stop.is_set():
+            raise StreamCancelled()
+        # a single image, ids holds one id as long as it is being decoded
+        idx = ids[0].item()
+        if stage == 'ingredients':
+            word = loaded.ingrs_vocab[idx]
+            if idx == 0 or word == '<pad>':
+                ingredients_done[0] = True
+            if not ingredients_done[0]:
+                events.put(('event', {'type': 'ingredient', 'text': word, 'time': time.time() - start}))
+        elif idx != 1:
+            events.put(('event', {'type': 'token', 'text': loaded.vocab[idx], 'time': time.time() - start}))
+
+    def run():
+        try:
+            img_features = None
+            if features is not None:
+                img_features = encode_images(loaded, image_tensor, features)
+            with torch.no_grad():
+                outputs = loaded.model.sample(image_tensor, greedy=greedy, temperature=temperature, beam=-1,
+                                              true_ingrs=None, img_features=img_features, callback=callback)
+            events.put(('outputs', outputs))
+        except StreamCancelled:
+            pass
+        except Exception as e:
+            events.put(('error', e))
+
+    threading.Thread(target=run, name='stream-prediction', daemon=True).start()
     try:
-        # Load vocabulary files
-        ingrs_vocab = pickle.load(open(os.path.join(data_dir, 'ingr_vocab.pkl'), 'rb'))
-        vocab = pickle.load(open(os.path.join(data_dir, 'instr_vocab.pkl'), 'rb'))
-
-        ingr_vocab_size = len(ingrs_vocab)
-        instrs_vocab_size = len(vocab)
-        output_dim = instrs_vocab_size
-
-        # Initialize model
-        import sys; sys.argv=['']; del sys
-        args = get_parser()
-        args.maxseqlen = 15
-        args.ingrs_only = False
-        model = get_model(args, ingr_vocab_size, instrs_vocab_size)
-   
-        # Load model
-        model_path = get_model_path(data_dir)
-        model.load_state_dict(torch.load(model_path, map_location=map_loc))
-        model.to(device)
-        model.eval()
-        model.ingrs_only = False
-        model.recipe_only = False
-
-        # Prepare image transformations
-        transf_list_batch = []
-        transf_list_batch.append(transforms.ToTensor())
-        transf_list_batch.append(transforms.Normalize((0.485, 0.456, 0.406), 
-                                                    (0.229, 0.224, 0.225)))
-        to_input_transf = transforms.Compose(transf_list_batch)
-
-        # Load and transform image
-        img = image.load_img(uploadedfile)
-        transf_list = []
-        transf_list.append(transforms.Resize(256))
-        transf_list.append(transforms.CenterCrop(224))
-        transform = transforms.Compose(transf_list)
-        
-        image_transf = transform(img)
-        image_tensor = to_input_transf(image_transf).unsqueeze(0).to(device)
+        while True:
+            kind, value = events.get()
+            if kind == 'event':
+                yield value
+            elif kind == 'error':
+                print(f"Error in streamed prediction: {str(value)}")
+                yield {'type': 'error', 'message': str(value), 'time': time.time() - start}
+                return
+            else:
+                outs, valid = prepare_output_batch(value['recipe_ids'].cpu().numpy(),
+                                                   value['ingr_ids'].cpu().numpy(),
+                                                   loaded.ingrs_vocab, loaded.vocab)[0]
+                if key is not None:
+                    cache.put(key, (outs, valid))
+                yield done(outs, valid)
+                return
+    finally:
+        stop.set()
+
 
+def format_prediction(outs, valid):
+    """Title, ingredients and recipe to show for a prediction"""
+    if valid['is_valid']:
+        return outs['title'], outs['ingrs'], outs['recipe']
+    else:
+        return "Not a valid recipe!", [], ["Reason: " + valid['reason']]
+
+
+def output(uploadedfile, quantize=False, backend='eager', draft=True):
+    """Process the image and return recipe information"""
+    try:
         # Generate recipe
         greedy = [True, False][0]  # Use only first option
         beam = [-1, -1][0]  # Use only first option
         temperature = 1.0
 
-        with torch.no_grad():
-            outputs = model.sample(image_tensor, greedy=greedy, 
-                                temperature=temperature, beam=beam, true_ingrs=None)
-                
-        ingr_ids = outputs['ingr_ids'].cpu().numpy()
-        recipe_ids = outputs['recipe_ids'].cpu().numpy()
-                
-        outs, valid = prepare_output(recipe_ids[0], ingr_ids[0], ingrs_vocab, vocab)
-            
-        if valid['is_valid']:
-            return outs['title'], outs['ingrs'], outs['recipe']
-        else:
-            return "Not a valid recipe!", [], ["Reason: " + valid['reason']]
+        outs, valid = predict_batch([uploadedfile], greedy=greedy, temperature=temperature, beam=beam,
+                                    quantize=quantize, backend=backend, draft=draft)[0]
+        return format_prediction(outs, valid)
 
     except Exception as e:
         print(f"Error in output function: {str(e)}")
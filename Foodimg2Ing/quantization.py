@@ -0,0 +1,60 @@
+#quantization.py
+import os
+
+import torch
+import torch.nn as nn
+
+from Foodimg2Ing.checkpoint import load_derived
+from Foodimg2Ing.model import get_model
+from modules.multihead_attention import MultiheadAttention
+
+QUANTIZED_FILENAME = 'modelbest.int8.ckpt'
+
+
+def quantize_model(model):
+    """int8 dynamic quantization of every nn.Linear of the model, in place.
+
+    The attention input projections are split into q/k/v nn.Linear layers first so they get quantized too.
+    This covers the linear layers of the two transformer decoders; the cnn and the ingredient embeddings
+    stay in float. Dynamically quantized layers only run on cpu.
+    """
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention):
+            module.split_in_proj()
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def get_quantized_path(data_dir):
+    return os.path.join(data_dir, QUANTIZED_FILENAME)
+
+
+def quantize_checkpoint(args, ingr_vocab_size, instrs_vocab_size, model_path):
+    """Quantized model built from the float weights of the checkpoint at model_path"""
+    model = get_model(args, ingr_vocab_size, instrs_vocab_size, pretrained=False)
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return quantize_model(model)
+
+
+def load_quantized_model(args, ingr_vocab_size, instrs_vocab_size, model_path, data_dir):
+    """Quantized model for the checkpoint at model_path, read from the disk cache in data_dir when it is
+    up to date, otherwise quantized from the float weights and written to the cache"""
+    quantized_path = get_quantized_path(data_dir)
+
+    def load(path):
+        # packed int8 weights are not plain tensors, weights_only loading does not support them
+        cached = torch.load(path, map_location='cpu', weights_only=False)
+        return cached.get('source'), cached['state_dict']
+
+    def write(path, signature):
+        model = quantize_checkpoint(args, ingr_vocab_size, instrs_vocab_size, model_path)
+        torch.save({'source': signature, 'state_dict': model.state_dict()}, path)
+
+    try:
+        state_dict = load_derived(quantized_path, model_path, load, write)
+    except OSError as e:
+        print(f"Could not cache the quantized model to {quantized_path}: {e}")
+        return quantize_checkpoint(args, ingr_vocab_size, instrs_vocab_size, model_path)
+    model = quantize_model(get_model(args, ingr_vocab_size, instrs_vocab_size, pretrained=False))
+    model.load_state_dict(state_dict)
+    return model
@@ -0,0 +1,206 @@
+#registry.py
+import gc
+import sys
+import threading
+import time
+
+import torch
+
+from Foodimg2Ing.args import get_parser
+from Foodimg2Ing.export import get_exported_model
+from Foodimg2Ing.checkpoint import checkpoint_signature
+from Foodimg2Ing.model import get_model
+from Foodimg2Ing.quantization import load_quantized_model
+from Foodimg2Ing.weights import load_mapped_model, load_vocab
+from utils.artifacts import resolve
+
+# Keep all the codes and pre-trained weights in data directory
+DATA_DIR = './data'
+
+# args used by the demo checkpoint, on top of the parser defaults
+DEFAULT_OVERRIDES = {'maxseqlen': 15, 'ingrs_only': False, 'quantize': False, 'backend': 'eager'}
+
+
+def get_model_path(data_dir, refresh=False):
+    """Local path of the checkpoint, from the artifact manifest in data_dir. The hub is only contacted with
+    refresh, or when there is no local copy at all"""
+    return resolve('inverse-cooking', data_dir, refresh=refresh)
+
+
+def get_default_device(use_gpu=True):
+    """code will run in gpu if available and if the flag is set to True, else it will run on cpu"""
+    return torch.device('cuda' if torch.cuda.is_available() and use_gpu else 'cpu')
+
+
+def build_args(overrides):
+    """Parser defaults with `overrides` applied, ignoring the host process' command line"""
+    argv = sys.argv
+    sys.argv = ['']
+    try:
+        args = get_parser()
+    finally:
+        sys.argv = argv
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
+
+
+def load_vocabs(data_dir):
+    """Load the ingredient and instruction vocabularies"""
+    return load_vocab(data_dir, 'ingr_vocab'), load_vocab(data_dir, 'instr_vocab')
+
+
+class LoadedModel(object):
+    """An inverse-cooking model in eval mode together with the vocabularies it was trained with."""
+
+    def __init__(self, model, ingrs_vocab, vocab, args, device, model_path, load_time, version=None):
+        self.model = model
+        self.ingrs_vocab = ingrs_vocab
+        self.vocab = vocab
+        self.args = args
+        self.device = device
+        self.model_path = model_path
+        self.load_time = load_time
+        # identifies the weights and options, predictions of two models with the same version are the same
+        self.version = version
+
+    def memory_usage(self):
+        """Bytes held by the model parameters, buffers and packed int8 weights of quantized layers"""
+        params = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        buffers = sum(b.numel() * b.element_size() for b in self.model.buffers())
+        packed = 0
+        for module in self.model.modules():
+            # int8 weights of quantized linear layers, eager or exported to TorchScript
+            packed_params = getattr(module, '_packed_params', None)
+            if isinstance(packed_params, torch.ScriptObject):
+                weight, bias = torch.ops.quantized.linear_unpack(packed_params)
+                packed += weight.numel() * weight.element_size()
+                if bias is not None:
+                    packed += bias.numel() * bias.element_size()
+        return {'parameters': params, 'buffers': buffers, 'packed': packed, 'total': params + buffers + packed}
+
+
+class ModelRegistry(object):
+    """Process-wide cache of loaded models.
+
+    Models are keyed by checkpoint path, device and the args overrides used to build them, and are loaded
+    at most once per key no matter how many threads ask for them concurrently.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._models = {}
+        self._model_paths = {}
+
+    def _model_path(self, data_dir):
+        if data_dir not in self._model_paths:
+            self._model_paths[data_dir] = get_model_path(data_dir)
+        return self._model_paths[data_dir]
+
+    def _key(self, data_dir, device, overrides):
+        return (self._model_path(data_dir), str(device), tuple(sorted(overrides.items())))
+
+    def _options(self, data_dir, device, overrides):
+        options = dict(DEFAULT_OVERRIDES)
+        options.update(overrides)
+        if device is None:
+            # quantized models and the exported graph, traced on cpu, only run on cpu
+            device = 'cpu' if options['quantize'] or options['backend'] == 'torchscript' else get_default_device()
+        return data_dir, torch.device(device), options
+
+    def _load(self, data_dir, device, overrides, model_path):
+        start = time.time()
+        ingrs_vocab, vocab = load_vocabs(data_dir)
+
+        args = build_args(overrides)
+        if args.quantize and device.type != 'cpu':
+            raise ValueError('Quantized models only run on cpu, got device {}'.format(device))
+        if args.backend == 'torchscript' and device.type != 'cpu':
+            raise ValueError('The exported model only runs on cpu, got device {}'.format(device))
+        if args.quantize and args.backend == 'fused':
+            raise ValueError('The fused backend only runs float models')
+
+        def build_model():
+            if args.quantize:
+                return load_quantized_model(args, len(ingrs_vocab), len(vocab), model_path, data_dir)
+            # the checkpoint holds the cnn weights as well, no need to fetch the imagenet ones, and they are
+            # memory-mapped, shared by the processes serving the same data_dir
+            return load_mapped_model(lambda: get_model(args, len(ingrs_vocab), len(vocab), pretrained=False),
+                                     model_path, data_dir)
+
+        if args.backend == 'torchscript':
+            model = get_exported_model(model_path, data_dir, device, build_model, args.quantize)
+        else:
+            model = build_model()
+            model.to(device)
+            model.eval()
+            if args.backend == 'fused':
+                model.fuse()
+        model.ingrs_only = args.ingrs_only
+        model.recipe_only = False
+
+        load_time = time.time() - start
+        print(f"Loaded model from {model_path} on {device} in {load_time:.2f}s")
+        version = (checkpoint_signature(model_path), tuple(sorted(overrides.items())))
+        return LoadedModel(model, ingrs_vocab, vocab, args, device, model_path, load_time, version)
+
+    def get(self, data_dir=DATA_DIR, device=None, **overrides):
+        """Return the model for the given options, loading it on first use"""
+        data_dir, device, overrides = self._options(data_dir, device, overrides)
+        with self._lock:
+            key = self._key(data_dir, device, overrides)
+            if key not in self._models:
+                self._models[key] = self._load(data_dir, device, overrides, key[0])
+            return self._models[key]
+
+    def warmup(self, data_dir=DATA_DIR, device=None, **overrides):
+        """Load the model and run a dummy prediction so the first real request does not pay for it"""
+        loaded = self.get(data_dir, device, **overrides)
+        image_tensor = torch.zeros(1, 3, 224, 224, device=loaded.device)
+        with torch.no_grad():
+            loaded.model.sample(image_tensor, greedy=True, temperature=1.0, beam=-1, true_ingrs=None)
+        return loaded
+
+    def reload(self, data_dir=DATA_DIR, device=None, **overrides):
+        """Resolve the checkpoint again and replace the cached model with a freshly loaded one"""
+        with self._lock:
+            self.unload(data_dir, device, **overrides)
+            self._model_paths.pop(data_dir, None)
+            return self.get(data_dir, device, **overrides)
+
+    def unload(self, data_dir=DATA_DIR, device=None, **overrides):
+        """Drop the cached model, returns whether there was one"""
+        data_dir, device, overrides = self._options(data_dir, device, overrides)
+        with self._lock:
+            if data_dir not in self._model_paths:
+                return False
+            loaded = self._models.pop(self._key(data_dir, device, overrides), None)
+        if loaded is None:
+            return False
+        del loaded
+        self._release_memory()
+        return True
+
+    def unload_all(self):
+        with self._lock:
+            self._models.clear()
+        self._release_memory()
+
+    def _release_memory(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def memory_usage(self):
+        """Per model and total bytes held by the loaded models"""
+        with self._lock:
+            models = list(self._models.items())
+        usage = {'models': {}, 'total': 0}
+        for (model_path, device, overrides), loaded in models:
+            name = '{} [{}] {}'.format(model_path, device, dict(overrides))
+            usage['models'][name] = loaded.memory_usage()
+            usage['total'] += usage['models'][name]['total']
+        return usage
+
+
+registry = ModelRegistry()
@@ -1,10 +1,40 @@
 #routes.py
-from flask import render_template ,url_for,flash,redirect,request,session
+from flask import render_template ,url_for,flash,redirect,request,session,jsonify,Response,stream_with_context
 from werkzeug.security import check_password_hash
 from Foodimg2Ing import app
-from Foodimg2Ing.output import output
+from Foodimg2Ing.batching import MicroBatcher
+from Foodimg2Ing.output import format_prediction, predict_batch, prediction_cache, stream_prediction
+import base64
+import functools
+import json
 import os
 
+# concurrent uploads are grouped into a single batched model call
+batcher = MicroBatcher(functools.partial(predict_batch, quantize=app.config.get('PREDICT_QUANTIZE', False),
+                                         backend=app.config.get('PREDICT_BACKEND', 'eager')),
+                       max_batch_size=app.config.get('PREDICT_MAX_BATCH_SIZE', 8),
+                       max_wait_ms=app.config.get('PREDICT_MAX_WAIT_MS', 20))
+
+
+def batched_output(image_path):
+    """Same as output(), going through the request-coalescing batcher"""
+    try:
+        outs, valid = batcher.predict(image_path)
+        return format_prediction(outs, valid)
+    except Exception as e:
+        print(f"Error in batched prediction: {str(e)}")
+        return None, None, None
+
+
+def stream_response(image):
+    """Server-sent events of stream_prediction for an image, one `event: <type>` per ingredient, recipe word
+    and the final prediction"""
+    events = stream_prediction(image, quantize=app.config.get('PREDICT_QUANTIZE', False),
+                               backend=app.config.get('PREDICT_BACKEND', 'eager'))
+    body = ('event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event)) for event in events)
+    return Response(stream_with_context(body), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 @app.route('/home',methods=['GET'])
 def home():
@@ -14,18 +44,40 @@ def home():
 def about():
     return render_template('about.html')
 
+@app.route('/metrics/batching',methods=['GET'])
+def batching_metrics():
+    return jsonify(batcher.stats())
+
+@app.route('/metrics/cache',methods=['GET'])
+def cache_metrics():
+    return jsonify(prediction_cache.stats())
+
 @app.route('/predict',methods=['POST','GET'])
 def predict():
     imagefile=request.files['imagefile']
-    image_path=os.path.join(app.root_path,'static/images/',imagefile.filename)
-    imagefile.save(image_path)
-    img="/images/"+imagefile.filename
-    title,ingredients,recipe = output(image_path)
+    # decoded from memory, the upload only goes to disk when KEEP_UPLOADS is set
+    image_bytes=imagefile.read()
+    if app.config.get('KEEP_UPLOADS', False):
+        image_path=os.path.join(app.root_path,'static/images/',imagefile.filename)
+        with open(image_path,'wb') as f:
+            f.write(image_bytes)
+        img="/images/"+imagefile.filename
+    else:
+        img="data:{};base64,{}".format(imagefile.mimetype or 'image/jpeg',base64.b64encode(image_bytes).decode())
+    title,ingredients,recipe = batched_output(image_bytes)
     return render_template('predict.html',title=title,ingredients=ingredients,recipe=recipe,img=img)
 
+@app.route('/predict/stream',methods=['POST'])
+def predict_stream():
+    return stream_response(request.files['imagefile'].read())
+
+@app.route('/stream/<samplefoodname>')
+def predictsample_stream(samplefoodname):
+    return stream_response(os.path.join(app.root_path,'static/images',str(samplefoodname)+".jpg"))
+
 @app.route('/<samplefoodname>')
 def predictsample(samplefoodname):
     imagefile=os.path.join(app.root_path,'static/images',str(samplefoodname)+".jpg")
     img="/images/demo_imgs/"+str(samplefoodname)+".jpg"
-    title,ingredients,recipe = output(imagefile)
+    title,ingredients,recipe = batched_output(imagefile)
     return render_template('predict.html',title=title,ingredients=ingredients,recipe=recipe,img=img)
@@ -0,0 +1,107 @@
+#weights.py
+import argparse
+import json
+import os
+import pickle
+import time
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from Foodimg2Ing.checkpoint import checkpoint_signature, load_derived, write_file
+
+SAFETENSORS_FILENAME = 'modelbest.safetensors'
+VOCAB_NAMES = ['ingr_vocab', 'instr_vocab']
+
+
+def get_safetensors_path(data_dir):
+    return os.path.join(data_dir, SAFETENSORS_FILENAME)
+
+
+def convert_checkpoint(model_path, path, signature=None):
+    """Write the state dict of the pickled checkpoint at model_path to path as safetensors, with the signature
+    of the checkpoint in the metadata"""
+    state_dict = torch.load(model_path, map_location='cpu')
+    metadata = {'source': json.dumps(signature or checkpoint_signature(model_path))}
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, path, metadata)
+
+
+def safetensors_source(path):
+    """Signature of the checkpoint a safetensors file was converted from"""
+    with safe_open(path, framework='pt') as f:
+        metadata = f.metadata() or {}
+    return json.loads(metadata.get('source', 'null'))
+
+
+def load_state_dict(model_path, data_dir):
+    """State dict of the checkpoint at model_path, memory-mapped from its safetensors conversion in data_dir.
+
+    The tensors are views of a copy-on-write mapping of the file, so processes loading the same file share its
+    pages in the page cache instead of each holding a private copy, as long as the weights are not modified.
+    Load them with model.load_state_dict(state_dict, assign=True) to keep them mapped. The conversion is done
+    (or redone when the checkpoint changed) first, by one worker at a time, falling back to the pickled
+    checkpoint when data_dir is not writable.
+    """
+    path = get_safetensors_path(data_dir)
+    try:
+        return load_derived(path, model_path, lambda p: (safetensors_source(p), load_file(p)),
+                            lambda p, signature: convert_checkpoint(model_path, p, signature))
+    except OSError as e:
+        print(f"Could not convert the checkpoint to {path}: {e}")
+        return torch.load(model_path, map_location='cpu')
+
+
+def load_mapped_model(build_model, model_path, data_dir):
+    """Model returned by build_model() with the memory-mapped weights of load_state_dict. It is built on the meta
+    device, so the random initial weights are never allocated"""
+    with torch.device('meta'):
+        model = build_model()
+    model.load_state_dict(load_state_dict(model_path, data_dir), assign=True)
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise RuntimeError('No weights for {} in {}'.format(', '.join(missing), model_path))
+    return model
+
+
+def convert_vocab(data_dir, name):
+    """Write the vocabulary pickle `name`.pkl as a json list of words (index = id)"""
+    with open(os.path.join(data_dir, name + '.pkl'), 'rb') as f:
+        vocab = pickle.load(f)
+    words = [vocab[i] for i in range(len(vocab))]
+    with open(os.path.join(data_dir, name + '.json.tmp'), 'w') as f:
+        json.dump(words, f)
+    os.replace(os.path.join(data_dir, name + '.json.tmp'), os.path.join(data_dir, name + '.json'))
+
+
+def load_vocab(data_dir, name):
+    """Vocabulary `name` as a list of words, from its json conversion when there is one, otherwise from the
+    pickle"""
+    json_path = os.path.join(data_dir, name + '.json')
+    if os.path.exists(json_path):
+        with open(json_path) as f:
+            return json.load(f)
+    with open(os.path.join(data_dir, name + '.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert the checkpoint to safetensors and the vocabularies to json')
+    parser.add_argument('--data_dir', type=str, default='./data',
+                        help='directory with the vocabularies and the checkpoint, the conversions are written there')
+    args = parser.parse_args()
+
+    from Foodimg2Ing.registry import get_model_path
+    model_path = get_model_path(args.data_dir)
+    path = get_safetensors_path(args.data_dir)
+    start = time.time()
+    write_file(path, lambda tmp_path: convert_checkpoint(model_path, tmp_path))
+    print('{} ({:.1f} MB) -> {} ({:.1f} MB) in {:.2f}s'.format(
+        model_path, os.path.getsize(model_path) / 2 ** 20, path, os.path.getsize(path) / 2 ** 20,
+        time.time() - start))
+    for name in VOCAB_NAMES:
+        convert_vocab(args.data_dir, name)
+        print('{0}.pkl ({1:.1f} KB) -> {0}.json ({2:.1f} KB)'.format(
+            os.path.join(args.data_dir, name), os.path.getsize(os.path.join(args.data_dir, name + '.pkl')) / 1024,
+            os.path.getsize(os.path.join(args.data_dir, name + '.json')) / 1024))
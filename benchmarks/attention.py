@@ -0,0 +1,146 @@
+"""Parity and per-layer latency of the fused MultiheadAttention path (need_weights=False, computed by
+F.scaled_dot_product_attention) against the explicit bmm/softmax path (need_weights=True).
+
+Parity is checked on the attention calls of the recipe decoder (causal self-attention over a whole sequence,
+attention over the image and ingredient features with a padding mask, and their incremental single-step
+versions) and on the recipes sampled by a decoder with every attention forced on either path. Latency is per
+attention call of a single decoding step, with the self-attention cache filled up to each of `lengths`.
+
+    python -m benchmarks.attention --batch_sizes 1 8 --lengths 1 50 150
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import modules.utils as utils
+from modules.multihead_attention import MultiheadAttention
+from modules.transformer_decoder import DecoderTransformer
+from tests.reference import attention_weights, compare, memory_inputs, memory_state, self_state
+
+
+def layer_parity(embed_size, num_heads, batch_size, length):
+    attn = MultiheadAttention(embed_size, num_heads)
+    attn.eval()
+    x = torch.randn(length, batch_size, embed_size)
+    memory, memory_mask = memory_inputs(batch_size, embed_size)
+
+    diffs = {
+        'self, causal': compare(attn, lambda: dict(query=x, key=x, value=x, mask_future_timesteps=True)),
+        'memory, padding': compare(attn, lambda: dict(query=x, key=memory, value=memory,
+                                                      key_padding_mask=memory_mask)),
+    }
+    # the cache is rebuilt for every call, the fused and the reference step see the same state
+    last = x[-1:]
+    diffs['self, step'] = compare(attn, lambda: dict(
+        query=last, key=last, value=last, mask_future_timesteps=True,
+        incremental_state=self_state(attn, x, length - 1)))
+    diffs['memory, step'] = compare(attn, lambda: dict(
+        query=last, key=memory, value=memory, key_padding_mask=memory_mask, static_kv=True,
+        incremental_state=memory_state(attn, memory)))
+    return diffs
+
+
+def sample(decoder, ingr_features, ingr_mask, img_features, steps):
+    with torch.no_grad():
+        ids, _ = decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features,
+                                first_token_value=0, last_token_value=1,
+                                incremental_state=utils.IncrementalState(steps))
+    return ids
+
+
+def decoder_parity(args, batch_size):
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=args.num_heads, num_layers=args.num_layers)
+    decoder.eval()
+    img_features = torch.randn(batch_size, args.embed_size, 49)
+    ingr_features = torch.randn(batch_size, args.embed_size, 20)
+    ingr_mask = torch.ones(batch_size, 1, 20)
+    ingr_mask[:, :, 10:] = 0
+
+    fused = sample(decoder, ingr_features, ingr_mask, img_features, args.steps)
+    with attention_weights(decoder):
+        reference = sample(decoder, ingr_features, ingr_mask, img_features, args.steps)
+    return torch.equal(fused, reference)
+
+
+def timeit(fn, repeat):
+    times = []
+    with torch.no_grad():
+        fn()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def step_latency(embed_size, num_heads, batch_size, length, repeat):
+    """ms per single-step call of the self-attention (cache of `length` steps) and the memory attention, for
+    the reference and the fused path"""
+    attn = MultiheadAttention(embed_size, num_heads)
+    attn.eval()
+    x = torch.randn(length, batch_size, embed_size)
+    memory, memory_mask = memory_inputs(batch_size, embed_size)
+    state = self_state(attn, x, length - 1)
+    static_state = memory_state(attn, memory)
+    last = x[-1:]
+
+    def self_step(need_weights):
+        attn(query=last, key=last, value=last, mask_future_timesteps=True, incremental_state=state,
+             need_weights=need_weights)
+        # drop the key/value appended by the timed call, every call attends over `length` steps
+        state.cache(attn).length -= 1
+
+    def memory_step(need_weights):
+        attn(query=last, key=memory, value=memory, key_padding_mask=memory_mask, incremental_state=static_state,
+             static_kv=True, need_weights=need_weights)
+
+    return {(name, need_weights): timeit(lambda: fn(need_weights), repeat)
+            for name, fn in (('self', self_step), ('memory', memory_step)) for need_weights in (True, False)}
+
+
+def main(args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    torch.set_num_threads(args.num_threads)
+
+    print('max abs difference per attention call')
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            diffs = layer_parity(args.embed_size, args.num_heads, batch_size, length)
+            print('  batch {:>3} length {:>4}: {}'.format(
+                batch_size, length, ', '.join('{} {:.1e}'.format(k, v) for k, v in diffs.items())))
+            assert max(diffs.values()) < 1e-4, diffs
+    for batch_size in args.batch_sizes:
+        same = decoder_parity(args, batch_size)
+        print('identical sampled recipes, batch {}: {}'.format(batch_size, same))
+        assert same
+
+    print('\nms per attention call of one decoding step, {} threads'.format(torch.get_num_threads()))
+    print('{:>6} {:>7} {:>8} {:>10} {:>10} {:>9}'.format('batch', 'length', 'attention', 'weights', 'fused',
+                                                        'speedup'))
+    for batch_size in args.batch_sizes:
+        for length in args.lengths:
+            times = step_latency(args.embed_size, args.num_heads, batch_size, length, args.repeat)
+            for name in ('self', 'memory'):
+                print('{:>6} {:>7} {:>8} {:>10.3f} {:>10.3f} {:>8.2f}x'.format(
+                    batch_size, length, name, times[name, True], times[name, False],
+                    times[name, True] / times[name, False]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--lengths', nargs='+', type=int, default=[1, 50, 150],
+                        help='decoding steps attended by the self-attention')
+    parser.add_argument('--steps', type=int, default=150, help='decoding steps of the decoder parity check')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--num_heads', type=int, default=8)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=200, help='timed calls per measurement')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+"""Parity and speed of DecoderTransformer.sample_beam against the previous list-based beam search.
+
+Parity is checked on a small decoder whose vocabulary is small enough for the end token to be among the best
+candidates, for several random inputs: every batch element must get the ids and score the list-based search
+returns for it alone. Speed is measured on a decoder with the size of the recipe decoder and random weights, so
+it never emits the end token and every run decodes exactly --steps steps.
+
+    python -m benchmarks.beam_search --beams 3 5 10
+"""
+import argparse
+import time
+
+import torch
+
+from modules.transformer_decoder import DecoderTransformer
+from tests.reference import legacy_sample_beam
+
+
+def parity(beam, batch_size, args):
+    """Number of batch elements for which sample_beam and legacy_sample_beam return different ids or scores,
+    and number of them ending with the end token"""
+    embed_size = 64
+    decoder = DecoderTransformer(embed_size, args.parity_vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=4, num_layers=2)
+    decoder.eval()
+    img_features = torch.randn(batch_size, embed_size, 49)
+    ingr_features = torch.randn(batch_size, embed_size, 20)
+    ingr_mask = torch.ones(batch_size, 1, 20)
+
+    with torch.no_grad():
+        ids, scores = decoder.sample_beam(ingr_features, ingr_mask, beam, img_features, 0, last_token_value=1)
+        mismatches = ended = 0
+        for i in range(batch_size):
+            legacy_ids, legacy_score = legacy_sample_beam(decoder, ingr_features[i:i + 1], ingr_mask[i:i + 1], beam,
+                                                          img_features[i:i + 1], 0, last_token_value=1,
+                                                          share_cache=False)
+            length = legacy_ids.size(1)
+            # shorter hypotheses are padded with the end token up to the longest one of the batch
+            same = (torch.equal(ids[i, :length], legacy_ids[0]) and bool((ids[i, length:] == 1).all())
+                    and abs(scores[i].item() - legacy_score) < 1e-4)
+            mismatches += not same
+            ended += legacy_ids[0, -1].item() == 1
+    return mismatches, ended
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        with torch.no_grad():
+            fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+
+    for beam in args.beams:
+        mismatches = ended = 0
+        for _ in range(args.parity_runs):
+            run_mismatches, run_ended = parity(beam, args.parity_batch_size, args)
+            mismatches += run_mismatches
+            ended += run_ended
+        total = args.parity_runs * args.parity_batch_size
+        print('beam {:>3}: {}/{} searches identical to the legacy one, {} ending with the end token'.format(
+            beam, total - mismatches, total, ended))
+        assert mismatches == 0
+
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=8, num_layers=args.num_layers)
+    decoder.eval()
+
+    print('{:>5} {:>6} {:>12} {:>12} {:>9}'.format('beam', 'batch', 'legacy (s)', 'batched (s)', 'speedup'))
+    for beam in args.beams:
+        for batch_size in args.batch_sizes:
+            img_features = torch.randn(batch_size, args.embed_size, 49)
+            ingr_features = torch.randn(batch_size, args.embed_size, 20)
+            ingr_mask = torch.ones(batch_size, 1, 20)
+
+            batched = timeit(lambda: decoder.sample_beam(ingr_features, ingr_mask, beam, img_features, 0,
+                                                         last_token_value=1), args.repeat)
+            if batch_size == 1:
+                legacy = timeit(lambda: legacy_sample_beam(decoder, ingr_features, ingr_mask, beam, img_features, 0,
+                                                           last_token_value=1), args.repeat)
+            else:
+                # the legacy implementation decodes one batch element at a time
+                legacy = batch_size * timeit(lambda: legacy_sample_beam(decoder, ingr_features[:1], ingr_mask[:1],
+                                                                        beam, img_features[:1], 0,
+                                                                        last_token_value=1), args.repeat)
+            print('{:>5} {:>6} {:>12.2f} {:>12.2f} {:>8.1f}x'.format(beam, batch_size, legacy, batched,
+                                                                    legacy / batched))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--beams', nargs='+', type=int, default=[3, 5, 10])
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--steps', type=int, default=30, help='number of decoding steps')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--parity_runs', type=int, default=10, help='random decoders of the parity check')
+    parser.add_argument('--parity_batch_size', type=int, default=4)
+    parser.add_argument('--parity_vocab_size', type=int, default=16)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
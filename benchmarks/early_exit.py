@@ -0,0 +1,78 @@
+"""Greedy decoding time of the recipe decoder with and without early exit.
+
+With early exit, finished sequences are dropped from the decoded batch and decoding stops once every sequence
+emitted the end token. The decoder has random weights, so --eos_bias is added to the end token logit to make
+sequences finish at different lengths, like the trained model does.
+
+    python -m benchmarks.early_exit --batch_sizes 1 8 --eos_bias 0.75
+"""
+import argparse
+import time
+
+import torch
+
+import modules.utils as utils
+from modules.transformer_decoder import DecoderTransformer
+
+
+def decode(decoder, ingr_features, ingr_mask, img_features, early_exit):
+    incremental_state = utils.IncrementalState(decoder.seq_length)
+    ids, _ = decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features, first_token_value=0,
+                            last_token_value=1, incremental_state=incremental_state, early_exit=early_exit)
+    return ids, incremental_state
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        with torch.no_grad():
+            fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=8, num_layers=args.num_layers)
+    decoder.eval()
+    with torch.no_grad():
+        decoder.linear.bias[1] += args.eos_bias
+
+    print('{:>6} {:>10} {:>10} {:>12} {:>12} {:>9}'.format('batch', 'steps', 'row steps', 'full (s)',
+                                                           'early (s)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        img_features = torch.randn(batch_size, args.embed_size, 49)
+        ingr_features = torch.randn(batch_size, args.embed_size, 20)
+        ingr_mask = torch.ones(batch_size, 1, 20)
+
+        with torch.no_grad():
+            full_ids, _ = decode(decoder, ingr_features, ingr_mask, img_features, False)
+            early_ids, state = decode(decoder, ingr_features, ingr_mask, img_features, True)
+        # the outputs may only differ after the end token
+        is_end = (full_ids == 1).long()
+        after_end = (is_end.cumsum(1) - is_end) > 0
+        assert torch.equal(full_ids[~after_end], early_ids[~after_end])
+
+        full = timeit(lambda: decode(decoder, ingr_features, ingr_mask, img_features, False), args.repeat)
+        early = timeit(lambda: decode(decoder, ingr_features, ingr_mask, img_features, True), args.repeat)
+        stats = state.stats()
+        print('{:>6} {:>10} {:>10} {:>12.2f} {:>12.2f} {:>8.1f}x'.format(
+            batch_size, '{}/{}'.format(stats['steps'], args.steps),
+            '{}/{}'.format(stats['row_steps'], args.steps * batch_size), full, early, full / early))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--steps', type=int, default=150, help='maximum number of decoding steps')
+    parser.add_argument('--eos_bias', type=float, default=0.75, help='added to the end token logit')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
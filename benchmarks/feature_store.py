@@ -0,0 +1,56 @@
+"""Time spent getting the image features from EncoderCNN versus from a populated feature store, and parity of
+the predictions made from both.
+
+    python -m Foodimg2Ing.features --store ./data/features
+    python -m benchmarks.feature_store --store ./data/features
+"""
+import argparse
+import time
+
+import torch
+
+from Foodimg2Ing.features import FeatureStore, encode_images
+from Foodimg2Ing.output import list_images, predict_batch, preprocess_images
+from Foodimg2Ing.registry import DATA_DIR, registry
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+    loaded = registry.warmup(args.data_dir)
+    store = FeatureStore(args.store, (loaded.args.embed_size, 49))
+
+    image_tensor = preprocess_images(images, loaded.device)
+    start = time.time()
+    cnn = encode_images(loaded, image_tensor)
+    cnn_ms = 1000 * (time.time() - start) / len(images)
+    start = time.time()
+    stored = encode_images(loaded, image_tensor, store)
+    store_ms = 1000 * (time.time() - start) / len(images)
+    print('features per image: cnn {:.1f}ms, store {:.2f}ms, max diff {:.2e}'.format(
+        cnn_ms, store_ms, (cnn - stored).abs().max().item()))
+
+    # the decoding settings tried on the same images
+    for greedy, beam in ((True, -1), (True, args.beam)):
+        start = time.time()
+        reference = predict_batch(images, greedy=greedy, beam=beam, data_dir=args.data_dir, cache=None, features=None)
+        without = time.time() - start
+        start = time.time()
+        results = predict_batch(images, greedy=greedy, beam=beam, data_dir=args.data_dir, cache=None, features=store)
+        with_store = time.time() - start
+        print('greedy={} beam={}: {:.2f}s without the store, {:.2f}s with it, same predictions: {}'.format(
+            greedy, beam, without, with_store, results == reference))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--store', type=str, default='./data/features', help='feature store directory')
+    parser.add_argument('--beam', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
@@ -0,0 +1,111 @@
+"""Parity and per-step latency of the recipe decoder with fused layers (DecoderTransformer.fuse) against the
+regular layers.
+
+Parity: greedy ids, logits and beam search ids of the two decoders on the same inputs. Latency: time per
+decoding step of greedy decoding, every row decoding all the steps (no early exit), and time to project the
+image and ingredient features to the keys/values of every layer.
+
+    python -m benchmarks.fused_decoder --batch_sizes 1 8 --steps 150
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+import modules.utils as utils
+from modules.transformer_decoder import DecoderTransformer
+
+
+def inputs(batch_size, embed_size):
+    img_features = torch.randn(batch_size, embed_size, 49)
+    ingr_features = torch.randn(batch_size, embed_size, 20)
+    ingr_mask = torch.ones(batch_size, 1, 20)
+    for i in range(batch_size):
+        ingr_mask[i, :, np.random.randint(1, 21):] = 0
+    return ingr_features, ingr_mask, img_features
+
+
+def sample(decoder, ingr_features, ingr_mask, img_features, steps, beam=-1, early_exit=True):
+    with torch.no_grad():
+        return decoder.sample(ingr_features, ingr_mask, greedy=True, beam=beam, img_features=img_features,
+                              first_token_value=0, last_token_value=1, early_exit=early_exit,
+                              incremental_state=utils.IncrementalState(steps))
+
+
+def parity(decoder, fused, batch_size, args):
+    ingr_features, ingr_mask, img_features = inputs(batch_size, args.embed_size)
+    ids, logits = sample(decoder, ingr_features, ingr_mask, img_features, args.steps)
+    fused_ids, fused_logits = sample(fused, ingr_features, ingr_mask, img_features, args.steps)
+    beam_ids, _ = sample(decoder, ingr_features, ingr_mask, img_features, args.steps, beam=args.beam)
+    fused_beam_ids, _ = sample(fused, ingr_features, ingr_mask, img_features, args.steps, beam=args.beam)
+    return {
+        'greedy ids': torch.equal(ids, fused_ids),
+        'beam ids': torch.equal(beam_ids, fused_beam_ids),
+        'max logit diff': (logits - fused_logits).abs().max().item(),
+    }
+
+
+def timeit(fns, repeat):
+    """Median time of each function, the functions are run in turn so they see the same machine load"""
+    times = [[] for _ in fns]
+    with torch.no_grad():
+        for fn in fns:
+            fn()
+        for _ in range(repeat):
+            for fn, fn_times in zip(fns, times):
+                start = time.perf_counter()
+                fn()
+                fn_times.append(time.perf_counter() - start)
+    return [float(np.median(fn_times)) for fn_times in times]
+
+
+def latency(decoders, batch_size, args):
+    """ms per decoding step and ms to precompute the memory keys/values, for each decoder"""
+    ingr_features, ingr_mask, img_features = inputs(batch_size, args.embed_size)
+    steps = timeit([lambda d=d: sample(d, ingr_features, ingr_mask, img_features, args.steps, early_exit=False)
+                    for d in decoders], args.repeat)
+    memory, _ = decoders[0].prepare_memory(ingr_features, ingr_mask, img_features)
+    precompute = timeit([lambda d=d: d.precompute_static_kv(memory, utils.IncrementalState(args.steps))
+                         for d in decoders], args.repeat)
+    return [(1000 * step / args.steps, 1000 * p) for step, p in zip(steps, precompute)]
+
+
+def main(args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    torch.set_num_threads(args.num_threads)
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=args.num_heads, num_layers=args.num_layers)
+    decoder.eval()
+    fused = copy.deepcopy(decoder).fuse()
+
+    for batch_size in args.batch_sizes:
+        result = parity(decoder, fused, batch_size, args)
+        print('batch {:>3}: identical greedy ids {}, identical beam ({}) ids {}, max logit diff {:.1e}'.format(
+            batch_size, result['greedy ids'], args.beam, result['beam ids'], result['max logit diff']))
+        assert result['greedy ids'] and result['beam ids']
+
+    print('\n{} layers, {} steps, {} threads'.format(args.num_layers, args.steps, torch.get_num_threads()))
+    print('{:>6} {:>8} {:>12} {:>16}'.format('batch', 'layers', 'ms/step', 'memory kv (ms)'))
+    for batch_size in args.batch_sizes:
+        regular_times, fused_times = latency([decoder, fused], batch_size, args)
+        print('{:>6} {:>8} {:>12.2f} {:>16.2f}'.format(batch_size, 'regular', *regular_times))
+        print('{:>6} {:>8} {:>12.2f} {:>16.2f}'.format(batch_size, 'fused', *fused_times))
+        print('{:>6} {:>8} {:>11.2f}x'.format(batch_size, 'speedup', regular_times[0] / fused_times[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--steps', type=int, default=150, help='number of decoding steps')
+    parser.add_argument('--beam', type=int, default=3, help='beam size of the parity check')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--num_heads', type=int, default=16)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per measurement')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+"""Per-request cost of turning an uploaded image into the model input.
+
+Compares the previous path (write the upload to disk, read it back, decode the full image, build the transforms)
+with the in-memory one (decode from the uploaded bytes with JPEG draft mode, cached transforms). Disk I/O is
+read from /proc/self/io (Linux only).
+
+    python -m benchmarks.ingest --image_dir "asset/Recipe Gen images"
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from Foodimg2Ing.output import list_images, load_image, preprocess_images
+
+
+def io_counters():
+    """Bytes passed to read/write calls by this process so far"""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+
+def legacy_ingest(image_bytes, upload_dir, filename):
+    """Save the upload, then read and preprocess it from disk with freshly built transforms"""
+    image_path = os.path.join(upload_dir, filename)
+    with open(image_path, 'wb') as f:
+        f.write(image_bytes)
+    transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(224), transforms.ToTensor(),
+                                    transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+    return torch.stack([transform(load_image(image_path, draft=False))])
+
+
+def measure(fn, repeat):
+    # warm up (lazy imports read files on first use)
+    fn()
+    rchar, wchar = io_counters()
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    elapsed = (time.time() - start) / repeat
+    new_rchar, new_wchar = io_counters()
+    return out, 1000 * elapsed, (new_rchar - rchar) / repeat, (new_wchar - wchar) / repeat
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+
+    # diff: mean / max absolute difference of the normalized input with the one of the previous path
+    print('{:>16} {:>10} {:>13} {:>8} {:>10} {:>10} {:>14}'.format(
+        'image', 'size', 'path', 'ms', 'read (KB)', 'write (KB)', 'diff'))
+    with tempfile.TemporaryDirectory() as upload_dir:
+        for path in images:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            with Image.open(path) as img:
+                size = '{}x{}'.format(*img.size)
+            legacy, *legacy_stats = measure(lambda: legacy_ingest(image_bytes, upload_dir, os.path.basename(path)),
+                                            args.repeat)
+            full, *full_stats = measure(lambda: preprocess_images([image_bytes], 'cpu', draft=False), args.repeat)
+            draft, *draft_stats = measure(lambda: preprocess_images([image_bytes], 'cpu'), args.repeat)
+            for name, out, (ms, read, written) in (('disk', legacy, legacy_stats), ('memory', full, full_stats),
+                                                   ('memory+draft', draft, draft_stats)):
+                diff = (out - legacy).abs()
+                print('{:>16} {:>10} {:>13} {:>8.1f} {:>10.1f} {:>10.1f} {:>14}'.format(
+                    os.path.basename(path)[:16], size, name, ms, read / 1024, written / 1024,
+                    '{:.3f} / {:.3f}'.format(diff.mean().item(), diff.max().item())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
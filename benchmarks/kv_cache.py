@@ -0,0 +1,67 @@
+"""Per-token latency and memory of incremental decoding with the recipe decoder.
+
+Reports the time per decoded token, the bytes held by the key/value caches at the end of decoding, the
+total bytes allocated while decoding (allocator churn, measured with the torch profiler) and how many times
+each layer projected the encoder outputs to keys/values.
+
+    python -m benchmarks.kv_cache --steps 150 --batch_sizes 1 8
+"""
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+import modules.utils as utils
+from modules.transformer_decoder import DecoderTransformer
+
+
+def decode(decoder, ingr_features, ingr_mask, img_features, steps):
+    incremental_state = utils.IncrementalState(steps)
+    decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features, first_token_value=0,
+                   last_token_value=1, incremental_state=incremental_state)
+    return incremental_state
+
+
+def allocated_bytes(fn):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def main(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=8, num_layers=args.num_layers)
+    decoder.eval()
+
+    print('{:>6} {:>14} {:>14} {:>16} {:>18}'.format('batch', 'ms/token', 'cache (MB)', 'allocated (MB)',
+                                                    'kv proj/layer'))
+    for batch_size in args.batch_sizes:
+        img_features = torch.randn(batch_size, args.embed_size, 49)
+        ingr_features = torch.randn(batch_size, args.embed_size, 20)
+        ingr_mask = torch.ones(batch_size, 1, 20)
+
+        with torch.no_grad():
+            start = time.time()
+            state = decode(decoder, ingr_features, ingr_mask, img_features, args.steps)
+            ms_per_token = 1000 * (time.time() - start) / args.steps
+            allocated = allocated_bytes(lambda: decode(decoder, ingr_features, ingr_mask, img_features, args.steps))
+
+        stats = state.stats()
+        print('{:>6} {:>14.2f} {:>14.2f} {:>16.1f} {:>18}'.format(
+            batch_size, ms_per_token, stats['cache_bytes'] / 2 ** 20, allocated / 2 ** 20,
+            stats['static_kv_projections'] / stats['static_kv_modules']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--steps', type=int, default=150, help='number of decoding steps')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=16)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
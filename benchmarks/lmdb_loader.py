@@ -0,0 +1,55 @@
+"""Samples/s of Foodimg2Ing.data_loader.get_loader reading the lmdb built by utils/ims2file.py versus decoding
+the Recipe1M jpg files (--load_jpeg), for several numbers of workers. Both read the same images, the report also
+gives the largest pixel difference between the two.
+
+    python -m benchmarks.lmdb_loader --aux_data_dir ../data --recipe1m_dir path/to/recipe1m --num_workers 0 4 8
+"""
+import argparse
+import copy
+import time
+
+from torchvision import transforms
+
+from Foodimg2Ing.data_loader import get_loader
+
+
+def run(args, use_lmdb, num_workers):
+    """Samples/s over at most args.max_samples images, and the first batch"""
+    args = copy.copy(args)
+    args.use_lmdb = use_lmdb
+    args.num_workers = num_workers
+    loader = get_loader(args, args.split, transforms.ToTensor(), max_num_samples=args.max_samples)
+
+    first, count = None, 0
+    start = time.time()
+    for images, _ in loader:
+        if first is None:
+            first = images
+        count += images.size(0)
+    elapsed = time.time() - start
+    return count / elapsed, first
+
+
+def main(args):
+    print('{:>8} {:>8} {:>12}'.format('source', 'workers', 'samples/s'))
+    for num_workers in args.num_workers:
+        results = {}
+        for name, use_lmdb in (('jpeg', False), ('lmdb', True)):
+            rate, results[name] = run(args, use_lmdb, num_workers)
+            print('{:>8} {:>8} {:>12.1f}'.format(name, num_workers, rate))
+    diff = (results['lmdb'] - results['jpeg']).abs().max().item() * 255
+    print('max pixel difference lmdb vs jpeg: {:.0f}'.format(diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aux_data_dir', type=str, default='../data',
+                        help='directory with imname2pos.pkl and the lmdb_<split> databases')
+    parser.add_argument('--recipe1m_dir', type=str, default='path/to/recipe1m',
+                        help='directory where recipe1m dataset is extracted')
+    parser.add_argument('--split', type=str, default='val')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', nargs='+', type=int, default=[0, 4])
+    parser.add_argument('--max_samples', type=int, default=4096)
+    main(parser.parse_args())
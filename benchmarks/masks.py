@@ -0,0 +1,56 @@
+"""Parity and speed of the vectorized mask_from_eos and label2onehot against their previous loop-based versions.
+
+    python -m benchmarks.masks --batch_sizes 1 32 256 --vocab_sizes 1488 23231
+"""
+import argparse
+import time
+
+import torch
+
+from Foodimg2Ing.model import label2onehot, mask_from_eos
+from tests.reference import legacy_label2onehot, legacy_mask_from_eos, random_ids
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+
+    print('{:>10} {:>6} {:>7} {:>14} {:>14} {:>9}'.format('function', 'batch', 'vocab', 'legacy (ms)',
+                                                          'vectorized (ms)', 'speedup'))
+    for vocab_size in args.vocab_sizes:
+        for batch_size in args.batch_sizes:
+            ids = random_ids(batch_size, args.length, vocab_size)
+            for mult_before in (True, False):
+                assert torch.equal(mask_from_eos(ids, 0, mult_before), legacy_mask_from_eos(ids, 0, mult_before))
+            assert torch.equal(label2onehot(ids, vocab_size), legacy_label2onehot(ids, vocab_size))
+
+            for name, new, old in (('mask', lambda: mask_from_eos(ids, 0, False),
+                                    lambda: legacy_mask_from_eos(ids, 0, False)),
+                                   ('onehot', lambda: label2onehot(ids, vocab_size),
+                                    lambda: legacy_label2onehot(ids, vocab_size))):
+                legacy = 1000 * timeit(old, args.repeat)
+                vectorized = 1000 * timeit(new, args.repeat)
+                print('{:>10} {:>6} {:>7} {:>14.3f} {:>14.3f} {:>8.1f}x'.format(name, batch_size, vocab_size,
+                                                                               legacy, vectorized,
+                                                                               legacy / vectorized))
+    print('outputs match the legacy implementations')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 32, 256])
+    parser.add_argument('--vocab_sizes', nargs='+', type=int, default=[1488, 23231])
+    parser.add_argument('--length', type=int, default=20, help='number of ingredient slots')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
@@ -0,0 +1,85 @@
+"""Parity and speed of the positional embeddings looked up in their precomputed table against their previous
+forward methods.
+
+Parity is checked for every decoding step (incremental) and for whole right-padded sequences, with learned and
+sinusoidal embeddings, and on the ids sampled by a decoder using either forward. Speed is the time of a single
+incremental lookup.
+
+    python -m benchmarks.positions --steps 150 --batch_sizes 1 8
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import modules.utils as utils
+from modules.transformer_decoder import DecoderTransformer, PositionalEmbedding
+from tests.reference import embedding_parity, legacy
+
+
+def decoder_parity(args, learned, batch_size):
+    decoder = DecoderTransformer(args.embed_size, args.vocab_size, dropout=0.0, seq_length=args.steps,
+                                 num_instrs=1, attention_nheads=8, num_layers=args.num_layers, learned=learned)
+    decoder.eval()
+    img_features = torch.randn(batch_size, args.embed_size, 49)
+    ingr_features = torch.randn(batch_size, args.embed_size, 20)
+    ingr_mask = torch.ones(batch_size, 1, 20)
+
+    def sample():
+        with torch.no_grad():
+            ids, _ = decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features,
+                                    first_token_value=0, last_token_value=1)
+        return ids
+
+    ids = sample()
+    with legacy(decoder):
+        legacy_ids = sample()
+    return torch.equal(ids, legacy_ids)
+
+
+def lookup_time(embed_positions, batch_size, steps, repeat):
+    captions = torch.zeros(batch_size, steps).long()
+    state = utils.IncrementalState(steps)
+    times = []
+    with torch.no_grad():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for i in range(1, steps + 1):
+                embed_positions(captions[:, :i], incremental_state=state)
+            times.append((time.perf_counter() - start) / steps)
+    return 1e6 * float(np.median(times))
+
+
+def main(args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    torch.set_num_threads(args.num_threads)
+
+    print('{:>11} {:>6} {:>12} {:>16} {:>14} {:>14}'.format('embeddings', 'batch', 'max diff', 'identical ids',
+                                                            'legacy (us)', 'table (us)'))
+    for learned in (True, False):
+        name = 'learned' if learned else 'sinusoidal'
+        embed_positions = PositionalEmbedding(1024, args.embed_size, 0, left_pad=False, learned=learned)
+        for batch_size in args.batch_sizes:
+            diff = embedding_parity(embed_positions, batch_size, args.steps, args.vocab_size)
+            same = decoder_parity(args, learned, batch_size)
+            assert diff == 0 and same, (name, batch_size, diff, same)
+            with legacy(embed_positions):
+                legacy_time = lookup_time(embed_positions, batch_size, args.steps, args.repeat)
+            table_time = lookup_time(embed_positions, batch_size, args.steps, args.repeat)
+            print('{:>11} {:>6} {:>12.1e} {:>16} {:>14.1f} {:>14.1f}'.format(
+                name, batch_size, diff, str(same), legacy_time, table_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--steps', type=int, default=150, help='number of decoding steps')
+    parser.add_argument('--embed_size', type=int, default=512)
+    parser.add_argument('--vocab_size', type=int, default=23231)
+    parser.add_argument('--num_layers', type=int, default=4, help='layers of the decoder parity check')
+    parser.add_argument('--repeat', type=int, default=20, help='timed decodings per measurement')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
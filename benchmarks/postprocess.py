@@ -0,0 +1,56 @@
+"""Parity and speed of utils.output_utils.prepare_output_batch against the previous per-recipe prepare_output.
+
+Recipes are random ids over the instruction vocabulary, biased towards punctuation, <eoi> and repeated words
+so that every validity rule and replacement is exercised.
+
+    python -m benchmarks.postprocess --batch_sizes 1 32 256
+"""
+import argparse
+import time
+
+import numpy as np
+
+from Foodimg2Ing.registry import DATA_DIR, load_vocabs
+from utils.output_utils import prepare_output_batch
+from tests.reference import legacy_prepare_output, random_outputs
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    ingrs_vocab, vocab = load_vocabs(args.data_dir)
+
+    ids, ingr_ids = random_outputs(rng, args.parity_samples, vocab, ingrs_vocab)
+    batch = prepare_output_batch(ids, ingr_ids, ingrs_vocab, vocab)
+    reasons = {}
+    for i, result in enumerate(batch):
+        legacy = legacy_prepare_output(ids[i], ingr_ids[i], ingrs_vocab, vocab)
+        assert result == legacy, 'recipe {} differs:\n{}\n{}'.format(i, result, legacy)
+        reasons[legacy[1]['reason']] = reasons.get(legacy[1]['reason'], 0) + 1
+    print('{} recipes identical to the previous implementation ({})'.format(
+        len(batch), ', '.join('{}: {}'.format(k, v) for k, v in sorted(reasons.items()))))
+
+    print('{:>6} {:>12} {:>12} {:>8}'.format('batch', 'loop (ms)', 'batch (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        ids, ingr_ids = random_outputs(rng, batch_size, vocab, ingrs_vocab)
+        legacy_time = timeit(lambda: [legacy_prepare_output(ids[i], ingr_ids[i], ingrs_vocab, vocab)
+                                      for i in range(batch_size)], args.repeat)
+        batch_time = timeit(lambda: prepare_output_batch(ids, ingr_ids, ingrs_vocab, vocab), args.repeat)
+        print('{:>6} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(batch_size, 1000 * legacy_time, 1000 * batch_time,
+                                                           legacy_time / batch_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR, help='directory with the vocabularies')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 32, 256])
+    parser.add_argument('--parity_samples', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    main(parser.parse_args())
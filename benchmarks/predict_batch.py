@@ -0,0 +1,42 @@
+"""Throughput of Foodimg2Ing.output.predict_batch for several batch sizes.
+
+    python -m benchmarks.predict_batch --batch_sizes 1 8 32
+"""
+import argparse
+import time
+
+import torch
+
+from Foodimg2Ing.output import list_images, predict_batch
+from Foodimg2Ing.registry import DATA_DIR, registry
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+
+    registry.warmup(args.data_dir)
+
+    print('{:>6} {:>10} {:>12} {:>10}'.format('batch', 'seconds', 'images/s', 'valid'))
+    for batch_size in args.batch_sizes:
+        batch = [images[i % len(images)] for i in range(batch_size)]
+        start = time.time()
+        results = predict_batch(batch, data_dir=args.data_dir)
+        elapsed = time.time() - start
+        valid = sum(valid['is_valid'] for _, valid in results)
+        print('{:>6} {:>10.2f} {:>12.2f} {:>10}'.format(batch_size, elapsed, batch_size / elapsed,
+                                                         '{}/{}'.format(valid, batch_size)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images',
+                        help='images to predict, cycled to fill each batch')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
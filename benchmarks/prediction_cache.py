@@ -0,0 +1,56 @@
+"""Latency of predict_batch for images that are not cached yet, cached in memory and cached on disk only.
+
+    python -m benchmarks.prediction_cache --image_dir "asset/Recipe Gen images"
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from Foodimg2Ing.cache import PredictionCache
+from Foodimg2Ing.output import list_images, predict_batch
+from Foodimg2Ing.registry import DATA_DIR, registry
+
+
+def timed(images, data_dir, cache):
+    start = time.time()
+    results = [predict_batch([image], data_dir=data_dir, cache=cache)[0] for image in images]
+    return results, 1000 * (time.time() - start) / len(images)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+    registry.warmup(args.data_dir)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        path = os.path.join(cache_dir, 'predictions.sqlite')
+        cache = PredictionCache(max_entries=args.max_entries, path=path)
+        cold, cold_ms = timed(images, args.data_dir, cache)
+        memory, memory_ms = timed(images, args.data_dir, cache)
+        # a new process only has the disk tier
+        disk_cache = PredictionCache(max_entries=args.max_entries, path=path)
+        disk, disk_ms = timed(images, args.data_dir, disk_cache)
+
+        assert cold == memory == disk, 'cached predictions differ from the computed ones'
+        print('{} images, ms per request'.format(len(images)))
+        print('{:>12} {:>12.1f}'.format('miss', cold_ms))
+        print('{:>12} {:>12.1f}'.format('memory hit', memory_ms))
+        print('{:>12} {:>12.1f}'.format('disk hit', disk_ms))
+        print(cache.stats())
+        print(disk_cache.stats())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--max_entries', type=int, default=1024)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
@@ -0,0 +1,85 @@
+"""Accuracy and latency of the int8 dynamically quantized model against the float model.
+
+There is no ground truth for the demo images, so the float model predictions are the reference: the report
+gives the ingredient IoU (softIoU) between the quantized and the float ingredients, the recipe validity rate
+(prepare_output) of both models, the number of identical recipes, the latency per image and the model size.
+
+    python -m benchmarks.quantization --image_dir "asset/Recipe Gen images"
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from Foodimg2Ing.model import label2onehot
+from Foodimg2Ing.output import list_images, preprocess_images
+from Foodimg2Ing.registry import DATA_DIR, registry
+from utils.metrics import softIoU
+from utils.output_utils import prepare_output
+
+
+def predict(loaded, images, repeat):
+    """Outputs of model.sample for every image (one at a time) and the median latency per image"""
+    outputs, times = [], []
+    for path in images:
+        image_tensor = preprocess_images([path], loaded.device)
+        for _ in range(repeat):
+            start = time.time()
+            with torch.no_grad():
+                out = loaded.model.sample(image_tensor, greedy=True, temperature=1.0, beam=-1, true_ingrs=None)
+            times.append(time.time() - start)
+        outputs.append(out)
+    return outputs, float(np.median(times))
+
+
+def validity(loaded, outputs):
+    valid = 0
+    for out in outputs:
+        _, v = prepare_output(out['recipe_ids'][0].cpu().numpy(), out['ingr_ids'][0].cpu().numpy(),
+                              loaded.ingrs_vocab, loaded.vocab)
+        valid += v['is_valid']
+    return valid / len(outputs)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+
+    float_model = registry.get(args.data_dir, device='cpu')
+    start = time.time()
+    quantized_model = registry.get(args.data_dir, device='cpu', quantize=True)
+    quantized_load_time = time.time() - start
+
+    float_outputs, float_latency = predict(float_model, images, args.repeat)
+    quantized_outputs, quantized_latency = predict(quantized_model, images, args.repeat)
+
+    pad_value = float_model.model.pad_value
+    ious, same_recipes = [], 0
+    for f, q in zip(float_outputs, quantized_outputs):
+        ious.append(softIoU(label2onehot(q['ingr_ids'], pad_value), label2onehot(f['ingr_ids'], pad_value)).item())
+        same_recipes += torch.equal(f['recipe_ids'], q['recipe_ids'])
+
+    print('{} images, {} runs each, {} threads'.format(len(images), args.repeat, torch.get_num_threads()))
+    print('{:>10} {:>14} {:>10} {:>10}'.format('model', 'latency (s)', 'size (MB)', 'valid'))
+    for name, loaded, latency, outputs in (('float', float_model, float_latency, float_outputs),
+                                           ('int8', quantized_model, quantized_latency, quantized_outputs)):
+        print('{:>10} {:>14.3f} {:>10.1f} {:>10.2f}'.format(name, latency, loaded.memory_usage()['total'] / 2 ** 20,
+                                                           validity(loaded, outputs)))
+    print('speedup {:.2f}x'.format(float_latency / quantized_latency))
+    print('ingredient IoU vs float: mean {:.3f} min {:.3f}'.format(np.mean(ious), np.min(ious)))
+    print('identical recipes: {}/{}'.format(same_recipes, len(images)))
+    print('quantized model loaded in {:.2f}s'.format(quantized_load_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per image')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
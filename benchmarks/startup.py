@@ -0,0 +1,47 @@
+"""Import time and memory of the app entry points, each measured in a fresh interpreter.
+
+Foodimg2Ing is what the Flask app imports, Foodimg2Ing.output is the model entry point the Streamlit pages import
+and streamlit_app is the Streamlit app itself. The report also shows whether tensorflow ended up being imported.
+
+    python -m benchmarks.startup --modules Foodimg2Ing Foodimg2Ing.output streamlit_app
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+CHILD = '''
+import json, resource, sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(json.dumps({{'seconds': elapsed, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'tensorflow': 'tensorflow' in sys.modules, 'torch': 'torch' in sys.modules}}))
+'''
+
+
+def measure(python, module):
+    result = subprocess.run([python, '-c', CHILD.format(module=module)], capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(args):
+    print('{:>22} {:>10} {:>14} {:>11}'.format('module', 'import (s)', 'max rss (MB)', 'tensorflow'))
+    for module in args.modules:
+        runs = [measure(args.python, module) for _ in range(args.repeat)]
+        if 'error' in runs[0]:
+            print('{:>22} failed: {}'.format(module, runs[0]['error']))
+            continue
+        best = min(runs, key=lambda run: run['seconds'])
+        print('{:>22} {:>10.2f} {:>14.0f} {:>11}'.format(module, best['seconds'], best['max_rss_mb'],
+                                                         'yes' if best['tensorflow'] else 'no'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', nargs='+', default=['Foodimg2Ing', 'Foodimg2Ing.output', 'streamlit_app'])
+    parser.add_argument('--python', type=str, default=sys.executable, help='interpreter to measure with')
+    parser.add_argument('--repeat', type=int, default=3, help='imports per module, the fastest one is reported')
+    main(parser.parse_args())
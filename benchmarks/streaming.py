@@ -0,0 +1,52 @@
+"""Time to the first ingredient and to the first recipe word with Foodimg2Ing.output.stream_prediction, against
+the latency of the blocking predict_batch call that returns the whole recipe at once.
+
+    python -m benchmarks.streaming --image_dir "asset/Recipe Gen images"
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from Foodimg2Ing.output import list_images, predict_batch, stream_prediction
+from Foodimg2Ing.registry import DATA_DIR, registry
+
+
+def stream_times(image, data_dir):
+    """Seconds to the first ingredient, the first recipe word and the final prediction"""
+    first = {}
+    for event in stream_prediction(image, data_dir=data_dir, cache=None, features=None):
+        first.setdefault(event['type'], event['time'])
+    return first.get('ingredient', np.nan), first.get('token', np.nan), first['done']
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    images = list_images(args.image_dir)
+    if not images:
+        raise RuntimeError('No images found in {}'.format(args.image_dir))
+    registry.warmup(args.data_dir)
+
+    print('{:>16} {:>12} {:>12} {:>12} {:>12}'.format('image', 'blocking', 'first ingr', 'first word',
+                                                      'stream done'))
+    rows = []
+    for path in images:
+        for _ in range(args.repeat):
+            start = time.time()
+            predict_batch([path], data_dir=args.data_dir, cache=None, features=None)
+            rows.append((time.time() - start,) + stream_times(path, args.data_dir))
+        print('{:>16} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}'.format(path.split('/')[-1][:16],
+                                                                     *np.median(rows[-args.repeat:], 0)))
+    print('{:>16} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}'.format('median', *np.nanmedian(rows, 0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--image_dir', type=str, default='asset/Recipe Gen images')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per image')
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads(),
+                        help='number of cpu threads used by torch')
+    main(parser.parse_args())
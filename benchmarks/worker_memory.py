@@ -0,0 +1,93 @@
+"""Memory and cold load time of the model in several worker processes loading it at the same time, with the
+weights read from the pickled checkpoint (torch.load, a private copy per worker) or memory-mapped from its
+safetensors conversion (pages shared through the page cache).
+
+Per worker: load time, RSS, PSS (shared pages divided between the processes mapping them) and the anonymous
+(private) memory, read from /proc (Linux only) once every worker has loaded the model and read all its weights.
+Run `python -m Foodimg2Ing.weights` first so that no worker pays for the conversion.
+
+    python -m benchmarks.worker_memory --workers 1 4 8
+"""
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+
+def memory():
+    """RSS, PSS and anonymous memory of this process in MB"""
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Anonymous:'):
+                values[parts[0][:-1].lower()] = int(parts[1]) / 1024
+    return values
+
+
+def worker(method, data_dir, model_path, ready, results):
+    import torch
+    from Foodimg2Ing.model import get_model
+    from Foodimg2Ing.registry import DEFAULT_OVERRIDES, build_args, load_vocabs
+    from Foodimg2Ing.weights import load_mapped_model
+
+    torch.set_num_threads(1)
+    start = time.time()
+    ingrs_vocab, vocab = load_vocabs(data_dir)
+    args = build_args(DEFAULT_OVERRIDES)
+    if method == 'mmap':
+        model = load_mapped_model(lambda: get_model(args, len(ingrs_vocab), len(vocab), pretrained=False),
+                                  model_path, data_dir)
+    else:
+        model = get_model(args, len(ingrs_vocab), len(vocab), pretrained=False)
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model.eval()
+    load_time = time.time() - start
+
+    # read every weight, as inference does
+    with torch.no_grad():
+        for p in model.parameters():
+            p.sum()
+    ready.wait()
+    results.put(dict(memory(), load_time=load_time))
+    # keep the model mapped until every worker has measured
+    ready.wait()
+
+
+def run(method, num_workers, data_dir, model_path):
+    context = multiprocessing.get_context('spawn')
+    ready = context.Barrier(num_workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(method, data_dir, model_path, ready, results))
+                 for _ in range(num_workers)]
+    for p in processes:
+        p.start()
+    stats = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return stats
+
+
+def main(args):
+    from Foodimg2Ing.registry import get_model_path
+    model_path = get_model_path(args.data_dir)
+
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'weights', 'workers', 'load (s)', 'rss (MB)', 'pss (MB)', 'anon (MB)', 'total pss'))
+    for num_workers in args.workers:
+        for method in args.methods:
+            stats = run(method, num_workers, args.data_dir, model_path)
+            mean = {key: np.mean([s[key] for s in stats]) for key in stats[0]}
+            print('{:>8} {:>8} {:>10.2f} {:>10.0f} {:>10.0f} {:>10.0f} {:>12.0f}'.format(
+                method, num_workers, mean['load_time'], mean['rss'], mean['pss'], mean['anonymous'],
+                sum(s['pss'] for s in stats)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='./data',
+                        help='directory with the vocabularies and the checkpoint')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4, 8])
+    parser.add_argument('--methods', nargs='+', default=['pickle', 'mmap'], choices=['pickle', 'mmap'])
+    main(parser.parse_args())
@@ -40,55 +40,72 @@ def calculate_nutrition(ingredients):
 
 
 
-def predict_from_image(uploaded_file):
-    """Process uploaded image and generate recipe"""
-    try:
+def save_upload(uploaded_file, keep_image=False):
+    """Bytes of an uploaded image and the image to display: the path it was saved to with keep_image,
+    otherwise the bytes themselves (st.image displays both)"""
+    image_bytes = uploaded_file.getvalue()
+    image_path = image_bytes
+    if keep_image:
         static_dir = os.path.join(os.getcwd(), "asset/Recipe Gen images/")
         os.makedirs(static_dir, exist_ok=True)
 
         image_path = os.path.join(static_dir, uploaded_file.name)
         with open(image_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-
-        try:
-            from Foodimg2Ing.output import output
-            
-            # Call output function which returns title, ingredients, recipe
-            title, ingredients, recipe = output(image_path)
-
-            # Handle title
-            if isinstance(title, list):
-                title = " ".join(title) if title else "Custom Recipe"
-            elif not title:
-                title = "Custom Recipe"
-
-            # Clean and validate recipe steps
-            if recipe:
-                # Remove any error messages or invalid steps
-                recipe = [
-                    step
-                    for step in recipe
-                    if not any(
-                        error_text in step.lower()
-                        for error_text in ["reason:", "no", "eos", "found"]
-                    )
-                ]
-                # Remove empty or single-character steps
-                recipe = [step for step in recipe if len(step.strip()) > 1]
-
-            # Ensure ingredients and recipe are lists
-            ingredients = ingredients if ingredients and isinstance(ingredients, list) else []
-            recipe = recipe if recipe else []
-
-            return title, ingredients, recipe, image_path
-
-        except Exception as e:
-            st.error(f"Error processing image: {str(e)}")
-            return None, None, None, None
+            f.write(image_bytes)
+    return image_bytes, image_path
+
+
+def clean_prediction(title, ingredients, recipe):
+    """Title, ingredients and recipe steps of a prediction, without the error messages and empty steps"""
+    # Handle title
+    if isinstance(title, list):
+        title = " ".join(title) if title else "Custom Recipe"
+    elif not title:
+        title = "Custom Recipe"
+
+    # Clean and validate recipe steps
+    if recipe:
+        # Remove any error messages or invalid steps
+        recipe = [
+            step
+            for step in recipe
+            if not any(
+                error_text in step.lower()
+                for error_text in ["reason:", "no", "eos", "found"]
+            )
+        ]
+        # Remove empty or single-character steps
+        recipe = [step for step in recipe if len(step.strip()) > 1]
+
+    # Ensure ingredients and recipe are lists
+    ingredients = ingredients if ingredients and isinstance(ingredients, list) else []
+    recipe = recipe if recipe else []
+    return title, ingredients, recipe
+
+
+def stream_from_image(uploaded_file, keep_image=False):
+    """Generate a recipe for an uploaded image, yielding the events of Foodimg2Ing.output.stream_prediction:
+    the ingredients and recipe words as they are decoded, then 'done' with the cleaned title, ingredients and
+    recipe and the image to display in 'image'.
 
+    The image is decoded from the uploaded bytes. It is only written to disk with keep_image, otherwise the
+    displayed image is the bytes themselves (st.image displays both).
+    """
+    try:
+        image_bytes, image_path = save_upload(uploaded_file, keep_image)
     except Exception as e:
-        st.error(f"Error saving image: {str(e)}")
-        return None, None, None, None
+        yield {"type": "error", "message": f"Error saving image: {str(e)}"}
+        return
+
+    from Foodimg2Ing.output import stream_prediction
+
+    for event in stream_prediction(image_bytes):
+        if event["type"] == "done":
+            event["title"], event["ingredients"], event["recipe"] = clean_prediction(
+                event["title"], event["ingredients"], event["recipe"]
+            )
+            event["image"] = image_path
+        yield event
 
 def display_recipe_card(title, ingredients, instructions, nutrition, image_path=None):
     """Display recipe information in an enhanced, aesthetic card format"""
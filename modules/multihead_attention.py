@@ -11,7 +11,7 @@ from torch import nn
 from torch.nn import Parameter
 import torch.nn.functional as F
 
-from modules.utils import fill_with_neg_inf, get_incremental_state, set_incremental_state
+from modules.utils import fill_with_neg_inf
 
 
 class MultiheadAttention(nn.Module):
@@ -34,6 +34,8 @@ class MultiheadAttention(nn.Module):
         else:
             self.register_parameter('in_proj_bias', None)
         self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        # True once split_in_proj() replaced in_proj_weight by q_proj, k_proj and v_proj
+        self.in_proj_split = False
 
         self.reset_parameters()
 
@@ -53,6 +55,8 @@ class MultiheadAttention(nn.Module):
         `mask_future_timesteps` argument. Padding elements can be excluded from
         the key by passing a binary ByteTensor (`key_padding_mask`) with shape:
         batch x src_len, where padding elements are indicated by 1s.
+        With need_weights=False, the attention is computed by the fused
+        F.scaled_dot_product_attention kernel and no weights are returned.
         """
 
         qkv_same = query.data_ptr() == key.data_ptr() == value.data_ptr()
@@ -64,15 +68,15 @@ class MultiheadAttention(nn.Module):
         assert key.size() == value.size()
 
         if incremental_state is not None:
-            saved_state = self._get_input_buffer(incremental_state)
-            if 'prev_key' in saved_state:
+            cache = incremental_state.cache(self)
+            if cache.length > 0:
                 # previous time steps are cached - no need to recompute
                 # key and value if they are static
                 if static_kv:
                     assert kv_same and not qkv_same
                     key = value = None
         else:
-            saved_state = None
+            cache = None
 
         if qkv_same:
             # self-attention
@@ -82,9 +86,8 @@ class MultiheadAttention(nn.Module):
             q = self.in_proj_q(query)
             if key is None:
                 assert value is None
-                # this will allow us to concat it with previous value and get
-                # just get the previous value
-                k = v = q.new(0)
+                # static keys and values are taken from the cache below
+                k = v = None
             else:
                 k, v = self.in_proj_kv(key)
         else:
@@ -93,14 +96,14 @@ class MultiheadAttention(nn.Module):
             v = self.in_proj_v(value)
         q *= self.scaling
 
-        if saved_state is not None:
-            if 'prev_key' in saved_state:
-                k = torch.cat((saved_state['prev_key'], k), dim=0)
-            if 'prev_value' in saved_state:
-                v = torch.cat((saved_state['prev_value'], v), dim=0)
-            saved_state['prev_key'] = k
-            saved_state['prev_value'] = v
-            self._set_input_buffer(incremental_state, saved_state)
+        if cache is not None:
+            if static_kv:
+                if k is not None:
+                    cache.set_static(k, v)
+                k, v = cache.key, cache.value
+            else:
+                # written in place in the preallocated buffers
+                k, v = cache.append(k, v)
 
         src_len = k.size(0)
 
@@ -108,6 +111,16 @@ class MultiheadAttention(nn.Module):
             assert key_padding_mask.size(0) == bsz
             assert key_padding_mask.size(1) == src_len
 
+        # only apply masking at training time (when incremental state is None)
+        mask_future_timesteps = mask_future_timesteps and incremental_state is None
+        if mask_future_timesteps:
+            assert query.size() == key.size(), \
+                'mask_future_timesteps only applies to self-attention'
+
+        if not need_weights:
+            attn = self.scaled_dot_product_attention(q, k, v, mask_future_timesteps, key_padding_mask)
+            return self.out_proj(attn), None
+
         q = q.contiguous().view(tgt_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
         k = k.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
         v = v.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
@@ -115,10 +128,7 @@ class MultiheadAttention(nn.Module):
         attn_weights = torch.bmm(q, k.transpose(1, 2))
         assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
 
-        # only apply masking at training time (when incremental state is None)
-        if mask_future_timesteps and incremental_state is None:
-            assert query.size() == key.size(), \
-                'mask_future_timesteps only applies to self-attention'
+        if mask_future_timesteps:
             attn_weights += self.buffered_mask(attn_weights).unsqueeze(0)
         if key_padding_mask is not None:
             # don't attend to padding symbols
@@ -143,19 +153,78 @@ class MultiheadAttention(nn.Module):
 
         return attn, attn_weights
 
+    def scaled_dot_product_attention(self, q, k, v, mask_future_timesteps=False, key_padding_mask=None):
+        """Attention output (Time x Batch x Channel, before out_proj) of the projected and scaled queries over
+        the projected keys and values, without materializing the attention weights"""
+        tgt_len, bsz, _ = q.size()
+        src_len = k.size(0)
+        # Time x Batch x Channel -> Batch x Heads x Time x Head_dim
+        q = q.view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.view(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.view(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        attn_mask = None
+        if key_padding_mask is not None:
+            # True where attending is allowed
+            attn_mask = ~key_padding_mask.bool().view(bsz, 1, 1, src_len)
+            if mask_future_timesteps:
+                # is_causal cannot be combined with a mask
+                attn_mask = attn_mask & torch.ones(tgt_len, src_len, dtype=torch.bool, device=q.device).tril()
+                mask_future_timesteps = False
+
+        # q is already scaled
+        attn = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                              dropout_p=self.dropout if self.training else 0.,
+                                              is_causal=mask_future_timesteps, scale=1.)
+        return attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, self.embed_dim)
+
+    def precompute_static_kv(self, key, incremental_state):
+        """Project encoder outputs to keys/values once, later steps with static_kv=True reuse them"""
+        k, v = self.in_proj_kv(key)
+        incremental_state.cache(self).set_static(k, v)
+
+    def split_in_proj(self):
+        """Replace the packed input projection by separate q/k/v nn.Linear layers with the same weights.
+        Outputs are unchanged, but the projections become visible to tools that work on nn.Linear modules
+        such as torch dynamic quantization.
+        """
+        if self.in_proj_split:
+            return
+        bias = self.in_proj_bias is not None
+        for i, name in enumerate(['q_proj', 'k_proj', 'v_proj']):
+            linear = nn.Linear(self.embed_dim, self.embed_dim, bias=bias).to(self.in_proj_weight.device)
+            start, end = i * self.embed_dim, (i + 1) * self.embed_dim
+            linear.weight.data.copy_(self.in_proj_weight.data[start:end])
+            if bias:
+                linear.bias.data.copy_(self.in_proj_bias.data[start:end])
+            setattr(self, name, linear)
+        del self.in_proj_weight
+        del self.in_proj_bias
+        self.in_proj_split = True
+
     def in_proj_qkv(self, query):
+        if self.in_proj_split:
+            return self.q_proj(query), self.k_proj(query), self.v_proj(query)
         return self._in_proj(query).chunk(3, dim=-1)
 
     def in_proj_kv(self, key):
+        if self.in_proj_split:
+            return self.k_proj(key), self.v_proj(key)
         return self._in_proj(key, start=self.embed_dim).chunk(2, dim=-1)
 
     def in_proj_q(self, query):
+        if self.in_proj_split:
+            return self.q_proj(query)
         return self._in_proj(query, end=self.embed_dim)
 
     def in_proj_k(self, key):
+        if self.in_proj_split:
+            return self.k_proj(key)
         return self._in_proj(key, start=self.embed_dim, end=2*self.embed_dim)
 
     def in_proj_v(self, value):
+        if self.in_proj_split:
+            return self.v_proj(value)
         return self._in_proj(value, start=2*self.embed_dim)
 
     def _in_proj(self, input, start=None, end=None):
@@ -181,23 +250,4 @@ class MultiheadAttention(nn.Module):
 
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
-        input_buffer = self._get_input_buffer(incremental_state)
-        if input_buffer is not None:
-            for k in input_buffer.keys():
-                input_buffer[k] = input_buffer[k].index_select(1, new_order)
-            self._set_input_buffer(incremental_state, input_buffer)
-
-    def _get_input_buffer(self, incremental_state):
-        return get_incremental_state(
-            self,
-            incremental_state,
-            'attn_state',
-        ) or {}
-
-    def _set_input_buffer(self, incremental_state, buffer):
-        set_incremental_state(
-            self,
-            incremental_state,
-            'attn_state',
-            buffer,
-        )
+        incremental_state.cache(self).reorder(new_order)
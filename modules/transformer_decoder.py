@@ -15,7 +15,6 @@ import torch.nn.functional as F
 from torch.nn.modules.utils import _single
 import modules.utils as utils
 from modules.multihead_attention import MultiheadAttention
-import numpy as np
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 import copy
 
@@ -44,6 +43,15 @@ def make_positions(tensor, padding_idx, left_pad):
     return out
 
 
+def mask_repetitions(predicted_mask, ids):
+    """Set -inf in predicted_mask (batch x vocab) at the ids (batch) just sampled, in place.
+    Id 0 is never masked, so it can always be predicted again.
+    """
+    predicted_mask.scatter_(1, ids.unsqueeze(1), float('-inf'))
+    predicted_mask[:, 0] = 0
+    return predicted_mask
+
+
 class LearnedPositionalEmbedding(nn.Embedding):
     """This module learns positional embeddings up to a fixed maximum size.
     Padding symbols are ignored, but it is necessary to specify whether padding
@@ -58,12 +66,11 @@ class LearnedPositionalEmbedding(nn.Embedding):
     def forward(self, input, incremental_state=None):
         """Input is expected to be of size [bsz x seqlen]."""
         if incremental_state is not None:
-            # positions is the same for every token when decoding a single step
-
-            positions = input.data.new(1, 1).fill_(self.padding_idx + input.size(1))
-        else:
+            # positions is the same for every token when decoding a single step, its row of the table is
+            # returned as is (1 x 1 x C) instead of being looked up from a positions tensor
+            return self.weight[self.padding_idx + input.size(1)].view(1, 1, -1)
 
-            positions = make_positions(input.data, self.padding_idx, self.left_pad)
+        positions = make_positions(input.data, self.padding_idx, self.left_pad)
         return super().forward(positions)
 
     def max_positions(self):
@@ -81,47 +88,51 @@ class SinusoidalPositionalEmbedding(nn.Module):
         self.embedding_dim = embedding_dim
         self.padding_idx = padding_idx
         self.left_pad = left_pad
-        self.weights = SinusoidalPositionalEmbedding.get_embedding(
+        # the table of init_size positions is computed once and follows the module across devices and dtypes;
+        # it is not part of the state dict. Built on cpu, so it exists even when the module is created on the
+        # meta device to load its weights
+        self.register_buffer('weights', SinusoidalPositionalEmbedding.get_embedding(
             init_size,
             embedding_dim,
             padding_idx,
-        )
+            device='cpu',
+        ), persistent=False)
         self.register_buffer('_float_tensor', torch.FloatTensor())
 
     @staticmethod
-    def get_embedding(num_embeddings, embedding_dim, padding_idx=None):
+    def get_embedding(num_embeddings, embedding_dim, padding_idx=None, device=None):
         """Build sinusoidal embeddings.
         This matches the implementation in tensor2tensor, but differs slightly
         from the description in Section 3.5 of "Attention Is All You Need".
         """
         half_dim = embedding_dim // 2
         emb = math.log(10000) / (half_dim - 1)
-        emb = torch.exp(torch.arange(half_dim, dtype=torch.float) * -emb)
-        emb = torch.arange(num_embeddings, dtype=torch.float).unsqueeze(1) * emb.unsqueeze(0)
+        emb = torch.exp(torch.arange(half_dim, dtype=torch.float, device=device) * -emb)
+        emb = torch.arange(num_embeddings, dtype=torch.float, device=device).unsqueeze(1) * emb.unsqueeze(0)
         emb = torch.cat([torch.sin(emb), torch.cos(emb)], dim=1).view(num_embeddings, -1)
         if embedding_dim % 2 == 1:
             # zero pad
-            emb = torch.cat([emb, torch.zeros(num_embeddings, 1)], dim=1)
+            emb = torch.cat([emb, torch.zeros(num_embeddings, 1, device=device)], dim=1)
         if padding_idx is not None:
             emb[padding_idx, :] = 0
         return emb
 
     def forward(self, input, incremental_state=None):
         """Input is expected to be of size [bsz x seqlen]."""
-        # recompute/expand embeddings if needed
         bsz, seq_len = input.size()
+        if incremental_state is not None:
+            # positions is the same for every token when decoding a single step
+            return self.weights[self.padding_idx + seq_len].view(1, 1, -1)
+
+        # expand embeddings if needed
         max_pos = self.padding_idx + 1 + seq_len
-        if self.weights is None or max_pos > self.weights.size(0):
+        if max_pos > self.weights.size(0):
             self.weights = SinusoidalPositionalEmbedding.get_embedding(
                 max_pos,
                 self.embedding_dim,
                 self.padding_idx,
-            )
-        self.weights = self.weights.type_as(self._float_tensor)
-
-        if incremental_state is not None:
-            # positions is the same for every token when decoding a single step
-            return self.weights[self.padding_idx + seq_len, :].expand(bsz, 1, -1)
+                device=self.weights.device,
+            ).to(self.weights.dtype)
 
         positions = make_positions(input.data, self.padding_idx, self.left_pad)
         return self.weights.index_select(0, positions.view(-1)).view(bsz, seq_len, -1).detach()
@@ -160,7 +171,7 @@ class TransformerDecoderLayer(nn.Module):
         if self.use_last_ln:
             self.last_ln = LayerNorm(self.embed_dim)
 
-    def forward(self, x, ingr_features, ingr_mask, incremental_state, img_features):
+    def forward(self, x, memory, memory_mask, incremental_state):
 
         # self attention
         residual = x
@@ -180,38 +191,15 @@ class TransformerDecoderLayer(nn.Module):
         residual = x
         x = self.maybe_layer_norm(1, x, before=True)
 
-        # attention
-        if ingr_features is None:
-
-            x, _ = self.cond_att(query=x,
-                                    key=img_features,
-                                    value=img_features,
-                                    key_padding_mask=None,
-                                    incremental_state=incremental_state,
-                                    static_kv=True,
-                                    )
-        elif img_features is None:
-            x, _ = self.cond_att(query=x,
-                                    key=ingr_features,
-                                    value=ingr_features,
-                                    key_padding_mask=ingr_mask,
-                                    incremental_state=incremental_state,
-                                    static_kv=True,
-                                    )
-
-
-        else:
-            # attention on concatenation of encoder_out and encoder_aux, query self attn (x)
-            kv = torch.cat((img_features, ingr_features), 0)
-            mask = torch.cat((torch.zeros(img_features.shape[1], img_features.shape[0], dtype=torch.uint8).to(device),
-                              ingr_mask), 1)
-            x, _ = self.cond_att(query=x,
-                                    key=kv,
-                                    value=kv,
-                                    key_padding_mask=mask,
-                                    incremental_state=incremental_state,
-                                    static_kv=True,
-            )
+        # attention on the image and/or ingredient features, query self attn (x)
+        x, _ = self.cond_att(query=x,
+                             key=memory,
+                             value=memory,
+                             key_padding_mask=memory_mask,
+                             incremental_state=incremental_state,
+                             static_kv=True,
+                             need_weights=False,
+                             )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
         x = self.maybe_layer_norm(1, x, after=True)
@@ -237,6 +225,101 @@ class TransformerDecoderLayer(nn.Module):
         else:
             return x
 
+    def precompute_static_kv(self, memory, incremental_state):
+        self.cond_att.precompute_static_kv(memory, incremental_state)
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        """Reorder the self-attention cache, the attended memory is shared by every beam of a batch element"""
+        self.self_attn.reorder_incremental_state(incremental_state, new_order)
+
+
+class FusedDecoderLayer(nn.Module):
+    """Inference-only version of a TransformerDecoderLayer, for incremental decoding one step at a time.
+
+    The self-attention projects q, k and v with a single matmul and the memory attention projects the image
+    and ingredient features to keys/values once per request (precompute_static_kv). Keys and values are kept
+    as Batch x Heads x Time x Head_dim (HeadMajorKVCache), the layout F.scaled_dot_product_attention reads, and
+    the query scaling is done by the kernel, so a step does not copy or reshape the caches. The weights are
+    views of the ones of the original layer.
+    """
+
+    def __init__(self, layer):
+        super().__init__()
+        if layer.self_attn.in_proj_split or layer.cond_att.in_proj_split:
+            raise ValueError('Quantized decoder layers cannot be fused')
+        self.num_heads = layer.self_attn.num_heads
+        self.head_dim = layer.self_attn.head_dim
+        self.embed_dim = layer.embed_dim
+        self.scaling = layer.self_attn.scaling
+        self.normalize_before = layer.normalize_before
+
+        self.self_attn = layer.self_attn
+        self.cond_att = layer.cond_att
+        self.fc1 = layer.fc1
+        self.fc2 = layer.fc2
+        self.layer_norms = layer.layer_norms
+        self.use_last_ln = layer.use_last_ln
+        if self.use_last_ln:
+            self.last_ln = layer.last_ln
+        self.eval()
+
+    def heads(self, x):
+        """Batch x Channel -> Batch x Heads x 1 x Head_dim (a view)"""
+        return x.view(x.size(0), self.num_heads, 1, self.head_dim)
+
+    def forward(self, x, memory, memory_mask, incremental_state):
+        assert incremental_state is not None and x.size(0) == 1, 'fused layers only decode one step at a time'
+        # Time(1) x Batch x Channel -> Batch x Channel
+        x = x[0]
+        bsz = x.size(0)
+
+        residual = x
+        x = self.maybe_layer_norm(0, x, before=True)
+        q, k, v = self.self_attn.in_proj_qkv(x)
+        k, v = incremental_state.cache((self, 'self'), utils.HeadMajorKVCache).append(self.heads(k), self.heads(v))
+        x = F.scaled_dot_product_attention(self.heads(q), k, v, scale=self.scaling).view(bsz, self.embed_dim)
+        x = residual + self.self_attn.out_proj(x)
+        x = self.maybe_layer_norm(0, x, after=True)
+
+        residual = x
+        x = self.maybe_layer_norm(1, x, before=True)
+        q = self.cond_att.in_proj_q(x)
+        cache = incremental_state.cache((self, 'memory'), utils.HeadMajorKVCache)
+        # True where attending is allowed
+        attn_mask = None if memory_mask is None else ~memory_mask.bool().view(bsz, 1, 1, -1)
+        x = F.scaled_dot_product_attention(self.heads(q), cache.key, cache.value, attn_mask=attn_mask,
+                                           scale=self.scaling).view(bsz, self.embed_dim)
+        x = residual + self.cond_att.out_proj(x)
+        x = self.maybe_layer_norm(1, x, after=True)
+
+        residual = x
+        x = self.maybe_layer_norm(-1, x, before=True)
+        x = residual + self.fc2(F.relu(self.fc1(x)))
+        x = self.maybe_layer_norm(-1, x, after=True)
+
+        if self.use_last_ln:
+            x = self.last_ln(x)
+
+        return x.unsqueeze(0)
+
+    def maybe_layer_norm(self, i, x, before=False, after=False):
+        assert before ^ after
+        if after ^ self.normalize_before:
+            return self.layer_norms[i](x)
+        else:
+            return x
+
+    def precompute_static_kv(self, memory, incremental_state):
+        """Keys/values of the memory (Time x Batch x Channel), as Batch x Heads x Time x Head_dim"""
+        k, v = self.cond_att.in_proj_kv(memory)
+        src_len, bsz, _ = memory.size()
+        k = k.reshape(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3).contiguous()
+        v = v.reshape(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3).contiguous()
+        incremental_state.cache((self, 'memory'), utils.HeadMajorKVCache).set_static(k, v)
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        incremental_state.cache((self, 'self'), utils.HeadMajorKVCache).reorder(new_order)
+
 class DecoderTransformer(nn.Module):
     """Transformer decoder."""
 
@@ -267,8 +350,13 @@ class DecoderTransformer(nn.Module):
 
         self.linear = Linear(embed_size, vocab_size-1)
 
-    def forward(self, ingr_features, ingr_mask, captions, img_features, incremental_state=None):
+    def prepare_memory(self, ingr_features, ingr_mask, img_features):
+        """Encoder outputs attended by every layer (Time x Batch x Channel) and their padding mask.
 
+        When both are given, the image and ingredient features are concatenated so each layer attends to them
+        with a single attention call. The result does not change while decoding, so it is computed once per
+        request rather than at every step.
+        """
         if ingr_features is not None:
             ingr_features = ingr_features.permute(0, 2, 1)
             ingr_features = ingr_features.transpose(0, 1)
@@ -284,6 +372,33 @@ class DecoderTransformer(nn.Module):
         if ingr_mask is not None:
             ingr_mask = (1-ingr_mask.squeeze(1)).byte()
 
+        if ingr_features is None:
+            return img_features, None
+        elif img_features is None:
+            return ingr_features, ingr_mask
+        memory = torch.cat((img_features, ingr_features), 0)
+        memory_mask = torch.cat((torch.zeros(img_features.shape[1], img_features.shape[0], dtype=torch.uint8,
+                                             device=ingr_mask.device), ingr_mask), 1)
+        return memory, memory_mask
+
+    def precompute_static_kv(self, memory, incremental_state):
+        """Project the encoder outputs to keys/values of every layer once, for the whole decoding"""
+        for layer in self.layers:
+            layer.precompute_static_kv(memory, incremental_state)
+
+    def fuse(self):
+        """Replace the layers by FusedDecoderLayer, in place. The decoder can then only be used to sample."""
+        self.layers = nn.ModuleList([layer if isinstance(layer, FusedDecoderLayer) else FusedDecoderLayer(layer)
+                                     for layer in self.layers])
+        self.eval()
+        return self
+
+    def forward(self, ingr_features, ingr_mask, captions, img_features, incremental_state=None):
+        memory, memory_mask = self.prepare_memory(ingr_features, ingr_mask, img_features)
+        return self.decode(captions, memory, memory_mask, incremental_state)
+
+    def decode(self, captions, memory, memory_mask, incremental_state=None):
+
         # embed positions
         if self.embed_positions is not None:
             positions = self.embed_positions(captions, incremental_state=incremental_state)
@@ -309,10 +424,9 @@ class DecoderTransformer(nn.Module):
         for p, layer in enumerate(self.layers):
             x  = layer(
                 x,
-                ingr_features,
-                ingr_mask,
+                memory,
+                memory_mask,
                 incremental_state,
-                img_features
             )
             
         # T x B x C -> B x T x C
@@ -325,9 +439,19 @@ class DecoderTransformer(nn.Module):
 
     def sample(self, ingr_features, ingr_mask, greedy=True, temperature=1.0, beam=-1,
                img_features=None, first_token_value=0,
-               replacement=True, last_token_value=0):
-
-        incremental_state = {}
+               replacement=True, last_token_value=0, length_penalty=0.0, incremental_state=None,
+               early_exit=True, step_callback=None):
+        """Greedy or top-k sampling (or beam search when beam != -1).
+
+        With early_exit, rows that emitted last_token_value after their first step are dropped from the decoded
+        batch and decoding stops once every row has finished. Their remaining ids are filled with
+        last_token_value and their remaining logits with zeros, so the outputs keep a fixed (batch x seq_length)
+        shape. Beam search stops once no alive beam can beat the finished ones.
+        step_callback(step, rows, ids) is called after every step with the ids sampled for the rows of the batch
+        still being decoded (not with beam search).
+        """
+        if incremental_state is None:
+            incremental_state = utils.IncrementalState(self.seq_length)
 
         # create dummy previous word
         if ingr_features is not None:
@@ -336,37 +460,33 @@ class DecoderTransformer(nn.Module):
             fs = img_features.size(0)
 
         if beam != -1:
-            if fs == 1:
-                return self.sample_beam(ingr_features, ingr_mask, beam, img_features, first_token_value,
-                                        replacement, last_token_value)
-            else:
-                print ("Beam Search can only be used with batch size of 1. Running greedy or temperature sampling...")
+            return self.sample_beam(ingr_features, ingr_mask, beam, img_features, first_token_value,
+                                    replacement, last_token_value, length_penalty, incremental_state, early_exit)
+
+        memory, memory_mask = self.prepare_memory(ingr_features, ingr_mask, img_features)
+        self.precompute_static_kv(memory, incremental_state)
 
         first_word = torch.ones(fs)*first_token_value
 
         first_word = first_word.to(device).long()
-        sampled_ids = [first_word]
-        logits = []
+        captions = first_word.unsqueeze(1)
+        sampled_ids = torch.ones(fs, self.seq_length).to(device).long() * last_token_value
+        logits = torch.zeros(fs, self.seq_length, self.linear.out_features).to(device)
+        # rows of the output still being decoded
+        active = torch.arange(fs).to(device)
+        if not replacement:
+            # -inf at the ids each row already sampled
+            predicted_mask = torch.zeros(fs, self.linear.out_features).to(device)
 
         for i in range(self.seq_length):
             # forward
-            outputs, _ = self.forward(ingr_features, ingr_mask, torch.stack(sampled_ids, 1),
-                                      img_features, incremental_state)
+            outputs, _ = self.decode(captions, memory, memory_mask, incremental_state)
             outputs = outputs.squeeze(1)
             if not replacement:
-                # predicted mask
-                if i == 0:
-                    predicted_mask = torch.zeros(outputs.shape).float().to(device)
-                else:
-                    # ensure no repetitions in sampling if replacement==False
-                    batch_ind = [j for j in range(fs) if sampled_ids[i][j] != 0]
-                    sampled_ids_new = sampled_ids[i][batch_ind]
-                    predicted_mask[batch_ind, sampled_ids_new] = float('-inf')
-
                 # mask previously selected ids
                 outputs += predicted_mask
 
-            logits.append(outputs)
+            logits[active, i] = outputs
             if greedy:
                 outputs_prob = torch.nn.functional.softmax(outputs, dim=-1)
                 _, predicted = outputs_prob.max(1)
@@ -378,86 +498,142 @@ class DecoderTransformer(nn.Module):
 
                 # top k random sampling
                 prob_prev_topk, indices = torch.topk(outputs_prob, k=k, dim=1)
-                predicted = torch.multinomial(prob_prev_topk, 1).view(-1)
-                predicted = torch.index_select(indices, dim=1, index=predicted)[:, 0].detach()
+                predicted = torch.multinomial(prob_prev_topk, 1)
+                predicted = torch.gather(indices, 1, predicted)[:, 0].detach()
 
-            sampled_ids.append(predicted)
-
-        sampled_ids = torch.stack(sampled_ids[1:], 1)
-        logits = torch.stack(logits, 1)
+            sampled_ids[active, i] = predicted
+            if step_callback is not None:
+                step_callback(i, active, predicted)
+            if not replacement:
+                # ensure no repetitions in sampling if replacement==False
+                mask_repetitions(predicted_mask, predicted)
+            captions = torch.cat((captions, predicted.unsqueeze(1)), 1)
+            incremental_state.num_steps += 1
+            incremental_state.num_row_steps += captions.size(0)
+
+            # a row starting with last_token_value keeps decoding: mask_from_eos always keeps the first position
+            if early_exit and i > 0:
+                finished = predicted == last_token_value
+                if finished.all():
+                    break
+                if finished.any():
+                    # only keep decoding the unfinished rows
+                    keep = (~finished).nonzero().squeeze(1)
+                    active = active[keep]
+                    captions = captions[keep]
+                    memory = memory.index_select(1, keep)
+                    if memory_mask is not None:
+                        memory_mask = memory_mask[keep]
+                    incremental_state.reorder(keep)
+                    if not replacement:
+                        predicted_mask = predicted_mask[keep]
 
         return sampled_ids, logits
 
     def sample_beam(self, ingr_features, ingr_mask, beam=3, img_features=None, first_token_value=0,
-                   replacement=True, last_token_value=0):
+                    replacement=True, last_token_value=0, length_penalty=0.0, incremental_state=None,
+                    early_exit=True):
+        """Beam search for every element of the batch at once.
+
+        The beams of all batch elements are folded into the batch dimension, so each step is a single forward
+        pass. As in the sequential search, each hypothesis is extended with its own k most likely tokens: an
+        <end> among them finishes it, and the k best of the others over all beams stay alive. Hypotheses are
+        ranked by their summed log-probability divided by length ** length_penalty. With early_exit, decoding
+        stops as soon as no alive beam can beat the finished ones of its batch element, otherwise it runs for
+        seq_length steps.
+        """
         k = beam
-        alpha = 0.0
-        # create dummy previous word
         if ingr_features is not None:
             fs = ingr_features.size(0)
         else:
             fs = img_features.size(0)
-        first_word = torch.ones(fs)*first_token_value
-
-        first_word = first_word.to(device).long()
 
-        sequences = [[[first_word], 0, {}, False, 1]]
-        finished = []
+        if incremental_state is None:
+            incremental_state = utils.IncrementalState(self.seq_length)
+
+        # project the encoder outputs once per batch element and share them between its beams
+        memory, memory_mask = self.prepare_memory(ingr_features, ingr_mask, img_features)
+        self.precompute_static_kv(memory, incremental_state)
+        expand_order = torch.arange(fs).to(device).repeat_interleave(k)
+        incremental_state.reorder(expand_order)
+        memory = memory.index_select(1, expand_order)
+        if memory_mask is not None:
+            memory_mask = memory_mask.index_select(0, expand_order)
+
+        tokens = torch.ones(fs * k, 1).to(device).long() * first_token_value
+        # all beams start with the same token, only keep the first one alive for the first step
+        scores = torch.zeros(fs, k).to(device)
+        scores[:, 1:] = float('-inf')
+        beam_offsets = (torch.arange(fs).to(device) * k).unsqueeze(1)
+
+        finished_tokens = torch.ones(fs, k, self.seq_length).to(device).long() * last_token_value
+        finished_scores = torch.ones(fs, k).to(device) * float('-inf')
+        finished_lengths = torch.zeros(fs, k).to(device).long()
+        done = torch.zeros(fs).to(device).bool()
+        if not replacement:
+            # -inf at the ids each beam already sampled
+            predicted_mask = torch.zeros(fs * k, self.linear.out_features).to(device)
 
         for i in range(self.seq_length):
             # forward
-            all_candidates = []
-            for rem in range(len(sequences)):
-                incremental = sequences[rem][2]
-                outputs, _ = self.forward(ingr_features, ingr_mask, torch.stack(sequences[rem][0], 1),
-                                          img_features, incremental)
-                outputs = outputs.squeeze(1)
-                if not replacement:
-                    # predicted mask
-                    if i == 0:
-                        predicted_mask = torch.zeros(outputs.shape).float().to(device)
-                    else:
-                        # ensure no repetitions in sampling if replacement==False
-                        batch_ind = [j for j in range(fs) if sequences[rem][0][i][j] != 0]
-                        sampled_ids_new = sequences[rem][0][i][batch_ind]
-                        predicted_mask[batch_ind, sampled_ids_new] = float('-inf')
-
-                    # mask previously selected ids
-                    outputs += predicted_mask
-
-                outputs_prob = torch.nn.functional.log_softmax(outputs, dim=-1)
-                probs, indices = torch.topk(outputs_prob, beam)
-                # tokens is [batch x beam ] and every element is a list
-                # score is [ batch x beam ] and every element is a scalar
-                # incremental is [batch x beam ] and every element is a dict
-
-
-                for bid in range(beam):
-                    tokens = sequences[rem][0] + [indices[:, bid]]
-                    score = sequences[rem][1] + probs[:, bid].squeeze().item()
-                    if indices[:,bid].item() == last_token_value:
-                        finished.append([tokens, score, None, True, sequences[rem][-1] + 1])
-                    else:
-                        all_candidates.append([tokens, score, incremental, False, sequences[rem][-1] + 1])
-
-            # if all the top-k scoring beams have finished, we can return them
-            ordered_all = sorted(all_candidates + finished, key=lambda tup: tup[1]/(np.power(tup[-1],alpha)),
-                                 reverse=True)[:k]
-            if all(el[-1] == True for el in ordered_all):
-                all_candidates = []
-
-            # order all candidates by score
-            ordered = sorted(all_candidates, key=lambda tup: tup[1]/(np.power(tup[-1],alpha)), reverse=True)
-            # select k best
-            sequences = ordered[:k]
-            finished = sorted(finished,  key=lambda tup: tup[1]/(np.power(tup[-1],alpha)), reverse=True)[:k]
-
-        if len(finished) != 0:
-            sampled_ids = torch.stack(finished[0][0][1:], 1)
-            logits = finished[0][1]
-        else:
-            sampled_ids = torch.stack(sequences[0][0][1:], 1)
-            logits = sequences[0][1]
+            outputs, _ = self.decode(tokens, memory, memory_mask, incremental_state)
+            outputs = outputs.squeeze(1)
+            if not replacement:
+                # mask previously selected ids
+                outputs = outputs + predicted_mask
+
+            lprobs = torch.nn.functional.log_softmax(outputs, dim=-1)
+            # every hypothesis is only extended with its k most likely tokens, it ends here when <end> is one of them
+            cand_lprobs, cand_tokens = lprobs.topk(k, dim=1)
+            cand_scores = scores.view(-1, 1) + cand_lprobs
+            is_eos = cand_tokens == last_token_value
+            # length of the hypotheses after this step, counting the first token
+            length = i + 2
+
+            # hypotheses ending at this step compete with the already finished ones
+            eos_scores = cand_scores.masked_fill(~is_eos, float('-inf')).max(1)[0].view(fs, k)
+            eos_scores = eos_scores / (length ** length_penalty)
+            eos_scores = eos_scores.masked_fill(done.unsqueeze(1), float('-inf'))
+            eos_tokens = torch.ones(fs * k, self.seq_length).to(device).long() * last_token_value
+            eos_tokens[:, :i] = tokens[:, 1:]
+            finished_scores, best = torch.cat((finished_scores, eos_scores), 1).topk(k, dim=1)
+            finished_tokens = torch.cat((finished_tokens, eos_tokens.view(fs, k, -1)), 1).gather(
+                1, best.unsqueeze(2).expand(-1, -1, self.seq_length))
+            finished_lengths = torch.cat((finished_lengths, torch.ones(fs, k).to(device).long() * (i + 1)),
+                                         1).gather(1, best)
+
+            # the rest of the candidates keep decoding
+            cand_scores = cand_scores.masked_fill(is_eos, float('-inf'))
+            scores, indices = cand_scores.view(fs, k * k).topk(k, dim=1)
+            new_order = (beam_offsets + indices // k).view(-1)
+            new_tokens = cand_tokens.view(fs, k * k).gather(1, indices)
+            tokens = torch.cat((tokens.index_select(0, new_order), new_tokens.view(-1, 1)), 1)
+            for layer in self.layers:
+                layer.reorder_incremental_state(incremental_state, new_order)
+            if not replacement:
+                # each beam inherits the mask of the hypothesis it extends
+                predicted_mask = mask_repetitions(predicted_mask.index_select(0, new_order), tokens[:, -1])
+
+            if early_exit:
+                # a batch element is done when its k-th finished hypothesis beats all the alive ones. Scores only
+                # decrease as hypotheses grow, but with length_penalty > 0 so does their normalization: alive
+                # scores are bounded with the longest length they can reach
+                max_length = self.seq_length + 1 if length_penalty > 0 else length
+                best_alive, _ = (scores / (max_length ** length_penalty)).max(1)
+                done = done | (finished_scores[:, -1] >= best_alive)
+                if done.all():
+                    break
+
+        # best finished hypothesis, or best alive one for batch elements where none finished
+        alive_scores, alive_best = (scores / (tokens.size(1) ** length_penalty)).max(1)
+        has_finished = finished_scores[:, 0] > float('-inf')
+
+        sampled_ids = finished_tokens[:, 0]
+        sampled_ids[~has_finished, :tokens.size(1) - 1] = tokens[(beam_offsets.squeeze(1) + alive_best)[~has_finished], 1:]
+        lengths = torch.where(has_finished, finished_lengths[:, 0], torch.ones_like(alive_best) * (tokens.size(1) - 1))
+        logits = torch.where(has_finished, finished_scores[:, 0], alive_scores)
+
+        sampled_ids = sampled_ids[:, :lengths.max().item()]
         return sampled_ids, logits
 
     def max_positions(self):
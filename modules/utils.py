@@ -219,6 +219,127 @@ def set_incremental_state(module, incremental_state, key, value):
         incremental_state[full_key] = value
 
 
+class KVCache(object):
+    """Keys and values of one attention module during incremental decoding.
+
+    Buffers are allocated once for `capacity` time steps (Time x Batch x Channel) and every decoding step
+    writes its keys/values in place at the current step index, instead of concatenating with the previous
+    ones. Static caches hold the projected encoder outputs, which do not change between steps.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.key = None
+        self.value = None
+        self.length = 0
+        self.static = False
+        self.num_projections = 0
+        self._spare = None
+
+    def append(self, k, v):
+        """Write the keys/values of the new time steps and return the ones of all steps so far"""
+        if self.key is None:
+            self.key = k.new_empty((self.capacity,) + k.shape[1:])
+            self.value = v.new_empty((self.capacity,) + v.shape[1:])
+        end = self.length + k.size(0)
+        assert end <= self.capacity, 'kv cache capacity exceeded'
+        self.key[self.length:end] = k
+        self.value[self.length:end] = v
+        self.length = end
+        return self.key[:end], self.value[:end]
+
+    def set_static(self, k, v):
+        self.key = k
+        self.value = v
+        self.length = k.size(0)
+        self.static = True
+        self.num_projections += 1
+
+    def reorder(self, new_order):
+        """Select/reorder the batch dimension, e.g. to follow the surviving hypotheses in beam search"""
+        if self.key is None:
+            return
+        if self.static:
+            self.key = self.key.index_select(1, new_order)
+            self.value = self.value.index_select(1, new_order)
+            return
+        if self._spare is None or self._spare[0].size(1) != new_order.numel():
+            shape = (self.capacity, new_order.numel()) + self.key.shape[2:]
+            self._spare = (self.key.new_empty(shape), self.value.new_empty(shape))
+        key, value = self._spare
+        torch.index_select(self.key[:self.length], 1, new_order, out=key[:self.length])
+        torch.index_select(self.value[:self.length], 1, new_order, out=value[:self.length])
+        # the previous buffers are reused by the next reorder
+        if self.key.size(1) == new_order.numel():
+            self._spare = (self.key, self.value)
+        else:
+            self._spare = None
+        self.key, self.value = key, value
+
+    def nbytes(self):
+        tensors = [self.key, self.value] + list(self._spare or [])
+        return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class HeadMajorKVCache(KVCache):
+    """KVCache holding keys/values as Batch x Heads x Time x Head_dim, the layout the attention kernel reads,
+    so decoding steps do not reshape the whole cache."""
+
+    def append(self, k, v):
+        if self.key is None:
+            self.key = k.new_empty(k.shape[:2] + (self.capacity,) + k.shape[3:])
+            self.value = v.new_empty(v.shape[:2] + (self.capacity,) + v.shape[3:])
+        end = self.length + k.size(2)
+        assert end <= self.capacity, 'kv cache capacity exceeded'
+        self.key[:, :, self.length:end] = k
+        self.value[:, :, self.length:end] = v
+        self.length = end
+        return self.key[:, :, :end], self.value[:, :, :end]
+
+    def reorder(self, new_order):
+        if self.key is None:
+            return
+        self.key = self.key.index_select(0, new_order)
+        self.value = self.value.index_select(0, new_order)
+
+
+class IncrementalState(object):
+    """Incremental decoding state of a decoder: one KVCache per attention module."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.caches = {}
+        # decoding steps run, and rows decoded summed over those steps
+        self.num_steps = 0
+        self.num_row_steps = 0
+
+    def cache(self, module, cache_class=KVCache):
+        cache = self.caches.get(module)
+        if cache is None:
+            cache = self.caches[module] = cache_class(self.capacity)
+        return cache
+
+    def reorder(self, new_order):
+        for cache in self.caches.values():
+            cache.reorder(new_order)
+
+    def nbytes(self):
+        """Bytes held by the key/value buffers of all the attention modules"""
+        return sum(cache.nbytes() for cache in self.caches.values())
+
+    def stats(self):
+        """Profiling counters: cached bytes, how many times encoder outputs were projected to keys/values and
+        how many steps (and rows x steps) were decoded"""
+        static = [cache for cache in self.caches.values() if cache.static]
+        return {
+            'cache_bytes': self.nbytes(),
+            'static_kv_modules': len(static),
+            'static_kv_projections': sum(cache.num_projections for cache in static),
+            'steps': self.num_steps,
+            'row_steps': self.num_row_steps,
+        }
+
+
 def load_align_dict(replace_unk):
     if replace_unk is None:
         align_dict = None
@@ -3,7 +3,7 @@ from click import prompt
 from components.logo import add_logo_with_rotating_text
 from home.nutrition_meal import analyze_ingredients_nutrition, render_meal_planning_main, render_nutrition_analysis_main
 from home.styles import  load_custom_css
-from home.utils import calculate_nutrition, display_recipe_card, load_lottie_url, predict_from_image
+from home.utils import calculate_nutrition, display_recipe_card, load_lottie_url, stream_from_image
 import streamlit as st
 from utils.text_generator import load_text_generator
 
@@ -22,6 +22,7 @@ from chef_transformer import dummy, meta
 import os
 import re
 from utils.utils import pure_comma_separation
+from utils.output_utils import prettify, replace_dict
 import json
 import streamlit.components.v1 as components
 
@@ -1001,21 +1002,51 @@ def render_image_upload_section():
         type=["jpg", "jpeg", "png"],
         help="For best results, use a well-lit, clear image of the food",
     )
+    keep_image = st.checkbox("Save the uploaded image", value=False)
 
     if uploaded_file:
-        with st.spinner("🔍 Analyzing your delicious image..."):
-            title, ingredients, recipe, image_path = predict_from_image(uploaded_file)
+        result = render_prediction_stream(stream_from_image(uploaded_file, keep_image=keep_image))
 
-            if title is None or ingredients is None or recipe is None:
-                st.error("Unable to analyze the image. Please try another one!")
-            else:
-                handle_recipe_generation(title, ingredients, recipe, image_path)
+        if result is None:
+            st.error("Unable to analyze the image. Please try another one!")
+        else:
+            handle_recipe_generation(result["title"], result["ingredients"], result["recipe"], result["image"])
 
     st.markdown("</div>", unsafe_allow_html=True)
 
 from utils.text_generator import chef_top, chef_beam, load_text_generator
 
 
+def render_prediction_stream(events):
+    """Show the ingredients and the recipe words as the model decodes them, returns the final 'done' event
+    (None on error) once the placeholders are cleared"""
+    status = st.empty()
+    status.markdown("### 🔍 Analyzing your delicious image...")
+    ingredients_box = st.empty()
+    recipe_box = st.empty()
+    ingredients, words = [], []
+
+    for event in events:
+        if event["type"] == "ingredient":
+            ingredients.append(event["text"])
+            ingredients_box.markdown("## Ingredients\n" + "\n".join([f"* {ing}" for ing in ingredients]))
+        elif event["type"] == "token":
+            status.markdown("### Your Recipe is Being Written...")
+            words.append(event["text"])
+            sentences = prettify(words, replace_dict)
+            if sentences:
+                steps = "\n".join([f"{i+1}. {step}" for i, step in enumerate(sentences[1:])])
+                recipe_box.markdown(f"# {sentences[0]}\n\n## Instructions\n{steps}")
+        else:
+            for placeholder in (status, ingredients_box, recipe_box):
+                placeholder.empty()
+            if event["type"] == "error":
+                st.error(f"Error processing image: {event['message']}")
+                return None
+            return event
+    return None
+
+
 def render_ingredient_input_section():
     st.markdown('<div class="ingredient-input-section">', unsafe_allow_html=True)
     chef_col1, chef_col2 = st.columns([2, 1])
@@ -2,6 +2,7 @@
 import streamlit as st
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 from pages.widgets import __login__
+from utils.artifacts import resolve
 import requests
 from bs4 import BeautifulSoup
 import random
@@ -25,9 +26,9 @@ login_ui.nav_sidebar()
 @st.cache_resource
 def load_model_and_tokenizer():
     try:
-        model_name = "google/flan-t5-base"
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        model_path = resolve("flan-t5-base")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
         return tokenizer, model
     except Exception as e:
         st.error(f"Error loading model: {str(e)}")
@@ -6,9 +6,6 @@ import sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
-# Disable TensorFlow logging
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-
 # Page configuration
 st.set_page_config(
     page_title="Be My Chef AI - Recipe Generator",
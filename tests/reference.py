@@ -0,0 +1,313 @@
+"""Reference implementations the optimized code is checked against, and the helpers comparing them, shared by
+the tests and the benchmarks."""
+import contextlib
+import copy
+import types
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import modules.utils as utils
+from modules.multihead_attention import MultiheadAttention
+from modules.transformer_decoder import LearnedPositionalEmbedding, SinusoidalPositionalEmbedding, make_positions
+
+# image features (49) followed by ingredient features (20), as attended by the recipe decoder
+MEMORY_LENGTH = 49 + 20
+
+
+def memory_inputs(batch_size, embed_size):
+    memory = torch.randn(MEMORY_LENGTH, batch_size, embed_size)
+    memory_mask = torch.zeros(batch_size, MEMORY_LENGTH, dtype=torch.uint8)
+    for i in range(batch_size):
+        # a random number of ingredients, the rest is padding
+        memory_mask[i, 49 + np.random.randint(1, 21):] = 1
+    return memory, memory_mask
+
+
+@contextlib.contextmanager
+def attention_weights(module):
+    """Force every attention of module on the need_weights=True path"""
+    def forward(self, *args, **kwargs):
+        kwargs['need_weights'] = True
+        return MultiheadAttention.forward(self, *args, **kwargs)
+
+    layers = [m for m in module.modules() if isinstance(m, MultiheadAttention)]
+    for layer in layers:
+        layer.forward = types.MethodType(forward, layer)
+    try:
+        yield
+    finally:
+        for layer in layers:
+            del layer.forward
+
+
+def compare(attn, need_weights_kwargs):
+    """Max abs difference between the outputs of the two paths for the same call"""
+    with torch.no_grad():
+        reference, _ = attn(need_weights=True, **need_weights_kwargs())
+        fused, weights = attn(need_weights=False, **need_weights_kwargs())
+    assert weights is None
+    return (reference - fused).abs().max().item()
+
+
+def self_state(attn, x, length):
+    """Incremental state with the self-attention keys/values of the first `length` steps of x cached"""
+    state = utils.IncrementalState(length + 1)
+    with torch.no_grad():
+        for t in range(length):
+            attn(query=x[t:t + 1], key=x[t:t + 1], value=x[t:t + 1], incremental_state=state, need_weights=False)
+    return state
+
+
+def memory_state(attn, memory):
+    """Incremental state with the keys/values of the memory precomputed"""
+    state = utils.IncrementalState(1)
+    with torch.no_grad():
+        attn.precompute_static_kv(memory, state)
+    return state
+
+
+def legacy_learned_forward(self, input, incremental_state=None):
+    if incremental_state is not None:
+        positions = input.data.new(1, 1).fill_(self.padding_idx + input.size(1))
+    else:
+        positions = make_positions(input.data, self.padding_idx, self.left_pad)
+    return nn.Embedding.forward(self, positions)
+
+
+def legacy_sinusoidal_forward(self, input, incremental_state=None):
+    bsz, seq_len = input.size()
+    max_pos = self.padding_idx + 1 + seq_len
+    weights = self.legacy_weights
+    if weights is None or max_pos > weights.size(0):
+        weights = SinusoidalPositionalEmbedding.get_embedding(max_pos, self.embedding_dim, self.padding_idx)
+    weights = self.legacy_weights = weights.type_as(self._float_tensor)
+
+    if incremental_state is not None:
+        return weights[self.padding_idx + seq_len, :].expand(bsz, 1, -1)
+
+    positions = make_positions(input.data, self.padding_idx, self.left_pad)
+    return weights.index_select(0, positions.view(-1)).view(bsz, seq_len, -1).detach()
+
+
+@contextlib.contextmanager
+def legacy(module):
+    """Run the positional embeddings of module with their previous forward"""
+    embeddings = [m for m in module.modules()
+                  if isinstance(m, (LearnedPositionalEmbedding, SinusoidalPositionalEmbedding))]
+    for m in embeddings:
+        if isinstance(m, LearnedPositionalEmbedding):
+            m.forward = types.MethodType(legacy_learned_forward, m)
+        else:
+            m.legacy_weights = None
+            m.forward = types.MethodType(legacy_sinusoidal_forward, m)
+    try:
+        yield
+    finally:
+        for m in embeddings:
+            del m.forward
+
+
+def embedding_parity(embed_positions, batch_size, steps, vocab_size):
+    """Max abs difference over every incremental step and over a right-padded batch"""
+    diff = 0.
+    captions = torch.randint(1, vocab_size, (batch_size, steps))
+    state = utils.IncrementalState(steps)
+    with torch.no_grad():
+        for i in range(1, steps + 1):
+            new = embed_positions(captions[:, :i], incremental_state=state)
+            with legacy(embed_positions):
+                old = embed_positions(captions[:, :i], incremental_state=state)
+            diff = max(diff, (new - old).abs().max().item())
+
+        for i in range(batch_size):
+            # padding (id 0, the padding_idx of the positions) at the end of the rows
+            captions[i, np.random.randint(1, steps + 1):] = 0
+        new = embed_positions(captions)
+        with legacy(embed_positions):
+            old = embed_positions(captions)
+    return max(diff, (new - old).abs().max().item())
+
+
+def copy_state(incremental_state):
+    copy_ = utils.IncrementalState(incremental_state.capacity)
+    copy_.caches = {module: copy.deepcopy(cache) for module, cache in incremental_state.caches.items()}
+    return copy_
+
+
+def legacy_sample_beam(decoder, ingr_features, ingr_mask, beam=3, img_features=None, first_token_value=0,
+                       replacement=True, last_token_value=0, share_cache=True):
+    """Beam search as it was implemented before being vectorized (batch size 1 only).
+
+    The children of a hypothesis share its cache, so they also attend to the keys/values of their siblings.
+    With share_cache=False every child gets its own copy of the cache of its parent instead.
+    """
+    k = beam
+    alpha = 0.0
+    fs = img_features.size(0)
+    first_word = torch.ones(fs).long() * first_token_value
+
+    # children of a beam share its state, so the cache grows by up to `beam` entries per step
+    sequences = [[[first_word], 0, utils.IncrementalState(decoder.seq_length * beam), False, 1]]
+    finished = []
+
+    for i in range(decoder.seq_length):
+        all_candidates = []
+        for rem in range(len(sequences)):
+            incremental = sequences[rem][2]
+            outputs, _ = decoder.forward(ingr_features, ingr_mask, torch.stack(sequences[rem][0], 1),
+                                         img_features, incremental)
+            outputs = outputs.squeeze(1)
+            outputs_prob = torch.nn.functional.log_softmax(outputs, dim=-1)
+            probs, indices = torch.topk(outputs_prob, beam)
+
+            for bid in range(beam):
+                tokens = sequences[rem][0] + [indices[:, bid]]
+                score = sequences[rem][1] + probs[:, bid].squeeze().item()
+                if indices[:, bid].item() == last_token_value:
+                    finished.append([tokens, score, None, True, sequences[rem][-1] + 1])
+                else:
+                    all_candidates.append([tokens, score, incremental if share_cache else copy_state(incremental),
+                                           False, sequences[rem][-1] + 1])
+
+        ordered_all = sorted(all_candidates + finished, key=lambda tup: tup[1] / (np.power(tup[-1], alpha)),
+                             reverse=True)[:k]
+        if all(el[-1] == True for el in ordered_all):
+            all_candidates = []
+
+        ordered = sorted(all_candidates, key=lambda tup: tup[1] / (np.power(tup[-1], alpha)), reverse=True)
+        sequences = ordered[:k]
+        finished = sorted(finished, key=lambda tup: tup[1] / (np.power(tup[-1], alpha)), reverse=True)[:k]
+
+    if len(finished) != 0:
+        return torch.stack(finished[0][0][1:], 1), finished[0][1]
+    return torch.stack(sequences[0][0][1:], 1), sequences[0][1]
+
+
+def legacy_label2onehot(labels, pad_value):
+    inp_ = torch.unsqueeze(labels, 2)
+    one_hot = torch.FloatTensor(labels.size(0), labels.size(1), pad_value + 1).zero_().to(labels.device)
+    one_hot.scatter_(2, inp_, 1)
+    one_hot, _ = one_hot.max(dim=1)
+    one_hot = one_hot[:, :-1]
+    one_hot[:, 0] = 0
+    return one_hot
+
+
+def legacy_mask_from_eos(ids, eos_value, mult_before=True):
+    mask = torch.ones(ids.size()).to(ids.device).byte()
+    mask_aux = torch.ones(ids.size(0)).to(ids.device).byte()
+    for idx in range(ids.size(1)):
+        if idx == 0:
+            continue
+        if mult_before:
+            mask[:, idx] = mask[:, idx] * mask_aux
+            mask_aux = mask_aux * (ids[:, idx] != eos_value)
+        else:
+            mask_aux = mask_aux * (ids[:, idx] != eos_value)
+            mask[:, idx] = mask[:, idx] * mask_aux
+    return mask
+
+
+def random_ids(batch_size, length, vocab_size):
+    """Ingredient-like ids: a random number of labels followed by eos (0) and padding (vocab_size)"""
+    ids = torch.randint(1, vocab_size, (batch_size, length))
+    lengths = torch.randint(0, length, (batch_size,))
+    positions = torch.arange(length).unsqueeze(0)
+    ids[positions == lengths.unsqueeze(1)] = 0
+    ids[positions > lengths.unsqueeze(1)] = vocab_size
+    # some sequences start with eos
+    ids[::7, 0] = 0
+    return ids
+
+
+legacy_replace_dict = {' .': '.', ' ,': ',', ' ;': ';', ' :': ':', '( ': '(', ' )': ')', " '": "'"}
+
+
+def legacy_prettify(toks, replace_dict):
+    toks = ' '.join(toks)
+    toks = toks.split('<end>')[0]
+    sentences = toks.split('<eoi>')
+    pretty_sentences = []
+    for sentence in sentences:
+        sentence = sentence.strip()
+        sentence = sentence.capitalize()
+        for k, v in replace_dict.items():
+            sentence = sentence.replace(k, v)
+        if sentence != '':
+            pretty_sentences.append(sentence)
+    return pretty_sentences
+
+
+def legacy_prepare_output(ids, gen_ingrs, ingr_vocab_list, vocab):
+    toks = [vocab[id_] for id_ in ids]
+    is_valid = True
+    reason = 'All ok.'
+    try:
+        cut = toks.index('<end>')
+        toks_trunc = toks[0:cut]
+    except ValueError:
+        toks_trunc = toks
+        is_valid = False
+        reason = 'no eos found'
+
+    score = float(len(set(toks_trunc))) / float(len(toks_trunc))
+
+    prev_word = ''
+    found_repeat = False
+    for word in toks_trunc:
+        if prev_word == word and prev_word != '<eoi>':
+            found_repeat = True
+            break
+        prev_word = word
+
+    toks = legacy_prettify(toks, legacy_replace_dict)
+    title = toks[0]
+    toks = toks[1:]
+
+    gen_ingrs_list = []
+    for ingr_idx in gen_ingrs:
+        ingr_name = ingr_vocab_list[ingr_idx]
+        if ingr_name == '<pad>':
+            break
+        gen_ingrs_list.append(ingr_name)
+
+    if score <= 0.3:
+        reason = 'Diversity score.'
+        is_valid = False
+    elif len(toks) != len(set(toks)):
+        reason = 'Repeated instructions.'
+        is_valid = False
+    elif found_repeat:
+        reason = 'Found word repeat.'
+        is_valid = False
+
+    valid = {'is_valid': is_valid, 'reason': reason, 'score': score}
+    outs = {'title': title, 'recipe': toks, 'ingrs': gen_ingrs_list}
+    return outs, valid
+
+
+def random_outputs(rng, batch_size, vocab, ingrs_vocab, length=150, num_ingrs=20):
+    """Recipe ids (batch_size x length) and ingredient ids (batch_size x num_ingrs) shaped like model.sample
+    outputs"""
+    word2id = {vocab[i]: i for i in range(len(vocab))}
+    special = [word2id[w] for w in ['.', ',', '(', ')', "'", ';', ':', '<eoi>', '<eoi>', '<eoi>']]
+    common = rng.integers(3, len(vocab), 40)
+
+    ids = rng.integers(3, len(vocab), (batch_size, length))
+    choice = rng.random((batch_size, length))
+    ids[choice < 0.3] = rng.choice(special, int((choice < 0.3).sum()))
+    # a small set of frequent words, to produce repeated words and instructions
+    ids[(choice >= 0.3) & (choice < 0.6)] = rng.choice(common, int(((choice >= 0.3) & (choice < 0.6)).sum()))
+    ids[:, 0] = rng.integers(3, len(vocab), batch_size)
+    ends = rng.integers(2, length + 20, batch_size)
+    for i, end in enumerate(ends):
+        if end < length:
+            ids[i, end] = word2id['<end>']
+
+    pad = len(ingrs_vocab) - 1
+    ingr_ids = rng.integers(1, pad, (batch_size, num_ingrs))
+    for i, n in enumerate(rng.integers(0, num_ingrs + 1, batch_size)):
+        ingr_ids[i, n:] = pad
+    return ids, ingr_ids
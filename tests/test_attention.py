@@ -0,0 +1,53 @@
+"""MultiheadAttention computed by F.scaled_dot_product_attention (need_weights=False) matches the explicit
+bmm/softmax path (need_weights=True) on a tiny decoder."""
+import torch
+
+import modules.utils as utils
+from modules.multihead_attention import MultiheadAttention
+from modules.transformer_decoder import DecoderTransformer
+from tests.reference import attention_weights, compare, memory_inputs, memory_state, self_state
+
+EMBED_SIZE = 32
+NUM_HEADS = 4
+
+
+def test_attention_calls_match():
+    torch.manual_seed(0)
+    attn = MultiheadAttention(EMBED_SIZE, NUM_HEADS)
+    attn.eval()
+    x = torch.randn(6, 3, EMBED_SIZE)
+    memory, memory_mask = memory_inputs(3, EMBED_SIZE)
+    last = x[-1:]
+
+    diffs = [
+        compare(attn, lambda: dict(query=x, key=x, value=x, mask_future_timesteps=True)),
+        compare(attn, lambda: dict(query=x, key=memory, value=memory, key_padding_mask=memory_mask)),
+        compare(attn, lambda: dict(query=last, key=last, value=last, mask_future_timesteps=True,
+                                   incremental_state=self_state(attn, x, 5))),
+        compare(attn, lambda: dict(query=last, key=memory, value=memory, key_padding_mask=memory_mask,
+                                   static_kv=True, incremental_state=memory_state(attn, memory))),
+    ]
+    assert max(diffs) < 1e-5
+
+
+def test_decoder_samples_match():
+    torch.manual_seed(0)
+    decoder = DecoderTransformer(EMBED_SIZE, 20, dropout=0.0, seq_length=10, num_instrs=1,
+                                 attention_nheads=NUM_HEADS, num_layers=2)
+    decoder.eval()
+    img_features = torch.randn(2, EMBED_SIZE, 49)
+    ingr_features = torch.randn(2, EMBED_SIZE, 20)
+    ingr_mask = torch.ones(2, 1, 20)
+    ingr_mask[1, :, 5:] = 0
+
+    def sample():
+        with torch.no_grad():
+            return decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features,
+                                  first_token_value=0, last_token_value=1, early_exit=False,
+                                  incremental_state=utils.IncrementalState(10))
+
+    ids, logits = sample()
+    with attention_weights(decoder):
+        reference_ids, reference_logits = sample()
+    assert torch.equal(ids, reference_ids)
+    assert torch.allclose(logits, reference_logits, atol=1e-5)
@@ -0,0 +1,62 @@
+"""Beam search of DecoderTransformer.sample_beam on tiny random decoders, whose vocabulary is small enough for
+the end token to often be among the best candidates."""
+import pytest
+import torch
+
+from modules.transformer_decoder import DecoderTransformer
+from tests.reference import legacy_sample_beam
+
+EMBED_SIZE = 32
+
+
+def tiny_decoder(seed, vocab_size=16, seq_length=12):
+    torch.manual_seed(seed)
+    decoder = DecoderTransformer(EMBED_SIZE, vocab_size, dropout=0.0, seq_length=seq_length, num_instrs=1,
+                                 attention_nheads=4, num_layers=2)
+    decoder.eval()
+    return decoder
+
+
+def tiny_inputs(batch_size):
+    img_features = torch.randn(batch_size, EMBED_SIZE, 49)
+    ingr_features = torch.randn(batch_size, EMBED_SIZE, 20)
+    ingr_mask = torch.ones(batch_size, 1, 20)
+    return ingr_features, ingr_mask, img_features
+
+
+@pytest.mark.parametrize('beam', [3, 5])
+def test_matches_legacy(beam):
+    ended = 0
+    for seed in range(5):
+        decoder = tiny_decoder(seed)
+        ingr_features, ingr_mask, img_features = tiny_inputs(4)
+        with torch.no_grad():
+            ids, scores = decoder.sample_beam(ingr_features, ingr_mask, beam, img_features, 0, last_token_value=1)
+            for i in range(4):
+                legacy_ids, legacy_score = legacy_sample_beam(decoder, ingr_features[i:i + 1], ingr_mask[i:i + 1],
+                                                              beam, img_features[i:i + 1], 0, last_token_value=1,
+                                                              share_cache=False)
+                length = legacy_ids.size(1)
+                # shorter hypotheses are padded with the end token up to the longest one of the batch
+                assert torch.equal(ids[i, :length], legacy_ids[0]), (seed, i)
+                assert bool((ids[i, length:] == 1).all()), (seed, i)
+                assert abs(scores[i].item() - legacy_score) < 1e-4, (seed, i)
+                ended += legacy_ids[0, -1].item() == 1
+    # the end token has to be reached for the finished hypotheses to be compared at all
+    assert ended > 0
+
+
+@pytest.mark.parametrize('length_penalty', [0.0, 1.0, 2.0])
+def test_early_stop_matches_full_search(length_penalty):
+    for seed in range(10):
+        decoder = tiny_decoder(seed)
+        ingr_features, ingr_mask, img_features = tiny_inputs(4)
+        with torch.no_grad():
+            ids, scores = decoder.sample_beam(ingr_features, ingr_mask, 3, img_features, 0, last_token_value=1,
+                                              length_penalty=length_penalty)
+            full_ids, full_scores = decoder.sample_beam(ingr_features, ingr_mask, 3, img_features, 0,
+                                                        last_token_value=1, length_penalty=length_penalty,
+                                                        early_exit=False)
+        assert torch.equal(ids, full_ids[:, :ids.size(1)]), seed
+        assert bool((full_ids[:, ids.size(1):] == 1).all()), seed
+        assert torch.allclose(scores, full_scores), seed
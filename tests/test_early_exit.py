@@ -0,0 +1,72 @@
+"""Greedy decoding with early exit gives the ids and logits of the full decoding up to the end token of every
+row (the positions mask_from_eos keeps), on tiny random decoders."""
+import pytest
+import torch
+
+import modules.utils as utils
+from Foodimg2Ing.model import mask_from_eos
+from modules.transformer_decoder import DecoderTransformer
+
+EMBED_SIZE = 32
+VOCAB_SIZE = 20
+STEPS = 15
+
+
+def eos_bias(decoder, eos_value, bias):
+    """Add bias to the end token logit, so random decoders finish at different steps, and make the first row
+    emit the end token at its first step"""
+    calls = [0]
+
+    def hook(module, input, output):
+        output = output.clone()
+        output[..., eos_value] += bias
+        if calls[0] == 0:
+            output[0, ..., eos_value] += 100
+        calls[0] += 1
+        return output
+
+    return decoder.linear.register_forward_hook(hook)
+
+
+# recipe decoder (ingredient and image features, <end> is 1) and ingredient decoder (image features only, no
+# repeated ingredients, <end> is 0, which random decoders already emit early)
+@pytest.mark.parametrize('eos_value, replacement, ingredients, bias', [(1, True, True, 1.5), (0, False, False, 0.0)])
+def test_early_exit_matches_full_decoding(eos_value, replacement, ingredients, bias):
+    dropped = kept_first = 0
+    for seed in range(5):
+        torch.manual_seed(seed)
+        decoder = DecoderTransformer(EMBED_SIZE, VOCAB_SIZE, dropout=0.0, seq_length=STEPS, num_instrs=1,
+                                     attention_nheads=4, num_layers=2)
+        decoder.eval()
+        img_features = torch.randn(8, EMBED_SIZE, 49)
+        ingr_features = ingr_mask = None
+        if ingredients:
+            ingr_features = torch.randn(8, EMBED_SIZE, 20)
+            ingr_mask = torch.ones(8, 1, 20)
+
+        def sample(early_exit):
+            state = utils.IncrementalState(STEPS)
+            handle = eos_bias(decoder, eos_value, bias)
+            try:
+                with torch.no_grad():
+                    ids, logits = decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features,
+                                                 first_token_value=0, replacement=replacement,
+                                                 last_token_value=eos_value, incremental_state=state,
+                                                 early_exit=early_exit)
+            finally:
+                handle.remove()
+            return ids, logits, state
+
+        full_ids, full_logits, _ = sample(False)
+        ids, logits, state = sample(True)
+
+        keep = mask_from_eos(full_ids, eos_value).bool()
+        assert torch.equal(ids[keep], full_ids[keep]), seed
+        assert torch.allclose(logits[keep], full_logits[keep], atol=1e-5), seed
+        assert bool((ids[~keep] == eos_value).all()), seed
+        assert bool((logits[~keep] == 0).all()), seed
+        dropped += state.stats()['row_steps'] < 8 * STEPS
+        kept_first += full_ids[0, 1].item() != eos_value
+
+    # finished rows were dropped, and a row emitting the end token at its first step kept decoding
+    assert dropped > 0 and kept_first > 0
@@ -0,0 +1,54 @@
+"""Incremental decoding with the preallocated key/value caches gives the logits of a full forward over the same
+prefix, without cache, including after the beam search reorders of the caches."""
+import copy
+
+import pytest
+import torch
+
+import modules.utils as utils
+from modules.transformer_decoder import DecoderTransformer
+
+EMBED_SIZE = 32
+VOCAB_SIZE = 20
+STEPS = 10
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_cached_steps_match_full_forward(fused):
+    torch.manual_seed(0)
+    decoder = DecoderTransformer(EMBED_SIZE, VOCAB_SIZE, dropout=0.0, seq_length=STEPS, num_instrs=1,
+                                 attention_nheads=4, num_layers=2)
+    decoder.eval()
+    reference = copy.deepcopy(decoder)
+    if fused:
+        decoder.fuse()
+
+    img_features = torch.randn(2, EMBED_SIZE, 49)
+    ingr_features = torch.randn(2, EMBED_SIZE, 20)
+    ingr_mask = torch.ones(2, 1, 20)
+    ingr_mask[1, :, 5:] = 0
+    # no id 0 in the captions, a full forward takes it for padding
+    captions = torch.randint(1, VOCAB_SIZE, (4, STEPS))
+    # two hypotheses per image, reordered as beam search does: only among the hypotheses of the same image
+    reorders = {3: [1, 1, 2, 3], 4: [0, 1, 3, 3], 7: [1, 0, 3, 2]}
+
+    with torch.no_grad():
+        memory, memory_mask = decoder.prepare_memory(ingr_features, ingr_mask, img_features)
+        state = utils.IncrementalState(STEPS)
+        decoder.precompute_static_kv(memory, state)
+        expand_order = torch.tensor([0, 0, 1, 1])
+        state.reorder(expand_order)
+        memory = memory.index_select(1, expand_order)
+        memory_mask = memory_mask.index_select(0, expand_order)
+
+        prefix = captions[:, :0]
+        for t in range(STEPS):
+            if t in reorders:
+                order = torch.tensor(reorders[t])
+                prefix = prefix.index_select(0, order)
+                for layer in decoder.layers:
+                    layer.reorder_incremental_state(state, order)
+            prefix = torch.cat((prefix, captions[:, t:t + 1]), 1)
+            logits, _ = decoder.decode(prefix, memory, memory_mask, state)
+            full_logits, _ = reference.decode(prefix, memory, memory_mask)
+            assert torch.allclose(logits[:, 0], full_logits[:, -1], atol=1e-5), t
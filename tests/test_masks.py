@@ -0,0 +1,33 @@
+"""The vectorized mask_from_eos and label2onehot match their previous loop-based versions."""
+import pytest
+import torch
+
+from Foodimg2Ing.model import label2onehot, mask_from_eos
+from tests.reference import legacy_label2onehot, legacy_mask_from_eos, random_ids
+
+VOCAB_SIZE = 10
+
+# eos (0) in the middle, at the start, repeated, missing, everywhere; padding (VOCAB_SIZE) after the eos
+IDS = torch.tensor([
+    [3, 5, 0, 10, 10, 10],
+    [0, 4, 2, 0, 10, 10],
+    [0, 0, 0, 7, 0, 10],
+    [1, 2, 3, 4, 5, 6],
+    [0, 0, 0, 0, 0, 0],
+    [4, 4, 0, 4, 4, 0],
+])
+
+
+@pytest.mark.parametrize('mult_before', [True, False])
+def test_mask_from_eos(mult_before):
+    torch.manual_seed(0)
+    for ids in (IDS, random_ids(64, 20, VOCAB_SIZE)):
+        mask = mask_from_eos(ids, 0, mult_before)
+        assert mask.dtype == torch.uint8
+        assert torch.equal(mask, legacy_mask_from_eos(ids, 0, mult_before))
+
+
+def test_label2onehot():
+    torch.manual_seed(0)
+    for ids in (IDS, random_ids(64, 20, VOCAB_SIZE)):
+        assert torch.equal(label2onehot(ids, VOCAB_SIZE), legacy_label2onehot(ids, VOCAB_SIZE))
@@ -0,0 +1,36 @@
+"""Positional embeddings looked up in their precomputed table match their previous forward methods on a tiny
+decoder."""
+import pytest
+import torch
+
+from modules.transformer_decoder import DecoderTransformer, PositionalEmbedding
+from tests.reference import embedding_parity, legacy
+
+
+@pytest.mark.parametrize('learned', [True, False])
+def test_embeddings_match(learned):
+    torch.manual_seed(0)
+    embed_positions = PositionalEmbedding(64, 16, 0, left_pad=False, learned=learned)
+    assert embedding_parity(embed_positions, batch_size=3, steps=12, vocab_size=20) == 0
+
+
+@pytest.mark.parametrize('learned', [True, False])
+def test_decoder_samples_match(learned):
+    torch.manual_seed(0)
+    decoder = DecoderTransformer(32, 20, dropout=0.0, seq_length=10, num_instrs=1, attention_nheads=8,
+                                 num_layers=2, learned=learned)
+    decoder.eval()
+    img_features = torch.randn(2, 32, 49)
+    ingr_features = torch.randn(2, 32, 20)
+    ingr_mask = torch.ones(2, 1, 20)
+
+    def sample():
+        with torch.no_grad():
+            return decoder.sample(ingr_features, ingr_mask, greedy=True, img_features=img_features,
+                                  first_token_value=0, last_token_value=1)
+
+    ids, logits = sample()
+    with legacy(decoder):
+        legacy_ids, legacy_logits = sample()
+    assert torch.equal(ids, legacy_ids)
+    assert torch.equal(logits, legacy_logits)
@@ -0,0 +1,45 @@
+"""prepare_output_batch gives the result of the previous per-recipe prepare_output for every recipe of a batch."""
+import numpy as np
+
+from tests.reference import legacy_prepare_output, random_outputs
+from utils.output_utils import prepare_output_batch
+
+# laid out like the instruction and ingredient vocabularies of the model
+VOCAB = (['<start>', '<end>', '<eoi>', '.', ',', '(', ')', "'", ';', ':']
+         + ['word{}'.format(i) for i in range(40)])
+INGRS_VOCAB = ['<end>'] + ['ingredient{}'.format(i) for i in range(30)] + ['<pad>']
+
+# one recipe per validity rule, padded with <end> (the one without <end> is the longest)
+RECIPES = [
+    'word1 word2 <eoi> word3 ( word4 ) , word5 . <eoi> word6 \' word7 ; word8 : <end>',
+    'word1 word2 <eoi> word3 word4 <eoi> word5 word6 ( word7 ) , word8 . <eoi> word9 ; word10 : word11',
+    'word1 <eoi> word2 word2 word2 word2 word2 word2 word2 word2 word2 word2 word2 <end>',
+    'word1 <eoi> word2 word3 <eoi> word2 word3 <eoi> word4 <end>',
+    'word1 <eoi> word2 word3 word3 word4 <eoi> word5 <end>',
+    'word1 <eoi> <eoi> word2 <end> word3 word3',
+]
+
+
+def test_matches_legacy():
+    word2id = {word: i for i, word in enumerate(VOCAB)}
+    length = max(len(recipe.split()) for recipe in RECIPES)
+    ids = np.full((len(RECIPES), length), word2id['<end>'])
+    for i, recipe in enumerate(RECIPES):
+        words = recipe.split()
+        ids[i, :len(words)] = [word2id[word] for word in words]
+    # ingredients followed by <pad>, no ingredient, no <pad>
+    ingr_ids = np.full((len(RECIPES), 5), len(INGRS_VOCAB) - 1)
+    ingr_ids[0, :2] = [3, 1]
+    ingr_ids[2] = [4, 8, 15, 16, 23]
+
+    rng = np.random.default_rng(0)
+    random_ids, random_ingr_ids = random_outputs(rng, 500, VOCAB, INGRS_VOCAB, length=40)
+
+    reasons = set()
+    for ids, ingr_ids in ((ids, ingr_ids), (random_ids, random_ingr_ids)):
+        for i, result in enumerate(prepare_output_batch(ids, ingr_ids, INGRS_VOCAB, VOCAB)):
+            legacy = legacy_prepare_output(ids[i], ingr_ids[i], INGRS_VOCAB, VOCAB)
+            assert result == legacy, i
+            reasons.add(legacy[1]['reason'])
+    # every validity rule was exercised
+    assert reasons == {'All ok.', 'no eos found', 'Diversity score.', 'Repeated instructions.', 'Found word repeat.'}
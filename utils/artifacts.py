@@ -0,0 +1,215 @@
+"""Offline-first resolution of the model artifacts fetched from the Hugging Face hub.
+
+Every artifact that was resolved once is recorded in a manifest (data/artifacts.json) with its local path, the
+hub revision it was downloaded at (its version), and the size and sha256 of its files. Resolving an artifact
+reads the manifest and checks the files against it without touching the network, so a cold start with no
+network does not wait on any hub timeout. The hub is only contacted on an explicit refresh, or when the
+artifact is neither in the manifest, in the local hub cache nor at its local fallback path.
+
+    python -m utils.artifacts                  # list the artifacts and check them against the manifest
+    python -m utils.artifacts --refresh        # download the latest revisions and record them
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_FILENAME = 'artifacts.json'
+DATA_DIR = './data'
+
+# repo_id and filename on the hub (no filename: the whole repository, restricted to allow_patterns), cache_dir
+# relative to the data directory (None: the default hub cache) and the path relative to the data directory
+# used when the hub has never been reached
+ARTIFACTS = {
+    'inverse-cooking': {
+        'repo_id': 'dark-side/ai-recipe-generator-model',
+        'filename': 'modelbest.ckpt',
+        'cache_dir': '.',
+        'local': 'modelbest.ckpt',
+    },
+    't5-recipe-generation': {
+        'repo_id': 'flax-community/t5-recipe-generation',
+    },
+    'flan-t5-base': {
+        'repo_id': 'google/flan-t5-base',
+    },
+}
+# files of a repository needed by transformers with the pytorch backend
+ALLOW_PATTERNS = ['*.json', '*.model', '*.txt', '*.safetensors', 'pytorch_model.bin']
+
+_lock = threading.Lock()
+
+
+class ArtifactError(RuntimeError):
+    pass
+
+
+def get_manifest_path(data_dir):
+    return os.path.join(data_dir, MANIFEST_FILENAME)
+
+
+def load_manifest(data_dir):
+    path = get_manifest_path(data_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(data_dir, manifest):
+    path = get_manifest_path(data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def sha256sum(path, chunk_size=2 ** 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_files(path):
+    """Files of an artifact relative to its path ('' for a single file artifact)"""
+    if os.path.isfile(path):
+        return ['']
+    return sorted(os.path.relpath(os.path.join(root, name), path)
+                  for root, _, names in os.walk(path) for name in names)
+
+
+def describe_files(path):
+    files = {}
+    for name in list_files(path):
+        file_path = os.path.join(path, name) if name else path
+        stat = os.stat(file_path)
+        files[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256sum(file_path)}
+    return files
+
+
+def hub_revision(path):
+    """Commit of a file or snapshot directory of the hub cache (.../snapshots/<commit>/...), or None"""
+    parts = os.path.normpath(path).split(os.sep)
+    if 'snapshots' in parts and parts.index('snapshots') + 1 < len(parts):
+        return parts[parts.index('snapshots') + 1]
+    return None
+
+
+def verify(entry, full=False):
+    """Check the files of a manifest entry, returns the reason they do not match or None.
+
+    Sizes are always checked. Hashes are checked with full=True, and for files modified since they were
+    recorded.
+    """
+    path = entry['path']
+    if not os.path.exists(path):
+        return 'missing {}'.format(path)
+    for name, recorded in entry['files'].items():
+        file_path = os.path.join(path, name) if name else path
+        if not os.path.exists(file_path):
+            return 'missing {}'.format(file_path)
+        stat = os.stat(file_path)
+        if stat.st_size != recorded['size']:
+            return 'size of {} is {}, expected {}'.format(file_path, stat.st_size, recorded['size'])
+        if full or stat.st_mtime != recorded['mtime']:
+            if sha256sum(file_path) != recorded['sha256']:
+                return 'sha256 of {} does not match the manifest'.format(file_path)
+            # same content, do not hash it again next time
+            recorded['mtime'] = stat.st_mtime
+    return None
+
+
+def fetch(spec, data_dir, local_files_only):
+    """Path of the artifact in the hub cache, downloading it unless local_files_only"""
+    from huggingface_hub import hf_hub_download, snapshot_download
+
+    cache_dir = os.path.join(data_dir, spec['cache_dir']) if spec.get('cache_dir') else None
+    if spec.get('filename'):
+        return hf_hub_download(repo_id=spec['repo_id'], filename=spec['filename'], cache_dir=cache_dir,
+                               local_files_only=local_files_only)
+    return snapshot_download(repo_id=spec['repo_id'], cache_dir=cache_dir, allow_patterns=ALLOW_PATTERNS,
+                             local_files_only=local_files_only)
+
+
+def locate(name, data_dir, refresh):
+    """Path and version of an artifact that is not in the manifest (or with refresh)"""
+    spec = ARTIFACTS[name]
+    if not refresh:
+        try:
+            path = fetch(spec, data_dir, local_files_only=True)
+            return path, hub_revision(path)
+        except Exception:
+            pass
+        if spec.get('local') and os.path.exists(os.path.join(data_dir, spec['local'])):
+            return os.path.join(data_dir, spec['local']), 'local'
+
+    try:
+        path = fetch(spec, data_dir, local_files_only=False)
+    except Exception as e:
+        raise ArtifactError('Could not download {} from the Hugging Face hub: {}'.format(name, e))
+    print(f"Downloaded {name} from the Hugging Face hub to {path}")
+    return path, hub_revision(path)
+
+
+def resolve(name, data_dir=DATA_DIR, refresh=False):
+    """Local path of the artifact `name`, from the manifest in data_dir.
+
+    Artifacts that are not in the manifest yet are looked up in the local hub cache, then at their local
+    fallback path, and downloaded last, and recorded. With refresh, the latest revision is downloaded and
+    recorded instead. Raises ArtifactError when the recorded files changed.
+    """
+    if name not in ARTIFACTS:
+        raise KeyError('Unknown artifact {}, expected one of {}'.format(name, ', '.join(ARTIFACTS)))
+
+    with _lock:
+        manifest = load_manifest(data_dir)
+        entry = manifest.get(name)
+        if entry is not None and not refresh:
+            recorded = json.dumps(entry)
+            problem = verify(entry)
+            if problem is None:
+                if json.dumps(entry) != recorded:
+                    record(data_dir, manifest, name, entry)
+                return entry['path']
+            # a local file replaced by another one is recorded again, hub files are expected to stay as they were
+            if entry['version'] != 'local' or not os.path.exists(entry['path']):
+                raise ArtifactError('{} does not match the manifest: {}. Run `python -m utils.artifacts '
+                                    '--refresh {}` to fetch it again'.format(name, problem, name))
+
+        path, version = locate(name, data_dir, refresh)
+        entry = {'repo_id': ARTIFACTS[name]['repo_id'], 'version': version, 'path': path,
+                 'files': describe_files(path)}
+        record(data_dir, manifest, name, entry)
+        return path
+
+
+def record(data_dir, manifest, name, entry):
+    manifest[name] = entry
+    try:
+        save_manifest(data_dir, manifest)
+    except OSError as e:
+        print(f"Could not record {name} in {get_manifest_path(data_dir)}: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resolve, verify or refresh the model artifacts')
+    parser.add_argument('names', nargs='*', default=list(ARTIFACTS),
+                        help='artifacts among {}, all by default'.format(', '.join(ARTIFACTS)))
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR,
+                        help='directory holding the manifest')
+    parser.add_argument('--refresh', action='store_true',
+                        help='download the latest revisions from the hub')
+    parser.add_argument('--verify', action='store_true',
+                        help='check the sha256 of every file, not only their size')
+    args = parser.parse_args()
+
+    for name in args.names:
+        path = resolve(name, args.data_dir, refresh=args.refresh)
+        entry = load_manifest(args.data_dir)[name]
+        problem = verify(entry, full=True) if args.verify else None
+        size = sum(f['size'] for f in entry['files'].values())
+        print('{:<22} {:<42} {:>10.1f} MB  {}{}'.format(name, str(entry['version']), size / 2 ** 20, path,
+                                                       '  ' + problem if problem else ''))
@@ -1,16 +1,22 @@
-
 import pickle
 from tqdm import tqdm
 import os
+import json
+import time
 import numpy as np
 from PIL import Image
 import argparse
 import lmdb
+from multiprocessing import Pool
 from torchvision import transforms
 
 
 MAX_SIZE = 1e12
 
+# set in every worker of the pool by init_worker
+worker_root = None
+worker_imscale = None
+
 
 def load_and_resize(root, path, imscale):
 
@@ -25,31 +31,106 @@ def load_and_resize(root, path, imscale):
     return img
 
 
+def init_worker(root, imscale):
+    global worker_root, worker_imscale
+    worker_root = root
+    worker_imscale = imscale
+
+
+def load_entry(path):
+    """Key and raw uint8 bytes (imscale x imscale x 3) of an image, run in the worker processes"""
+    im = load_and_resize(worker_root, path, worker_imscale)
+    return path.encode(), np.asarray(im, dtype=np.uint8).tobytes()
+
+
+def progress_path(save_dir, split):
+    return os.path.join(save_dir, 'lmdb_' + split + '.progress.json')
+
+
+def load_progress(save_dir, split, paths):
+    """Number of leading paths already committed by a previous run, 0 if it worked on another image list"""
+    path = progress_path(save_dir, split)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        progress = json.load(f)
+    if progress['total'] != len(paths) or progress['last'] != (paths[progress['done'] - 1] if progress['done'] else None):
+        return 0
+    return progress['done']
+
+
+def save_progress(save_dir, split, paths, done):
+    path = progress_path(save_dir, split)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'done': done, 'total': len(paths), 'last': paths[done - 1] if done else None}, f)
+    os.replace(path + '.tmp', path)
+
+
+def commit(env, batch):
+    with env.begin(write=True) as txn:
+        for key, value in batch:
+            txn.put(key, value)
+    return len(batch)
+
+
+def build_split(env, paths, args, split):
+    """Writes the images of paths missing from env, from a pool of args.num_workers processes.
+
+    Results come back in order and are committed every args.commit_every images, the progress file then
+    records how many leading paths are stored so that an interrupted run resumes from there.
+    """
+    done = load_progress(args.save_dir, split, paths)
+    with env.begin() as txn:
+        todo = [p for p in paths[done:] if txn.get(p.encode()) is None]
+    print('{}: {} images, {} already stored, {} to load'.format(split, len(paths), len(paths) - len(todo), len(todo)))
+    if not todo:
+        save_progress(args.save_dir, split, paths, len(paths))
+        return
+
+    # position in paths of each image to load, to checkpoint the committed prefix
+    position = {p: i for i, p in enumerate(paths)}
+    root = os.path.join(args.root, 'images', split)
+    start = time.time()
+    written = 0
+    with Pool(args.num_workers, initializer=init_worker, initargs=(root, args.imscale)) as pool:
+        results = pool.imap(load_entry, todo, chunksize=args.chunksize)
+        batch = []
+        for key, value in tqdm(results, total=len(todo)):
+            batch.append((key, value))
+            if len(batch) == args.commit_every:
+                written += commit(env, batch)
+                save_progress(args.save_dir, split, paths, position[key.decode()] + 1)
+                batch = []
+        written += commit(env, batch)
+    save_progress(args.save_dir, split, paths, len(paths))
+
+    elapsed = time.time() - start
+    print('{}: wrote {} images in {:.1f}s ({:.1f} images/s)'.format(split, written, elapsed, written / elapsed))
+
+
 def main(args):
 
-    parts = {}
     datasets = {}
     imname2pos = {'train': {}, 'val': {}, 'test': {}}
     for split in ['train', 'val', 'test']:
         datasets[split] = pickle.load(open(os.path.join(args.save_dir, args.suff + 'recipe1m_' + split + '.pkl'), 'rb'))
 
-        parts[split] = lmdb.open(os.path.join(args.save_dir, 'lmdb_'+split), map_size=int(MAX_SIZE))
-        with parts[split].begin() as txn:
-            present_entries = [key for key, _ in txn.cursor()]
+        paths = []
         j = 0
-        for i, entry in tqdm(enumerate(datasets[split])):
+        for entry in datasets[split]:
             impaths = entry['images'][0:5]
 
             for n, p in enumerate(impaths):
                 if n == args.maxnumims:
                     break
-                if p.encode() not in present_entries:
-                    im = load_and_resize(os.path.join(args.root, 'images', split), p, args.imscale)
-                    im = np.array(im).astype(np.uint8)
-                    with parts[split].begin(write=True) as txn:
-                        txn.put(p.encode(), im)
+                if p not in imname2pos[split]:
+                    paths.append(p)
                 imname2pos[split][p] = j
                 j += 1
+
+        env = lmdb.open(os.path.join(args.save_dir, 'lmdb_'+split), map_size=int(MAX_SIZE))
+        build_split(env, paths, args, split)
+        env.close()
     pickle.dump(imname2pos, open(os.path.join(args.save_dir, 'imname2pos.pkl'), 'wb'))
 
 
@@ -63,11 +144,11 @@ def test(args):
         break
     image_file = lmdb.open(os.path.join(args.save_dir, 'lmdb_' + 'val'), max_readers=1, readonly=True,
                            lock=False, readahead=False, meminit=False)
-    with image_file.begin(write=False) as txn:
+    with image_file.begin(write=False, buffers=True) as txn:
         image = txn.get(path.encode())
-        image = np.fromstring(image, dtype=np.uint8)
+        image = np.frombuffer(image, dtype=np.uint8)
         image = np.reshape(image, (args.imscale, args.imscale, 3))
-    image = Image.fromarray(image.astype('uint8'), 'RGB')
+        image = Image.fromarray(image, 'RGB')
     print (np.shape(image))
 
 
@@ -84,6 +165,12 @@ if __name__ == "__main__":
                         help='maximum number of images to allow for each sample')
     parser.add_argument('--suff', type=str, default='',
                         help='id of the vocabulary to use')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='number of processes loading and resizing images')
+    parser.add_argument('--commit_every', type=int, default=1000,
+                        help='number of images written per lmdb transaction')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='number of images sent to a worker at a time')
     parser.add_argument('--test_only', dest='test_only', action='store_true')
     parser.set_defaults(test_only=False)
     args = parser.parse_args()
@@ -54,6 +54,38 @@ def update_error_types(error_types, y_pred, y_true):
     error_types['fn_all'] += ((1-y_pred) * y_true).sum().item()
 
 
+class ErrorTypes(object):
+    """Accumulates the error types of update_error_types and the sum of the per-sample softIoU on the device
+    of the predictions, without copying anything to the host until result() is called."""
+
+    def __init__(self):
+        self.counts = None
+        self.iou = None
+        self.n = 0
+
+    def update(self, y_pred, y_true):
+        counts = torch.stack([(y_pred * y_true).sum(0), (y_pred * (1-y_true)).sum(0),
+                              ((1-y_pred) * y_true).sum(0), ((1-y_pred) * (1-y_true)).sum(0)]).double()
+        iou = softIoU(y_pred, y_true).sum().double()
+        if self.counts is None:
+            self.counts = counts
+            self.iou = iou
+        else:
+            self.counts += counts
+            self.iou += iou
+        self.n += y_pred.size(0)
+
+    def result(self):
+        """Error types in the format of update_error_types, plus the mean softIoU per sample ('iou')"""
+        if self.counts is None:
+            raise ValueError('no predictions were accumulated')
+        values = torch.cat([self.counts.flatten(), self.iou.view(1)]).cpu().numpy()
+        tp_i, fp_i, fn_i, tn_i = values[:-1].reshape(4, -1)
+        return {'tp_i': tp_i, 'fp_i': fp_i, 'fn_i': fn_i, 'tn_i': tn_i,
+                'tp_all': tp_i.sum(), 'fp_all': fp_i.sum(), 'fn_all': fn_i.sum(),
+                'iou': values[-1] / self.n}
+
+
 def compute_metrics(ret_metrics, error_types, metric_names, eps=1e-10, weights=None):
 
     if 'accuracy' in metric_names:
@@ -1,4 +1,6 @@
 
+import numpy as np
+
 replace_dict = {' .': '.',
                 ' ,': ',',
                 ' ;': ';',
@@ -8,34 +10,55 @@ replace_dict = {' .': '.',
                " '": "'"}
 
 
+# words of each vocabulary as a numpy array and the id of each word, built once per vocabulary object
+_vocab_arrays = {}
+
+
+def vocab_arrays(vocab):
+    """(words, word2id) of a vocabulary mapping ids 0..len(vocab)-1 to words (a list or a dict). words is a
+    numpy object array, so a whole matrix of ids is converted to words with one indexing operation"""
+    cached = _vocab_arrays.get(id(vocab))
+    if cached is None or cached[0] is not vocab:
+        words = np.empty(len(vocab), dtype=object)
+        words[:] = [vocab[i] for i in range(len(vocab))]
+        word2id = {}
+        for i, word in enumerate(words):
+            word2id.setdefault(word, i)
+        cached = (vocab, words, word2id)
+        _vocab_arrays[id(vocab)] = cached
+    return cached[1], cached[2]
+
+
+def first_index(ids, value):
+    """Position of the first `value` in each row of ids, or the row length when there is none"""
+    found = ids == value
+    return np.where(found.any(1), found.argmax(1), ids.shape[1])
+
+
 def get_recipe(ids, vocab):
-    toks = []
-    for id_ in ids:
-        toks.append(vocab[id_])
-    return toks
+    words, _ = vocab_arrays(vocab)
+    return words[np.asarray(ids)].tolist()
 
 
 def get_ingrs(ids, ingr_vocab_list):
-    gen_ingrs = []
-    for ingr_idx in ids:
-        ingr_name = ingr_vocab_list[ingr_idx]
-        if ingr_name == '<pad>':
-            break
-        gen_ingrs.append(ingr_name)
-    return gen_ingrs
+    words, word2id = vocab_arrays(ingr_vocab_list)
+    ids = np.asarray(ids).reshape(1, -1)
+    cut = first_index(ids, word2id.get('<pad>', -1))[0]
+    return words[ids[0, :cut]].tolist()
 
 
 def prettify(toks, replace_dict):
     toks = ' '.join(toks)
     toks = toks.split('<end>')[0]
+    # replacements only remove spaces next to punctuation, they can run once on the whole recipe
+    for k, v in replace_dict.items():
+        toks = toks.replace(k, v)
     sentences = toks.split('<eoi>')
 
     pretty_sentences = []
     for sentence in sentences:
         sentence = sentence.strip()
         sentence = sentence.capitalize()
-        for k, v in replace_dict.items():
-            sentence = sentence.replace(k, v)
         if sentence != '':
             pretty_sentences.append(sentence)
     return pretty_sentences
@@ -57,46 +80,70 @@ def colorized_list(ingrs, ingrs_gt, colorize=False):
 
 def prepare_output(ids, gen_ingrs, ingr_vocab_list, vocab):
 
-    toks = get_recipe(ids, vocab)
-    is_valid = True
-    reason = 'All ok.'
-    try:
-        cut = toks.index('<end>')
-        toks_trunc = toks[0:cut]
-    except:
-        toks_trunc = toks
-        is_valid = False
-        reason = 'no eos found'
-
-    # repetition score
-    score = float(len(set(toks_trunc))) / float(len(toks_trunc))
-
-    prev_word = ''
-    found_repeat = False
-    for word in toks_trunc:
-        if prev_word == word and prev_word != '<eoi>':
-            found_repeat = True
-            break
-        prev_word = word
-
-    toks = prettify(toks, replace_dict)
-    title = toks[0]
-    toks = toks[1:]
+    if gen_ingrs is not None:
+        gen_ingrs = np.asarray(gen_ingrs)[None]
+    return prepare_output_batch(np.asarray(ids)[None], gen_ingrs, ingr_vocab_list, vocab)[0]
+
+
+def prepare_output_batch(ids, gen_ingrs, ingr_vocab_list, vocab):
+    """prepare_output for every row of a batch of recipe ids (N x T) and ingredient ids (N x L, or None).
+
+    Ids are converted to words, truncated at the first <end> / <pad> and checked for repeated words on whole
+    matrices, only the diversity score and the sentences are built per recipe.
+    """
+    ids = np.asarray(ids)
+    words, word2id = vocab_arrays(vocab)
+    toks = words[ids]
+    lengths = first_index(ids, word2id.get('<end>', -1))
+    has_eos = lengths < ids.shape[1]
+
+    in_recipe = np.arange(ids.shape[1]) < lengths[:, None]
+
+    # repetition score: distinct words (distinct ids, words of a vocabulary are distinct) over length,
+    # counted on the sorted rows with the positions after <end> set to -1
+    sorted_ids = np.sort(np.where(in_recipe, ids, -1), axis=1)
+    distinct = ((sorted_ids[:, 1:] != sorted_ids[:, :-1]) & (sorted_ids[:, 1:] >= 0)).sum(1) + (sorted_ids[:, 0] >= 0)
+    scores = distinct / np.maximum(lengths, 1)
+
+    # a word equal to the previous one, other than <eoi>, before the end of the recipe
+    repeats = (ids[:, 1:] == ids[:, :-1]) & (ids[:, 1:] != word2id.get('<eoi>', -1))
+    found_repeats = (repeats & in_recipe[:, 1:]).any(1)
 
     if gen_ingrs is not None:
-        gen_ingrs = get_ingrs(gen_ingrs, ingr_vocab_list)
-
-    if score <= 0.3:
-        reason = 'Diversity score.'
-        is_valid = False
-    elif len(toks) != len(set(toks)):
-        reason = 'Repeated instructions.'
-        is_valid = False
-    elif found_repeat:
-        reason = 'Found word repeat.'
-        is_valid = False
-
-    valid = {'is_valid': is_valid, 'reason': reason, 'score': score}
-    outs = {'title': title, 'recipe': toks, 'ingrs': gen_ingrs}
-
-    return outs, valid
+        ingr_words, ingr_word2id = vocab_arrays(ingr_vocab_list)
+        gen_ingrs = np.asarray(gen_ingrs)
+        ingr_lengths = first_index(gen_ingrs, ingr_word2id.get('<pad>', -1))
+        ingr_toks = ingr_words[gen_ingrs]
+
+    results = []
+    for i in range(len(ids)):
+        is_valid = True
+        reason = 'All ok.'
+        if not has_eos[i]:
+            is_valid = False
+            reason = 'no eos found'
+
+        score = float(scores[i])
+        sentences = prettify(toks[i, :lengths[i]], replace_dict)
+        title = sentences[0] if sentences else ''
+        recipe = sentences[1:]
+
+        ingrs = None
+        if gen_ingrs is not None:
+            ingrs = ingr_toks[i, :ingr_lengths[i]].tolist()
+
+        if score <= 0.3:
+            reason = 'Diversity score.'
+            is_valid = False
+        elif len(recipe) != len(set(recipe)):
+            reason = 'Repeated instructions.'
+            is_valid = False
+        elif found_repeats[i]:
+            reason = 'Found word repeat.'
+            is_valid = False
+
+        valid = {'is_valid': is_valid, 'reason': reason, 'score': score}
+        outs = {'title': title, 'recipe': recipe, 'ingrs': ingrs}
+        results.append((outs, valid))
+
+    return results
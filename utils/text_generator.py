@@ -8,6 +8,7 @@ from chef_transformer import dummy, meta
 import streamlit as st
 from utils import ext
 from utils.api import generate_cook_image
+from utils.artifacts import resolve
 from utils.draw import generate_food_with_logo_image, generate_recipe_image
 import streamlit as st
 from utils.st import local_css, remote_css
@@ -30,7 +31,8 @@ class TextGeneration:
         self.api_keys = []
         self.api_test = 2
         self.task = "text2text-generation"
-        self.model_name_or_path = "flax-community/t5-recipe-generation"
+        # flax-community/t5-recipe-generation, see utils/artifacts.py
+        self.artifact = "t5-recipe-generation"
         self.color_frame = "#ffffff"
         self.main_frame = "asset/frame/recipe-bg.png"
         self.no_food = "asset/frame/no_food.png"
@@ -82,10 +84,9 @@ class TextGeneration:
         return data
 
     def load_pipeline(self):
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path)
-        self.generator = pipeline(
-            self.task, model=self.model_name_or_path, tokenizer=self.model_name_or_path
-        )
+        model_path = resolve(self.artifact)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.generator = pipeline(self.task, model=model_path, tokenizer=model_path)
 
     def load_api(self):
         app_ids = os.getenv("EDAMAM_APP_ID")